@@ -7,7 +7,7 @@ import time
 
 from channel import channel_factory
 from common import const
-from config import load_config
+from config import get_config_path, load_config, reload_config
 from plugins import *
 import threading
 
@@ -38,6 +38,15 @@ def start_channel(channel_name: str):
             threading.Thread(target=linkai_client.start, args=(channel,)).start()
         except Exception as e:
             pass
+    if conf().get("metrics_port"):
+        from common import metrics
+        metrics.start_server(conf().get("metrics_port"), conf().get("metrics_host", "127.0.0.1"))
+    if conf().get("config_watch_interval"):
+        from common import config_watcher
+        config_watcher.start(conf().get("config_watch_interval"), conf().get("config_watch_debounce", 1), {
+            get_config_path(): reload_config,
+            "./plugins/config.json": PluginManager().reload_plugin_configs,
+        })
     channel.startup()
 
 
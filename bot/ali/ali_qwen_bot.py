@@ -1,6 +1,7 @@
 # encoding:utf-8
 
 import json
+import logging
 import time
 from typing import List, Tuple
 
@@ -16,13 +17,13 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common import const
-from config import conf, load_config
+from config import conf, reload_config
 
 class AliQwenBot(Bot):
     def __init__(self):
         super().__init__()
         self.api_key_expired_time = self.set_api_key()
-        self.sessions = SessionManager(AliQwenSession, model=conf().get("model", const.QWEN))
+        self.sessions = SessionManager(AliQwenSession, namespace=type(self).__name__, model=conf().get("model", const.QWEN))
 
     def api_key_client(self):
         return broadscope_bailian.AccessTokenClient(access_key_id=self.access_key_id(), access_key_secret=self.access_key_secret())
@@ -63,22 +64,15 @@ class AliQwenBot(Bot):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[QWEN] session query={}".format(session.messages))
+            logger.debug("[QWEN] session query=%s", session.messages)
 
             reply_content = self.reply_text(session)
-            logger.debug(
-                "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
+            logger.debug("[QWEN] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session_id, reply_content["content"], reply_content["completion_tokens"])
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
@@ -86,7 +80,7 @@ class AliQwenBot(Bot):
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[QWEN] reply {} used 0 tokens.".format(reply_content))
+                logger.debug("[QWEN] reply %s used 0 tokens.", reply_content)
             return reply
 
         else:
@@ -176,8 +170,9 @@ class AliQwenBot(Bot):
             # NOTE 模拟系统消息，测试发现人格描述以"你需要扮演ChatGPT"开头能够起作用，而以"你是ChatGPT"开头模型会直接否认
             system_qa = ChatQaMessage(system_content, '好的，我会严格按照你的设定回答问题')
             history.insert(0, system_qa)
-        logger.debug("[QWEN] converted qa messages: {}".format([item.to_dict() for item in history]))
-        logger.debug("[QWEN] user content as prompt: {}".format(user_content))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[QWEN] converted qa messages: %s", [item.to_dict() for item in history])
+        logger.debug("[QWEN] user content as prompt: %s", user_content)
         return user_content, history
 
     def get_completion_content(self, response, node_id):
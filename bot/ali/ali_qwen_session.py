@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from bot.token_counter import TokenLedger, get_token_counter
 from common.log import logger
 
 """
@@ -14,6 +15,7 @@ from common.log import logger
 class AliQwenSession(Session):
     def __init__(self, session_id, system_prompt=None, model="qianwen"):
         super().__init__(session_id, system_prompt)
+        self.token_ledger = TokenLedger(get_token_counter(None))
         self.model = model
         self.reset()
 
@@ -25,22 +27,22 @@ class AliQwenSession(Session):
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
         while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+            if len(self.history) > 2:
+                self.pop_turn()
+            elif len(self.history) == 2 and self.history[1]["role"] == "assistant":
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
+            elif len(self.history) == 2 and self.history[1]["role"] == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(messages)=%s", max_tokens, cur_tokens, len(self.history))
                 break
             if precise:
                 cur_tokens = self.calc_tokens()
@@ -49,14 +51,7 @@ class AliQwenSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
-
-def num_tokens_from_messages(messages, model):
-    """Returns the number of tokens used by a list of messages."""
-    # 官方token计算规则："对于中文文本来说，1个token通常对应一个汉字；对于英文文本来说，1个token通常对应3至4个字母或1个单词"
-    # 详情请产看文档：https://help.aliyun.com/document_detail/2586397.html
-    # 目前根据字符串长度粗略估计token数，不影响正常使用
-    tokens = 0
-    for msg in messages:
-        tokens += len(msg["content"])
-    return tokens
+        # 官方token计算规则："对于中文文本来说，1个token通常对应一个汉字；对于英文文本来说，1个token通常对应3至4个字母或1个单词"
+        # 详情请产看文档：https://help.aliyun.com/document_detail/2586397.html
+        # 目前根据字符串长度粗略估计token数，不影响正常使用
+        return self.token_ledger.tokens(self.history)
@@ -0,0 +1,155 @@
+import threading
+import time
+
+from common.log import logger
+from common.token_bucket import RateLimiter
+from config import conf
+
+
+class ApiKey(object):
+    def __init__(self, key, weight=1, max_in_flight=0, tokens_per_minute=0):
+        self.key = key
+        self.weight = weight
+        self.max_in_flight = max_in_flight  # 同时进行中的请求数上限，0表示不限制
+        self.limiter = RateLimiter(tokens_per_minute) if tokens_per_minute else None  # 按实际token用量限流
+        self.in_flight = 0
+        self.current_weight = 0  # 平滑加权轮询的当前权重
+        self.evicted_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_tokens = 0
+
+    def available(self, now):
+        if self.evicted_until > now:
+            return False
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        if self.limiter and self.limiter.wait_time() > 0:
+            return False
+        return True
+
+    def __repr__(self):
+        return "ApiKey({}...{})".format(self.key[:3], self.key[-4:]) if self.key and len(self.key) > 8 else "ApiKey(***)"
+
+
+class ApiKeyPool(object):
+    """
+    多个api_key的负载均衡：平滑加权轮询，限制每个key同时进行中的请求数，
+    返回429/401的key暂时移出轮询，并按回复中的token用量对每个key限流
+    """
+
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """选取一个可用的key并计入进行中的请求，都不可用时返回None"""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [k for k in self.keys if k.available(now)]
+            if not candidates:
+                # 剩下的key都被移出轮询时，选择最早恢复的key，避免完全不可用
+                evicted = [k for k in self.keys if k.available(0)]
+                if not evicted:
+                    return None
+                candidates = [min(evicted, key=lambda k: k.evicted_until)]
+            total = 0
+            best = None
+            for key in candidates:
+                key.current_weight += key.weight
+                total += key.weight
+                if best is None or key.current_weight > best.current_weight:
+                    best = key
+            best.current_weight -= total
+            best.in_flight += 1
+            best.requests += 1
+            return best
+
+    def release(self, api_key: ApiKey, status_code=None, tokens=0):
+        """
+        请求结束后调用
+        :param status_code: 失败时的http状态码，429/401会让该key暂时移出轮询
+        :param tokens: 本次请求消耗的token数
+        """
+        with self.lock:
+            api_key.in_flight = max(api_key.in_flight - 1, 0)
+            if status_code:
+                api_key.errors += 1
+            if status_code in (401, 429):
+                seconds = conf().get("api_key_evict_seconds", 60)
+                if status_code == 401:
+                    seconds *= 10  # 授权失败通常不会自行恢复
+                api_key.evicted_until = time.monotonic() + seconds
+                logger.warning("[{}] {} evicted for {}s, status_code={}".format(self.name, api_key, seconds, status_code))
+        if tokens:
+            self.add_usage(api_key, tokens)
+
+    def add_usage(self, api_key: ApiKey, tokens):
+        """记录token用量，超出该key的tokens_per_minute后暂停选用，直到额度恢复"""
+        with self.lock:
+            api_key.total_tokens += tokens
+        if api_key.limiter:
+            api_key.limiter.consume(None, tokens)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "key": repr(k),
+                    "weight": k.weight,
+                    "in_flight": k.in_flight,
+                    "requests": k.requests,
+                    "errors": k.errors,
+                    "total_tokens": k.total_tokens,
+                    "evicted": k.evicted_until > now,
+                }
+                for k in self.keys
+            ]
+
+
+def status_code_of(e):
+    """获取openai/anthropic/requests异常对应的http状态码"""
+    for attr in ("http_status", "status_code"):
+        code = getattr(e, attr, None)
+        if isinstance(code, int):
+            return code
+    response = getattr(e, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(name, default_key=None):
+    """
+    获取名为name的key池，key列表读取配置name_api_keys，元素可以是字符串或
+    {"key": ..., "weight": 1, "max_in_flight": 0, "tokens_per_minute": 0}，未配置时使用default_key
+    """
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            keys = []
+            for item in conf().get(name + "_api_keys") or []:
+                if isinstance(item, str):
+                    item = {"key": item}
+                keys.append(ApiKey(
+                    item["key"],
+                    item.get("weight", 1),
+                    item.get("max_in_flight", conf().get("api_key_max_in_flight", 0)),
+                    item.get("tokens_per_minute", 0),
+                ))
+            if not keys and default_key:
+                keys.append(ApiKey(default_key, max_in_flight=conf().get("api_key_max_in_flight", 0)))
+            pool = _pools[name] = ApiKeyPool(name, keys)
+            logger.debug("[ApiKeyPool] create pool %s with %s keys", name, len(keys))
+        return pool
+
+
+def reset_key_pools():
+    """配置变更后调用，下次获取时按新配置重建"""
+    with _pools_lock:
+        _pools.clear()
@@ -1,18 +1,21 @@
 # encoding:utf-8
 
-import requests
 import json
+from common import http_client
 from common import const
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.token_cache import get_token_cache
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 BAIDU_API_KEY = conf().get("baidu_wenxin_api_key")
 BAIDU_SECRET_KEY = conf().get("baidu_wenxin_secret_key")
+# access_token无效或已过期的错误码
+INVALID_TOKEN_CODES = (110, 111)
 
 class BaiduWenxinBot(Bot):
 
@@ -27,7 +30,7 @@ class BaiduWenxinBot(Bot):
             elif conf().get("model") and conf().get("model") == const.WEN_XIN_4:
                 wenxin_model = "completions_pro"
 
-        self.sessions = SessionManager(BaiduWenxinSession, model=wenxin_model)
+        self.sessions = SessionManager(BaiduWenxinSession, namespace=type(self).__name__, model=wenxin_model)
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -50,9 +53,7 @@ class BaiduWenxinBot(Bot):
                         result["completion_tokens"],
                         result["content"],
                     )
-                    logger.debug(
-                        "[BAIDU] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(session.messages, session_id, reply_content, completion_tokens)
-                    )
+                    logger.debug("[BAIDU] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session_id, reply_content, completion_tokens)
 
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
@@ -85,9 +86,12 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            if response_text.get("error_code") in INVALID_TOKEN_CODES:
+                # access_token失效，下次请求重新获取
+                self._token_cache().invalidate()
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -107,9 +111,21 @@ class BaiduWenxinBot(Bot):
 
     def get_access_token(self):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
-        :return: access_token，或是None(如果错误)
+        使用 AK，SK 生成鉴权签名（Access Token），有效期内复用缓存
+        :return: access_token，或是'None'(如果错误)
         """
+        try:
+            return self._token_cache().get()
+        except Exception as e:
+            logger.warn("[BAIDU] get access_token failed: {}".format(e))
+            return "None"
+
+    def _token_cache(self):
+        return get_token_cache("baidu:" + str(BAIDU_API_KEY), self._request_access_token)
+
+    @staticmethod
+    def _request_access_token():
         url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        res = http_client.post(url, params=params).json()
+        return res.get("access_token"), res.get("expires_in")
@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from bot.token_counter import TokenLedger, get_token_counter
 from common.log import logger
 
 """
@@ -13,6 +14,7 @@ from common.log import logger
 class BaiduWenxinSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
+        self.token_ledger = TokenLedger(get_token_counter(None))
         self.model = model
         # 百度文心不支持system prompt
         # self.reset()
@@ -25,13 +27,12 @@ class BaiduWenxinSession(Session):
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
         while cur_tokens > max_tokens:
-            if len(self.messages) >= 2:
-                self.messages.pop(0)
-                self.messages.pop(0)
+            if len(self.history) >= 2:
+                self.pop_turn()
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(messages)=%s", max_tokens, cur_tokens, len(self.history))
                 break
             if precise:
                 cur_tokens = self.calc_tokens()
@@ -40,14 +41,6 @@ class BaiduWenxinSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
-
-
-def num_tokens_from_messages(messages, model):
-    """Returns the number of tokens used by a list of messages."""
-    tokens = 0
-    for msg in messages:
         # 官方token计算规则暂不明确： "大约为 token数为 "中文字 + 其他语种单词数 x 1.3"
         # 这里先直接根据字数粗略估算吧，暂不影响正常使用，仅在判断是否丢弃历史会话的时候会有偏差
-        tokens += len(msg["content"])
-    return tokens
+        return self.token_ledger.tokens(self.history)
@@ -15,3 +15,10 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    def reply_stream(self, query, context: Context = None):
+        """
+        bot auto-reply content in stream
+        :return: iterator of Reply, TEXT replies are partial chunks of the answer
+        """
+        yield self.reply(query, context)
@@ -4,17 +4,18 @@ import time
 
 import openai
 import openai.error
-import requests
 
+from bot.api_key_pool import get_key_pool, status_code_of
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client, retry
 from common.log import logger
-from common.token_bucket import TokenBucket
-from config import conf, load_config
+from common.token_bucket import RateLimiter
+from config import conf, reload_config
 
 
 # OpenAI对话模型API (可用)
@@ -28,10 +29,10 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
 
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        # 未单独设置api_key的用户从key池中轮询选择，配置open_ai_api_keys可使用多个key
+        self.key_pool = get_key_pool("open_ai", conf().get("open_ai_api_key"))
+        self.sessions = SessionManager(ChatGPTSession, namespace=type(self).__name__, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {
             "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
@@ -58,14 +59,19 @@ class ChatGPTBot(Bot, OpenAIImage):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
+            api_key = context.get("openai_api_key")
+            lease = self._acquire_lease(api_key)
+            if not self._acquire_rate_limit(session_id, lease.key if lease else api_key):
+                if lease:
+                    self.key_pool.release(lease)
+                return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
+            logger.debug("[CHATGPT] session query=%s", session.messages)
 
-            api_key = context.get("openai_api_key")
             model = context.get("gpt_model")
             new_args = None
             if model:
@@ -75,24 +81,11 @@ class ChatGPTBot(Bot, OpenAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            try:
+                reply_content = self.reply_text(session, api_key, args=new_args, lease=lease)
+            except retry.RetryLater as e:
+                raise e.then(lambda content: self._build_reply(session, content))
+            return self._build_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -106,7 +99,120 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_stream(self, query, context=None):
+        # 只有普通文本对话走流式接口，命令和其他类型的消息仍按原流程一次性回复
+        if context.type != ContextType.TEXT or query in conf().get("clear_memory_commands", ["#清除记忆"]) or query in ["#清除所有", "#更新配置"]:
+            yield self.reply(query, context)
+            return
+        logger.info("[CHATGPT] stream query={}".format(query))
+        session_id = context["session_id"]
+        api_key = context.get("openai_api_key")
+        lease = self._acquire_lease(api_key)
+        used_key = lease.key if lease else api_key
+        if not self._acquire_rate_limit(session_id, used_key):
+            if lease:
+                self.key_pool.release(lease)
+            yield Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+            return
+        session = self.sessions.session_query(query, session_id)
+        args = self.args
+        if context.get("gpt_model"):
+            args = self.args.copy()
+            args["model"] = context.get("gpt_model")
+        parts = []
+        error = None
+        try:
+            response = openai.ChatCompletion.create(api_key=used_key, messages=session.messages, stream=True, **args)
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    yield Reply(ReplyType.TEXT, delta)
+        except Exception as e:
+            error = e
+        finally:
+            if lease:
+                self.key_pool.release(lease, status_code=status_code_of(error) if error else None)
+        if error is not None:
+            if not parts:
+                # 还没有输出任何内容时，退回非流式接口，复用其重试逻辑
+                logger.warn("[CHATGPT] stream error, fallback to non-stream: {}".format(error))
+                try:
+                    content = self.reply_text(session, api_key, args=args)
+                except retry.RetryLater as e:
+                    raise e.then(lambda content: self._build_reply(session, content))
+                yield self._build_reply(session, content)
+                return
+            logger.warn("[CHATGPT] stream interrupted after {} chunks: {}".format(len(parts), error))
+        if parts:
+            content = "".join(parts)
+            logger.debug("[CHATGPT] stream session_id=%s, reply_cont=%s", session_id, content)
+            self.sessions.session_reply(content, session_id)
+            # 流式接口不返回用量，按会话记录的token数估算
+            tokens = session.calc_tokens()
+            if lease:
+                self.key_pool.add_usage(lease, tokens)
+            if self.tokens_limiter:
+                self.tokens_limiter.consume(used_key, tokens)
+
+    def init_rate_limiters(self):
+        super().init_rate_limiters()
+        # 限流器按key独立计数：请求数和token用量按api_key，单会话请求数按session_id
+        self.request_limiter = RateLimiter(conf().get("rate_limit_chatgpt")) if conf().get("rate_limit_chatgpt") else None
+        self.tokens_limiter = RateLimiter(conf().get("rate_limit_chatgpt_tpm")) if conf().get("rate_limit_chatgpt_tpm") else None
+        self.session_limiter = RateLimiter(conf().get("rate_limit_session")) if conf().get("rate_limit_session") else None
+
+    def _acquire_lease(self, api_key=None):
+        """未指定api_key时从key池中选择，key池为空时返回None，使用默认的openai.api_key"""
+        return self.key_pool.acquire() if api_key is None else None
+
+    def _acquire_rate_limit(self, session_id, api_key=None) -> bool:
+        """
+        检查限流，令牌不足时最多等待rate_limit_wait秒，默认不等待直接返回False，避免占用处理线程。
+        api_key为本次请求实际使用的key，key池中的每个key分别计数
+        """
+        timeout = conf().get("rate_limit_wait", 0)
+        checks = []
+        if self.session_limiter:
+            checks.append((self.session_limiter, session_id, "session {} rate limit exceeded".format(session_id)))
+        # token用量在回复后才知道，这里只要求没有欠账
+        if self.tokens_limiter:
+            checks.append((self.tokens_limiter, api_key, "tokens per minute limit exceeded"))
+        if self.request_limiter:
+            checks.append((self.request_limiter, api_key, "requests per minute limit exceeded"))
+        wait = 0
+        for limiter, key, message in checks:
+            seconds = limiter.wait_time(key, 1)
+            if seconds > timeout:
+                logger.warn("[CHATGPT] {}".format(message))
+                return False
+            wait = max(wait, seconds)
+        if wait > 0:
+            time.sleep(wait)
+        # 所有限流器都放行后才扣除令牌，被其他限流器拒绝的请求不占用会话和请求数额度
+        if self.session_limiter:
+            self.session_limiter.consume(session_id)
+        if self.request_limiter:
+            self.request_limiter.consume(api_key)
+        return True
+
+    def _build_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        logger.debug("[CHATGPT] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session.session_id, reply_content["content"], reply_content["completion_tokens"])
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            if self.tokens_limiter:
+                self.tokens_limiter.consume(reply_content.get("api_key"), reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply %s used 0 tokens.", reply_content)
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, lease=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
@@ -114,51 +220,56 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        if lease is None:
+            lease = self._acquire_lease(api_key)
+        if api_key is None and lease is None and self.key_pool.keys:
+            logger.warn("[CHATGPT] no available api key in pool")
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            used_key = lease.key if lease else api_key
+            response = openai.ChatCompletion.create(api_key=used_key, messages=session.messages, **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
+            result = {
+                "api_key": used_key,
                 "total_tokens": response["usage"]["total_tokens"],
                 "completion_tokens": response["usage"]["completion_tokens"],
                 "content": response.choices[0]["message"]["content"],
             }
+            if lease:
+                self.key_pool.release(lease, tokens=result["total_tokens"])
+            return result
         except Exception as e:
+            if lease:
+                self.key_pool.release(lease, status_code=status_code_of(e))
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            base_delay = None
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[CHATGPT] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                base_delay = 10
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CHATGPT] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                base_delay = 5
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
             else:
                 logger.exception("[CHATGPT] Exception: {}".format(e))
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
             if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                delay = retry.backoff(retry_count, base_delay, retry_after=retry.get_retry_after(e))
+                logger.warn("[CHATGPT] 第{}次重试, {:.1f}秒后执行".format(retry_count + 1, delay))
+                return retry.retry(delay, lambda: self.reply_text(session, api_key, args, retry_count + 1), result)
             else:
                 return result
 
@@ -183,13 +294,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -208,7 +319,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 image_url = submission.json()['data'][0]['url']
                 return True, image_url
             except Exception as e:
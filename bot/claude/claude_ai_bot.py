@@ -16,7 +16,7 @@ from config import conf
 class ClaudeAIBot(Bot, OpenAIImage):
     def __init__(self):
         super().__init__()
-        self.sessions = SessionManager(ClaudeAiSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = SessionManager(ClaudeAiSession, namespace=type(self).__name__, model=conf().get("model") or "gpt-3.5-turbo")
         self.claude_api_cookie = conf().get("claude_api_cookie")
         self.proxy = conf().get("proxy")
         self.con_uuid_dic = {}
@@ -143,7 +143,7 @@ class ClaudeAIBot(Bot, OpenAIImage):
             # remove system message
             if session.messages[0].get("role") == "system":
                 if model == "wenxin" or model == "claude":
-                    session.messages.pop(0)
+                    session.pop_message(0)
             logger.info(f"[CLAUDEAI] query={query}")
 
             # do http request
@@ -1,11 +1,10 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 import anthropic
 
+from bot.api_key_pool import get_key_pool, status_code_of
 from bot.bot import Bot
 from bot.openai.open_ai_image import OpenAIImage
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -13,6 +12,7 @@ from bot.gemini.google_gemini_bot import GoogleGeminiBot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
 from config import conf
 
@@ -23,9 +23,9 @@ user_session = dict()
 class ClaudeAPIBot(Bot, OpenAIImage):
     def __init__(self):
         super().__init__()
-        self.claudeClient = anthropic.Anthropic(
-            api_key=conf().get("claude_api_key")
-        )
+        # 配置claude_api_keys可使用多个key轮询，每个key一个client
+        self.key_pool = get_key_pool("claude", conf().get("claude_api_key"))
+        self.clients = {}
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("open_ai_api_base"):
             openai.api_base = conf().get("open_ai_api_base")
@@ -33,7 +33,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
         if proxy:
             openai.proxy = proxy
 
-        self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "text-davinci-003")
+        self.sessions = SessionManager(ChatGPTSession, namespace=type(self).__name__, model=conf().get("model") or "text-davinci-003")
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -50,22 +50,11 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
-                    logger.info(result)
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"],
-                        result["completion_tokens"],
-                        result["content"],
-                    )
-                    logger.debug(
-                        "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
-                    )
-
-                    if total_tokens == 0:
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else:
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
+                    try:
+                        result = self.reply_text(session)
+                    except retry.RetryLater as e:
+                        raise e.then(lambda content: self._build_reply(session, content))
+                    reply = self._build_reply(session, result)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -76,10 +65,34 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
+    def _build_reply(self, session: ChatGPTSession, result: dict) -> Reply:
+        logger.info(result)
+        total_tokens, completion_tokens, reply_content = (
+            result["total_tokens"],
+            result["completion_tokens"],
+            result["content"],
+        )
+        logger.debug("[CLAUDE_API] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session, session.session_id, reply_content, completion_tokens)
+
+        if total_tokens == 0:
+            return Reply(ReplyType.ERROR, reply_content)
+        self.sessions.session_reply(reply_content, session.session_id, total_tokens)
+        return Reply(ReplyType.TEXT, reply_content)
+
+    def _get_client(self, api_key):
+        client = self.clients.get(api_key)
+        if client is None:
+            client = self.clients[api_key] = anthropic.Anthropic(api_key=api_key)
+        return client
+
     def reply_text(self, session: ChatGPTSession, retry_count=0):
+        lease = self.key_pool.acquire()
+        if lease is None and self.key_pool.keys:
+            logger.warn("[CLAUDE_API] no available api key in pool")
+            return {"total_tokens": 0, "completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
         try:
             actual_model = self._model_mapping(conf().get("model"))
-            response = self.claudeClient.messages.create(
+            response = self._get_client(lease.key if lease else None).messages.create(
                 model=actual_model,
                 max_tokens=1024,
                 # system=conf().get("system"),
@@ -89,6 +102,9 @@ class ClaudeAPIBot(Bot, OpenAIImage):
             res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
             total_tokens = response.usage.input_tokens+response.usage.output_tokens
             completion_tokens = response.usage.output_tokens
+            if lease:
+                self.key_pool.release(lease, tokens=total_tokens)
+                lease = None
             logger.info("[CLAUDE_API] reply={}".format(res_content))
             return {
                 "total_tokens": total_tokens,
@@ -96,18 +112,18 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
+            if lease:
+                self.key_pool.release(lease, status_code=status_code_of(e))
             need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
+            result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            base_delay = None
+            if isinstance(e, (openai.error.RateLimitError, anthropic.RateLimitError)):
                 logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                base_delay = 10
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[CLAUDE_API] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
                 need_retry = False
@@ -118,8 +134,9 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 self.sessions.clear_session(session.session_id)
 
             if need_retry:
-                logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                delay = retry.backoff(retry_count, base_delay, retry_after=retry.get_retry_after(e))
+                logger.warn("[CLAUDE_API] 第{}次重试, {:.1f}秒后执行".format(retry_count + 1, delay))
+                return retry.retry(delay, lambda: self.reply_text(session, retry_count + 1), result)
             else:
                 return result
 
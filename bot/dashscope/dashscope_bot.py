@@ -4,8 +4,9 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
-from config import conf, load_config
+from config import conf, reload_config
 from .dashscope_session import DashscopeSession
 import os
 import dashscope
@@ -23,7 +24,7 @@ dashscope_models = {
 class DashscopeBot(Bot):
     def __init__(self):
         super().__init__()
-        self.sessions = SessionManager(DashscopeSession, model=conf().get("model") or "qwen-plus")
+        self.sessions = SessionManager(DashscopeSession, namespace=type(self).__name__, model=conf().get("model") or "qwen-plus")
         self.model_name = conf().get("model") or "qwen-plus"
         self.api_key = conf().get("dashscope_api_key")
         os.environ["DASHSCOPE_API_KEY"] = self.api_key
@@ -44,35 +45,34 @@ class DashscopeBot(Bot):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[DASHSCOPE] session query={}".format(session.messages))
+            logger.debug("[DASHSCOPE] session query=%s", session.messages)
 
-            reply_content = self.reply_text(session)
-            logger.debug(
-                "[DASHSCOPE] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[DASHSCOPE] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            try:
+                reply_content = self.reply_text(session)
+            except retry.RetryLater as e:
+                raise e.then(lambda content: self._build_reply(session, content))
+            return self._build_reply(session, reply_content)
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    def _build_reply(self, session, reply_content: dict) -> Reply:
+        logger.debug("[DASHSCOPE] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session.session_id, reply_content["content"], reply_content["completion_tokens"])
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[DASHSCOPE] reply %s used 0 tokens.", reply_content)
+        return reply
+
     def reply_text(self, session: DashscopeSession, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -100,11 +100,13 @@ class DashscopeBot(Bot):
                     response.request_id, response.status_code,
                     response.code, response.message
                 ))
-                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
                 need_retry = retry_count < 2
                 result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
                 if need_retry:
-                    return self.reply_text(session, retry_count + 1)
+                    base_delay = 10 if response.status_code == HTTPStatus.TOO_MANY_REQUESTS else None
+                    delay = retry.backoff(retry_count, base_delay)
+                    logger.warn("[DASHSCOPE] 第{}次重试, {:.1f}秒后执行".format(retry_count + 1, delay))
+                    return retry.retry(delay, lambda: self.reply_text(session, retry_count + 1), result)
                 else:
                     return result
         except Exception as e:
@@ -112,6 +114,8 @@ class DashscopeBot(Bot):
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if need_retry:
-                return self.reply_text(session, retry_count + 1)
+                delay = retry.backoff(retry_count)
+                logger.warn("[DASHSCOPE] 第{}次重试, {:.1f}秒后执行".format(retry_count + 1, delay))
+                return retry.retry(delay, lambda: self.reply_text(session, retry_count + 1), result)
             else:
                 return result
@@ -23,7 +23,7 @@ class GoogleGeminiBot(Bot):
         super().__init__()
         self.api_key = conf().get("gemini_api_key")
         # 复用文心的token计算方式
-        self.sessions = SessionManager(BaiduWenxinSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = SessionManager(BaiduWenxinSession, namespace=type(self).__name__, model=conf().get("model") or "gpt-3.5-turbo")
 
     def reply(self, query, context: Context = None) -> Reply:
         try:
@@ -3,19 +3,22 @@
 
 import re
 import time
-import requests
 import config
+from bot.api_key_pool import get_key_pool
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
+from bot.session_summarizer import summarizer
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client, media_downloader, retry
 from common.log import logger
 from config import conf, pconf
 import threading
 from common import memory, utils
 import base64
 import os
+import shutil
 
 class LinkAIBot(Bot):
     # authentication failed
@@ -24,8 +27,10 @@ class LinkAIBot(Bot):
 
     def __init__(self):
         super().__init__()
-        self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions = LinkAISessionManager(LinkAISession, namespace=type(self).__name__, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
+        # 配置linkai_api_keys可使用多个key轮询
+        self.key_pool = get_key_pool("linkai", conf().get("linkai_api_key"))
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
@@ -65,11 +70,10 @@ class LinkAIBot(Bot):
             else:
                 plugin_app_code = self._find_group_mapping_code(context)
                 app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
 
             session_id = context["session_id"]
             session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+            logger.debug("[LinkAI] session=%s, session_id=%s", session_message, session_id)
 
             # image process
             img_cache = memory.USER_IMAGE_CACHE.get(session_id)
@@ -119,17 +123,16 @@ class LinkAIBot(Bot):
             if file_id:
                 body["file_id"] = file_id
             logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
-
             # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res, lease = self._post_chat(body)
+            if res is None:
+                return Reply(ReplyType.TEXT, "提问太快啦，请休息一下再问我吧")
             if res.status_code == 200:
                 # execute success
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
                 total_tokens = response["usage"]["total_tokens"]
+                self.key_pool.add_usage(lease, total_tokens)
                 res_code = response.get('code')
                 logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
                 if res_code == 429:
@@ -160,9 +163,9 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    delay = retry.backoff(retry_count, 2, retry_after=retry.parse_retry_after(res.headers.get("Retry-After")))
+                    logger.warn(f"[LINKAI] do retry, times={retry_count}, delay={delay:.1f}s")
+                    return retry.retry(delay, lambda: self._chat(query, context, retry_count + 1), Reply(ReplyType.TEXT, "请再问我一次吧"))
 
                 error_reply = "提问太快啦，请休息一下再问我吧"
                 if res.status_code == 409:
@@ -172,16 +175,16 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            delay = retry.backoff(retry_count, 2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}, delay={delay:.1f}s")
+            return retry.retry(delay, lambda: self._chat(query, context, retry_count + 1), Reply(ReplyType.TEXT, "请再问我一次吧"))
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
             enable_image_input = False
             app_info = self._fetch_app_info(app_code)
             if not app_info:
-                logger.debug(f"[LinkAI] not found app, can't process images, app_code={app_code}")
+                logger.debug("[LinkAI] not found app, can't process images, app_code=%s", app_code)
                 return None
             plugins = app_info.get("data").get("plugins")
             for plugin in plugins:
@@ -258,17 +261,16 @@ class LinkAIBot(Bot):
             }
             if self.args.get("max_tokens"):
                 body["max_tokens"] = self.args.get("max_tokens")
-            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
-
             # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res, lease = self._post_chat(body)
+            if res is None:
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
             if res.status_code == 200:
                 # execute success
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
                 total_tokens = response["usage"]["total_tokens"]
+                self.key_pool.add_usage(lease, total_tokens)
                 logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
                 return {
                     "total_tokens": total_tokens,
@@ -284,9 +286,9 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    delay = retry.backoff(retry_count, 2, retry_after=retry.parse_retry_after(res.headers.get("Retry-After")))
+                    logger.warn(f"[LINKAI] do retry, times={retry_count}, delay={delay:.1f}s")
+                    return retry.retry(delay, lambda: self.reply_text(session, app_code, retry_count + 1), {"total_tokens": 0, "completion_tokens": 0, "content": "请再问我一次吧"})
 
                 return {
                     "total_tokens": 0,
@@ -297,16 +299,33 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            delay = retry.backoff(retry_count, 2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}, delay={delay:.1f}s")
+            return retry.retry(delay, lambda: self.reply_text(session, app_code, retry_count + 1), {"total_tokens": 0, "completion_tokens": 0, "content": "请再问我一次吧"})
+
+    def _post_chat(self, body):
+        """从key池中选择api_key发起对话请求，返回(response, key)，没有可用的key时返回(None, None)"""
+        lease = self.key_pool.acquire()
+        if lease is None:
+            logger.warn("[LINKAI] no available api key in pool")
+            return None, None
+        headers = {"Authorization": "Bearer " + lease.key}
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        try:
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                   timeout=conf().get("request_timeout", 180))
+        except Exception:
+            self.key_pool.release(lease)
+            raise
+        self.key_pool.release(lease, status_code=None if res.status_code == 200 else res.status_code)
+        return res, lease
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +346,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -359,7 +378,7 @@ class LinkAIBot(Bot):
     def _fetch_agent_suffix(self, response):
         try:
             plugin_list = []
-            logger.debug(f"[LinkAgent] res={response}")
+            logger.debug("[LinkAgent] res=%s", response)
             if response.get("agent") and response.get("agent").get("chain") and response.get("agent").get("need_show_plugin"):
                 chain = response.get("agent").get("chain")
                 suffix = "\n\n- - - - - - - - - - - -"
@@ -400,6 +419,8 @@ class LinkAIBot(Bot):
         max_send_num = conf().get("max_media_send_count")
         send_interval = conf().get("media_send_interval")
         try:
+            # 图片和视频并行预先下载，之后按顺序发送时直接使用缓存
+            media_downloader.prefetch(image_urls[:max_send_num] if max_send_num else image_urls)
             i = 0
             for url in image_urls:
                 if max_send_num and i >= max_send_num:
@@ -429,9 +450,8 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
-        with open(file_path, "wb") as f:
-            f.write(response.content)
+        # 缓存文件按内容命名，复制一份以保留原文件名
+        shutil.copyfile(media_downloader.download(url), file_path)
         return file_path
     except Exception as e:
         logger.warn(e)
@@ -445,15 +465,18 @@ class LinkAISessionManager(SessionManager):
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
         session = self.build_session(session_id)
+        summarizer.apply(session)
         if query:
             session.add_query(query)
         session.add_reply(reply)
         try:
             max_tokens = conf().get("conversation_max_tokens", 2500)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            logger.debug("[LinkAI] chat history, before tokens=%s, now tokens=%s", total_tokens, tokens_cnt)
+            summarizer.maybe_schedule(session, tokens_cnt)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.mark_session(session)
         return session
 
 
@@ -466,9 +489,9 @@ class LinkAISession(ChatGPTSession):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         cur_tokens = self.calc_tokens()
         if cur_tokens > max_tokens:
-            for i in range(0, len(self.messages)):
-                if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
+            for i in range(0, len(self.history)):
+                if i > 0 and self.history[i].get("role") == "assistant" and self.history[i - 1].get("role") == "user":
+                    self.pop_message(i)
+                    self.pop_message(i - 1)
                     return self.calc_tokens()
         return cur_tokens
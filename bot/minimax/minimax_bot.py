@@ -9,10 +9,10 @@ from bot.minimax.minimax_session import MinimaxSession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
-from config import conf, load_config
+from config import conf, reload_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
 from common import const
 
 
@@ -41,7 +41,7 @@ class MinimaxBot(Bot):
                 }
             ],
         }
-        self.sessions = SessionManager(MinimaxSession, model=const.MiniMax)
+        self.sessions = SessionManager(MinimaxSession, namespace=type(self).__name__, model=const.MiniMax)
 
     def reply(self, query, context: Context = None) -> Reply:
         # acquire reply content
@@ -57,12 +57,12 @@ class MinimaxBot(Bot):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[Minimax_AI] session query={}".format(session))
+            logger.debug("[Minimax_AI] session query=%s", session)
 
             model = context.get("Minimax_model")
             new_args = self.args.copy()
@@ -73,14 +73,7 @@ class MinimaxBot(Bot):
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
+            logger.debug("[Minimax_AI] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session_id, reply_content["content"], reply_content["completion_tokens"])
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
@@ -88,7 +81,7 @@ class MinimaxBot(Bot):
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[Minimax_AI] reply {} used 0 tokens.".format(reply_content))
+                logger.debug("[Minimax_AI] reply %s used 0 tokens.", reply_content)
             return reply
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
@@ -107,7 +100,7 @@ class MinimaxBot(Bot):
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post(self.base_url, headers=headers, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
@@ -20,11 +20,11 @@ class MinimaxSession(Session):
 
     def add_query(self, query):
         user_item = {"sender_type": "USER", "sender_name": self.session_id, "text": query}
-        self.messages.append(user_item)
+        self.history.append(user_item)
 
     def add_reply(self, reply):
         assistant_item = {"sender_type": "BOT", "sender_name": "MM智能助理", "text": reply}
-        self.messages.append(assistant_item)
+        self.history.append(assistant_item)
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
@@ -34,22 +34,22 @@ class MinimaxSession(Session):
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
         while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["sender_type"] == "BOT":
-                self.messages.pop(1)
+            if len(self.history) > 2:
+                self.pop_turn()
+            elif len(self.history) == 2 and self.history[1]["sender_type"] == "BOT":
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
-            elif len(self.messages) == 2 and self.messages[1]["sender_type"] == "USER":
+            elif len(self.history) == 2 and self.history[1]["sender_type"] == "USER":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(messages)=%s", max_tokens, cur_tokens, len(self.history))
                 break
             if precise:
                 cur_tokens = self.calc_tokens()
@@ -58,7 +58,7 @@ class MinimaxSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        return num_tokens_from_messages(self.history, self.model)
 
 
 def num_tokens_from_messages(messages, model):
@@ -4,27 +4,29 @@ import time
 
 import openai
 import openai.error
+from bot.api_key_pool import get_key_pool
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import http_client
 from common.log import logger
-from config import conf, load_config
+from config import conf, reload_config
 from .moonshot_session import MoonshotSession
-import requests
 
 
 # ZhipuAI对话模型API
 class MoonshotBot(Bot):
     def __init__(self):
         super().__init__()
-        self.sessions = SessionManager(MoonshotSession, model=conf().get("model") or "moonshot-v1-128k")
+        self.sessions = SessionManager(MoonshotSession, namespace=type(self).__name__, model=conf().get("model") or "moonshot-v1-128k")
         self.args = {
             "model": conf().get("model") or "moonshot-v1-128k",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.3),  # 如果设置，值域须为 [0, 1] 我们推荐 0.3，以达到较合适的效果。
             "top_p": conf().get("top_p", 1.0),  # 使用默认值
         }
-        self.api_key = conf().get("moonshot_api_key")
+        # 配置moonshot_api_keys可使用多个key轮询
+        self.key_pool = get_key_pool("moonshot", conf().get("moonshot_api_key"))
         self.base_url = conf().get("moonshot_base_url", "https://api.moonshot.cn/v1/chat/completions")
 
     def reply(self, query, context=None):
@@ -42,12 +44,12 @@ class MoonshotBot(Bot):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
+            logger.debug("[MOONSHOT_AI] session query=%s", session.messages)
 
             model = context.get("moonshot_model")
             new_args = self.args.copy()
@@ -58,14 +60,7 @@ class MoonshotBot(Bot):
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
+            logger.debug("[MOONSHOT_AI] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session_id, reply_content["content"], reply_content["completion_tokens"])
             if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
             elif reply_content["completion_tokens"] > 0:
@@ -73,7 +68,7 @@ class MoonshotBot(Bot):
                 reply = Reply(ReplyType.TEXT, reply_content["content"])
             else:
                 reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
+                logger.debug("[MOONSHOT_AI] reply %s used 0 tokens.", reply_content)
             return reply
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
@@ -87,22 +82,31 @@ class MoonshotBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        lease = self.key_pool.acquire()
+        if lease is None:
+            logger.warn("[MOONSHOT_AI] no available api key in pool")
+            return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
         try:
             headers = {
                 "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
+                "Authorization": "Bearer " + lease.key
             }
             body = args
             body["messages"] = session.messages
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
+            res = None
+            try:
+                res = http_client.post(
+                    self.base_url,
+                    headers=headers,
+                    json=body
+                )
+            finally:
+                self.key_pool.release(lease, status_code=None if res is None or res.status_code == 200 else res.status_code)
             if res.status_code == 200:
                 response = res.json()
+                self.key_pool.add_usage(lease, response["usage"]["total_tokens"])
                 return {
                     "total_tokens": response["usage"]["total_tokens"],
                     "completion_tokens": response["usage"]["completion_tokens"],
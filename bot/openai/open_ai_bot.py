@@ -28,7 +28,7 @@ class OpenAIBot(Bot, OpenAIImage):
         if proxy:
             openai.proxy = proxy
 
-        self.sessions = SessionManager(OpenAISession, model=conf().get("model") or "text-davinci-003")
+        self.sessions = SessionManager(OpenAISession, namespace=type(self).__name__, model=conf().get("model") or "text-davinci-003")
         self.args = {
             "model": conf().get("model") or "text-davinci-003",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
@@ -62,9 +62,7 @@ class OpenAIBot(Bot, OpenAIImage):
                         result["completion_tokens"],
                         result["content"],
                     )
-                    logger.debug(
-                        "[OPEN_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
-                    )
+                    logger.debug("[OPEN_AI] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session, session_id, reply_content, completion_tokens)
 
                     if total_tokens == 0:
                         reply = Reply(ReplyType.ERROR, reply_content)
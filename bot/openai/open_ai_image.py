@@ -4,7 +4,7 @@ import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.token_bucket import RateLimiter
 from config import conf
 
 
@@ -12,12 +12,15 @@ from config import conf
 class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
-        if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+        self.init_rate_limiters()
+
+    def init_rate_limiters(self):
+        """按当前配置创建限流器，配置热更新时重新调用"""
+        self.dalle_limiter = RateLimiter(conf().get("rate_limit_dalle", 50)) if conf().get("rate_limit_dalle") else None
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+            if self.dalle_limiter and not self.dalle_limiter.acquire(api_key, timeout=conf().get("rate_limit_wait", 0)):
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
             response = openai.Image.create(
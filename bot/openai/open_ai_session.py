@@ -16,7 +16,7 @@ class OpenAISession(Session):
               Q: xxx
         """
         prompt = ""
-        for item in self.messages:
+        for item in self.history:
             if item["role"] == "system":
                 prompt += item["content"] + "<|endoftext|>\n\n\n"
             elif item["role"] == "user":
@@ -24,7 +24,7 @@ class OpenAISession(Session):
             elif item["role"] == "assistant":
                 prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
 
-        if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
+        if len(self.history) > 0 and self.history[-1]["role"] == "user":
             prompt += "A: "
         return prompt
 
@@ -36,22 +36,22 @@ class OpenAISession(Session):
             precise = False
             if cur_tokens is None:
                 raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+            logger.debug("Exception when counting tokens precisely for query: %s", e)
         while cur_tokens > max_tokens:
-            if len(self.messages) > 1:
-                self.messages.pop(0)
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
-                self.messages.pop(0)
+            if len(self.history) > 1:
+                self.pop_turn()
+            elif len(self.history) == 1 and self.history[0]["role"] == "assistant":
+                self.pop_message(0)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
                     cur_tokens = len(str(self))
                 break
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "user":
+            elif len(self.history) == 1 and self.history[0]["role"] == "user":
                 logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
-                logger.debug("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                logger.debug("max_tokens=%s, total_tokens=%s, len(conversation)=%s", max_tokens, cur_tokens, len(self.history))
                 break
             if precise:
                 cur_tokens = self.calc_tokens()
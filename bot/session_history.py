@@ -0,0 +1,188 @@
+"""
+会话消息列表：就是普通的list，提交给模型接口和插件直接读写的都是它本身，额外记录修改版本号。
+裁剪历史时按轮移除：一轮问答只做一次切片删除，且不会在开头留下没有提问的回复。
+
+性能对比：python -m bot.session_history [--turns 1000] [--keep 20]
+"""
+
+
+def _is_reply(item):
+    # minimax的消息使用sender_type区分角色
+    return item.get("role") == "assistant" or item.get("sender_type") == "BOT"
+
+
+class SessionHistory(list):
+    """
+    有system消息时下标0为system消息。所有修改list的方法都会增加version，
+    插件直接append等修改同样能被持久化等功能感知
+    """
+
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        self.version = 0  # 每次修改加一，用于判断是否需要重新持久化
+        self.generation = 0  # 每次重置或整体替换加一
+
+    @property
+    def offset(self):
+        """第一条问答消息的下标"""
+        return 1 if len(self) > 0 and self[0].get("role") == "system" else 0
+
+    def load(self, messages):
+        super().__setitem__(slice(None), list(messages))
+        self.version += 1
+        self.generation += 1
+
+    def reset(self, system_item=None):
+        super().__setitem__(slice(None), [system_item] if system_item is not None else [])
+        self.version += 1
+        self.generation += 1
+
+    def prepend(self, items):
+        """在system消息之后、最早的消息之前插入items"""
+        offset = self.offset
+        super().__setitem__(slice(offset, offset), items)
+        self.version += 1
+
+    def pop_turn(self):
+        """移除最早的一轮问答（一条提问及其后的回复），system消息保留，返回被移除的消息列表"""
+        offset = self.offset
+        end = offset + 1
+        if end > len(self):
+            return []
+        if not _is_reply(self[offset]):
+            while end < len(self) and _is_reply(self[end]):
+                end += 1
+        removed = self[offset:end]
+        super().__delitem__(slice(offset, end))
+        self.version += 1
+        return removed
+
+    def append(self, item):
+        super().append(item)
+        self.version += 1
+
+    def extend(self, items):
+        super().extend(items)
+        self.version += 1
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.version += 1
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.version += 1
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self.version += 1
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.version += 1
+
+    def reverse(self):
+        super().reverse()
+        self.version += 1
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self.version += 1
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self.version += 1
+
+    def __iadd__(self, items):
+        super().extend(items)
+        self.version += 1
+        return self
+
+
+
+def _build_messages(turns):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": "question {}".format(i)})
+        messages.append({"role": "assistant", "content": "answer {}".format(i)})
+    return messages
+
+
+if __name__ == "__main__":
+    import argparse
+    import timeit
+
+    parser = argparse.ArgumentParser(description="对比逐条pop(1)与按轮切片删除裁剪长会话的耗时")
+    parser.add_argument("--turns", type=int, default=1000, help="会话的问答轮数")
+    parser.add_argument("--keep", type=int, default=20, help="裁剪后保留的问答轮数")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    messages = _build_messages(args.turns)
+    keep = args.keep * 2 + 1
+
+    def trim_list_pop():
+        items = list(messages)
+        while len(items) > keep:
+            items.pop(1)
+        return items
+
+    def trim_list_slice():
+        items = list(messages)
+        while len(items) > keep:
+            del items[1:3]
+        return items
+
+    def trim_history_pop():
+        history = SessionHistory(messages)
+        while len(history) > keep:
+            history.pop(1)
+        return history
+
+    def trim_history_turn():
+        history = SessionHistory(messages)
+        while len(history) > keep:
+            history.pop_turn()
+        return history
+
+    def rolling(factory, trim):
+        # 逐轮对话，每轮追加问答后裁剪回原长度，模拟长期会话的稳定状态
+        def run():
+            items = factory(messages)
+            for i in range(args.turns):
+                items.append({"role": "user", "content": "q"})
+                items.append({"role": "assistant", "content": "a"})
+                while len(items) > len(messages):
+                    trim(items)
+            return items
+
+        return run
+
+    def pop_one(items):
+        items.pop(1)
+
+    def del_turn(items):
+        del items[1:3]
+
+    cases = [
+        ("trim list.pop(1)", trim_list_pop),
+        ("trim list del [1:3]", trim_list_slice),
+        ("trim SessionHistory.pop(1)", trim_history_pop),
+        ("trim SessionHistory.pop_turn", trim_history_turn),
+        ("rolling list.pop(1)", rolling(list, pop_one)),
+        ("rolling list del [1:3]", rolling(list, del_turn)),
+        ("rolling SessionHistory.pop(1)", rolling(SessionHistory, pop_one)),
+        ("rolling SessionHistory.pop_turn", rolling(SessionHistory, SessionHistory.pop_turn)),
+    ]
+    expected = [func() for _, func in cases]
+    assert all(result == expected[0] for result in expected[:4])
+    assert all(result == expected[4] for result in expected[4:])
+    print("turns={}, messages={}, keep={} turns".format(args.turns, len(messages), args.keep))
+    for name, func in cases:
+        cost = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("  {:<34} {:8.3f}ms".format(name, cost * 1000))
@@ -1,3 +1,6 @@
+from bot.session_history import SessionHistory
+from bot.session_store import get_session_writer
+from bot.session_summarizer import summarizer
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
@@ -6,16 +9,34 @@ from config import conf
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
-        self.messages = []
+        self.history = SessionHistory()
+        self.token_ledger = None  # 设置后按消息缓存token数，见bot/token_counter.py
+        self.pending_summary = None  # 后台生成的历史摘要，见bot/session_summarizer.py
+        self.transient = False  # 临时副本，不持久化也不生成摘要，见SessionManager.fork_session
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
             self.system_prompt = system_prompt
 
+    @property
+    def messages(self):
+        return self.history
+
+    @messages.setter
+    def messages(self, messages):
+        self.history.load(messages)
+        if self.token_ledger is not None:
+            self.token_ledger.reset(self.history)
+
     # 重置会话
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
-        self.messages = [system_item]
+        self.history.reset(system_item)
+        if self.token_ledger is not None:
+            self.token_ledger.reset(self.history)
+
+    def set_model(self, model):
+        self.model = model
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -23,11 +44,42 @@ class Session(object):
 
     def add_query(self, query):
         user_item = {"role": "user", "content": query}
-        self.messages.append(user_item)
+        self.history.append(user_item)
+        if self.token_ledger is not None:
+            self.token_ledger.append()
 
     def add_reply(self, reply):
         assistant_item = {"role": "assistant", "content": reply}
-        self.messages.append(assistant_item)
+        self.history.append(assistant_item)
+        if self.token_ledger is not None:
+            self.token_ledger.append()
+
+    def pop_message(self, index):
+        if self.token_ledger is not None:
+            self.token_ledger.sync(self.history)
+            self.token_ledger.pop(index)
+        return self.history.pop(index)
+
+    def pop_turn(self):
+        """移除最早的一轮问答，system消息保留，返回被移除的消息列表"""
+        if self.token_ledger is not None:
+            self.token_ledger.sync(self.history)
+        removed = self.history.pop_turn()
+        if self.token_ledger is not None and removed:
+            self.token_ledger.pop_many(self.history.offset, len(removed))
+        return removed
+
+    def compact(self, summarized, replacement):
+        """
+        用replacement替换最早的消息中属于summarized的部分，summarized中已被裁剪的消息不影响替换
+        """
+        ids = set(id(message) for message in summarized)
+        history = self.history
+        while len(history) > history.offset and id(history[history.offset]) in ids:
+            history.pop(history.offset)
+        history.prepend(replacement)
+        if self.token_ledger is not None:
+            self.token_ledger.reset(history)
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
@@ -37,14 +89,20 @@ class Session(object):
 
 
 class SessionManager(object):
-    def __init__(self, sessioncls, **session_args):
+    def __init__(self, sessioncls, namespace=None, **session_args):
+        """
+        :param namespace: 会话在存储中的命名空间，使用同一会话类的不同bot需要传入各自的值(如bot类名)，避免互相覆盖
+        """
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), max_size=conf().get("max_session_count"), on_evict=self.on_session_evicted)
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        # 开启session_store时，会话首次访问从存储中加载，修改由后台线程批量写回
+        self.writer = get_session_writer()
+        self.namespace = namespace or sessioncls.__name__
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -55,21 +113,68 @@ class SessionManager(object):
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self._load_session(session_id) if system_prompt is None else None
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            self.sessions[session_id] = session
+            self.mark_session(session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+            self.mark_session(self.sessions[session_id])
+        return self.sessions[session_id]
+
+    def mark_session(self, session):
+        """
+        会话被修改后调用，由后台线程写回存储。必须在修改完成之后调用，否则写入的可能是修改前的内容
+        """
+        if self.writer and session.session_id is not None and not session.transient:
+            self.writer.mark(self.namespace, session)
+
+    def fork_session(self, session_id, fork_id):
+        """
+        复制会话到fork_id，用于结果不一定被采用的调用(如对冲请求)，副本不持久化
+        调用结束后使用drop_fork删除副本，采用的问答另行写入原会话
+        """
+        session = self.build_session(session_id)
+        fork = self.sessioncls(fork_id, session.system_prompt, **self.session_args)
+        fork.messages = list(session.messages)
+        fork.transient = True
+        self.sessions[fork_id] = fork
+        return fork
+
+    def drop_fork(self, fork_id):
+        self.sessions.pop(fork_id, None)
+
+    def _load_session(self, session_id):
+        if not self.writer:
+            return None
+        session = self.writer.get_pending(self.namespace, session_id)
+        if session is not None:
+            return session
+        try:
+            data = self.writer.store.get(self.namespace, session_id)
+        except Exception as e:
+            logger.warning("[SessionManager] load session failed, session_id={}, err={}".format(session_id, e))
+            return None
+        if not data:
+            return None
+        session = self.sessioncls(session_id, data.get("system_prompt"), **self.session_args)
+        session.messages = data.get("messages", [])
+        session.stored_version = session.history.version
+        logger.debug("[SessionManager] session loaded from store, session_id=%s, messages=%s", session_id, len(data.get("messages", [])))
         return session
 
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
+        summarizer.apply(session)
         session.add_query(query)
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
+            logger.debug("prompt tokens used=%s", total_tokens)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.mark_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -78,14 +183,26 @@ class SessionManager(object):
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            logger.debug("raw total_tokens=%s, savesession tokens=%s", total_tokens, tokens_cnt)
+            summarizer.maybe_schedule(session, tokens_cnt)
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.mark_session(session)
         return session
 
+    def on_session_evicted(self, session_id, session):
+        """会话因过期或超出数量上限被移除时调用，子类可覆盖以持久化会话"""
+        logger.debug("[SessionManager] session evicted, session_id=%s", session_id)
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.writer:
+            self.writer.discard(self.namespace, session_id)
+            self.writer.store.delete(self.namespace, session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.writer:
+            self.writer.discard(self.namespace)
+            self.writer.store.clear(self.namespace)
@@ -0,0 +1,262 @@
+"""
+会话持久化：进程重启后从存储中恢复会话上下文，避免用户重新发送长提示。
+会话在首次访问时从存储中加载；被访问过的会话由后台线程定期检查，有修改的批量写入（write-behind），
+不在回复路径上同步写盘。存储中超过expires_in_seconds未更新的会话会被定期清理。
+
+存储类型通过session_store配置：memory（仅进程内，重建bot时保留会话）、sqlite、shelve（本地磁盘kv），为空时不持久化。
+"""
+
+import atexit
+import json
+import os
+import shelve
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class MemorySessionStore(object):
+    def __init__(self):
+        self.data = {}  # (namespace, session_id) -> (data, updated_at)
+        self.lock = threading.Lock()
+
+    def get(self, namespace, session_id):
+        with self.lock:
+            item = self.data.get((namespace, session_id))
+        return item[0] if item else None
+
+    def put_many(self, namespace, items):
+        now = time.time()
+        with self.lock:
+            for session_id, data in items:
+                self.data[(namespace, session_id)] = (data, now)
+
+    def delete(self, namespace, session_id):
+        with self.lock:
+            self.data.pop((namespace, session_id), None)
+
+    def clear(self, namespace):
+        with self.lock:
+            for key in [key for key in self.data if key[0] == namespace]:
+                del self.data[key]
+
+    def purge(self, before):
+        """删除before(时间戳)之前更新的会话，返回删除的数量"""
+        with self.lock:
+            keys = [key for key, (_, updated_at) in self.data.items() if updated_at < before]
+            for key in keys:
+                del self.data[key]
+        return len(keys)
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (namespace TEXT, session_id TEXT, data TEXT, updated_at REAL, "
+                "PRIMARY KEY (namespace, session_id))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)")
+
+    def get(self, namespace, session_id):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM sessions WHERE namespace = ? AND session_id = ?", (namespace, session_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, namespace, items):
+        now = time.time()
+        rows = [(namespace, session_id, json.dumps(data, ensure_ascii=False), now) for session_id, data in items]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO sessions (namespace, session_id, data, updated_at) VALUES (?, ?, ?, ?)", rows)
+
+    def delete(self, namespace, session_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", (namespace, session_id))
+
+    def clear(self, namespace):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sessions WHERE namespace = ?", (namespace,))
+
+    def purge(self, before):
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (before,)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ShelveSessionStore(object):
+    def __init__(self, path):
+        self.db = shelve.open(path)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(namespace, session_id):
+        return "{}\x00{}".format(namespace, session_id)
+
+    def get(self, namespace, session_id):
+        with self.lock:
+            item = self.db.get(self._key(namespace, session_id))
+        return item[0] if item else None
+
+    def put_many(self, namespace, items):
+        now = time.time()
+        with self.lock:
+            for session_id, data in items:
+                self.db[self._key(namespace, session_id)] = (data, now)
+            self.db.sync()
+
+    def delete(self, namespace, session_id):
+        with self.lock:
+            self.db.pop(self._key(namespace, session_id), None)
+
+    def clear(self, namespace):
+        prefix = namespace + "\x00"
+        with self.lock:
+            for key in [key for key in self.db.keys() if key.startswith(prefix)]:
+                del self.db[key]
+
+    def purge(self, before):
+        with self.lock:
+            keys = [key for key in self.db.keys() if self.db[key][1] < before]
+            for key in keys:
+                del self.db[key]
+            self.db.sync()
+        return len(keys)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SessionWriter(object):
+    """
+    后台写入线程：记录被访问过的会话，每隔flush_interval秒把版本有变化的会话按命名空间批量写入存储，
+    并定期清理存储中过期的会话
+    """
+
+    purge_interval = 600
+
+    def __init__(self, store, flush_interval=5):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.pending = {}  # (namespace, session_id) -> session
+        self.lock = threading.Lock()
+        self.last_purge = 0
+        self.thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self.thread.start()
+
+    def mark(self, namespace, session):
+        with self.lock:
+            self.pending[(namespace, session.session_id)] = session
+
+    def get_pending(self, namespace, session_id):
+        """已从内存中淘汰但尚未写入存储的会话"""
+        with self.lock:
+            return self.pending.get((namespace, session_id))
+
+    def discard(self, namespace, session_id=None):
+        with self.lock:
+            for key in [key for key in self.pending if key[0] == namespace and (session_id is None or key[1] == session_id)]:
+                del self.pending[key]
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        batches = {}
+        for (namespace, session_id), session in pending.items():
+            version = session.history.version
+            if version == getattr(session, "stored_version", None):
+                continue
+            try:
+                data = {"system_prompt": session.system_prompt, "messages": list(session.history)}
+            except RuntimeError:
+                # 遍历时会话正在被修改，留到下次写入
+                self.mark(namespace, session)
+                continue
+            batches.setdefault(namespace, []).append((session_id, data, session, version))
+        for namespace, batch in batches.items():
+            try:
+                self.store.put_many(namespace, [(session_id, data) for session_id, data, _, _ in batch])
+            except Exception as e:
+                logger.warning("[SessionStore] write {} sessions failed: {}".format(len(batch), e))
+                for _, _, session, _ in batch:
+                    self.mark(namespace, session)
+                continue
+            for _, _, session, version in batch:
+                session.stored_version = version
+                if session.history.version != version:
+                    # 写入期间会话又被修改，留到下次写入
+                    self.mark(namespace, session)
+            logger.debug("[SessionStore] wrote %s sessions of %s", len(batch), namespace)
+
+    def purge(self):
+        expires_in_seconds = conf().get("expires_in_seconds")
+        if not expires_in_seconds:
+            return
+        count = self.store.purge(time.time() - expires_in_seconds)
+        if count:
+            logger.debug("[SessionStore] purged %s expired sessions", count)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - self.last_purge > self.purge_interval:
+                    self.last_purge = time.monotonic()
+                    self.purge()
+            except Exception as e:
+                logger.exception("[SessionStore] background write error: {}".format(e))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _create_store(store_type):
+    path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions")
+    if store_type == "memory":
+        return MemorySessionStore()
+    if store_type == "sqlite":
+        return SqliteSessionStore(path + ".db")
+    if store_type == "shelve":
+        return ShelveSessionStore(path)
+    logger.warning("[SessionStore] unknown session_store: {}".format(store_type))
+    return None
+
+
+def get_session_writer():
+    """按session_store配置返回全局的SessionWriter，未开启持久化时返回None"""
+    global _writer
+    store_type = conf().get("session_store")
+    if not store_type:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                store = _create_store(store_type)
+                if store is None:
+                    return None
+                _writer = SessionWriter(store, conf().get("session_store_flush_interval", 5))
+                atexit.register(_close)
+                logger.info("[SessionStore] session store enabled, type={}".format(store_type))
+    return _writer
+
+
+def _close():
+    # 退出前写入尚未持久化的修改
+    try:
+        _writer.flush()
+        _writer.store.close()
+    except Exception as e:
+        logger.warning("[SessionStore] close error: {}".format(e))
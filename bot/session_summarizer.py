@@ -0,0 +1,121 @@
+"""
+会话历史压缩：会话token数超过conversation_max_tokens * summary_trigger_ratio时，
+由后台线程调用summary_model把较早的对话总结为一轮摘要问答，在该会话下一次提问时替换掉被总结的消息，
+使长期会话的提示词长度大致保持不变，避免直接丢弃早期对话后用户需要重新解释。
+
+摘要在会话自己的处理线程中替换，不与正在进行的请求同时修改会话；被总结的消息若已被discard_exceeding裁剪，摘要仍会保留其内容。
+摘要通过OpenAI兼容接口生成（open_ai_api_base，使用open_ai的key池）。
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.api_key_pool import get_key_pool, status_code_of
+from common.log import logger
+from config import conf
+
+summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+SUMMARY_PROMPT = "请把下面的对话总结为一段简洁的摘要，保留用户的身份、偏好、要求以及已经确定的结论和重要事实，不超过{}字：\n\n{}"
+SUMMARY_QUERY = "以下是我们之前对话的摘要，请在后续回答中参考：\n{}"
+SUMMARY_ACK = "好的，我会参考之前的对话内容。"
+
+
+def _message_text(message):
+    role = message.get("role") or message.get("sender_type", "")
+    content = message.get("content", message.get("text", ""))
+    if not isinstance(content, str):
+        content = str(content)
+    return "{}: {}".format({"user": "用户", "assistant": "助手", "USER": "用户", "BOT": "助手"}.get(role, role), content)
+
+
+class SessionSummarizer(object):
+    def __init__(self):
+        self.running = set()  # 正在总结的session_id
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        return bool(conf().get("summary_enabled"))
+
+    def maybe_schedule(self, session, cur_tokens=None):
+        """会话超过高水位时提交后台总结任务，同一会话同时只有一个任务"""
+        if not self.enabled() or session.session_id is None or session.transient or session.pending_summary is not None:
+            return
+        if cur_tokens is None:
+            try:
+                cur_tokens = session.calc_tokens()
+            except Exception:
+                return
+        max_tokens = conf().get("conversation_max_tokens", 1000)
+        if cur_tokens < max_tokens * conf().get("summary_trigger_ratio", 0.8):
+            return
+        history = session.history
+        # 保留最近summary_keep_turns轮对话，其余（包括之前的摘要）参与总结
+        count = len(history) - history.offset - conf().get("summary_keep_turns", 2) * 2
+        if count < 2:
+            return
+        snapshot = [history[history.offset + i] for i in range(count)]
+        if any("role" not in message for message in snapshot):
+            return  # 摘要以role格式的问答插入，其他格式的会话(如minimax)不支持
+        with self.lock:
+            if session.session_id in self.running:
+                return
+            self.running.add(session.session_id)
+        logger.debug("[Summary] summarize %s messages, session_id=%s, tokens=%s", count, session.session_id, cur_tokens)
+        summary_pool.submit(self._summarize, session, snapshot, history.generation)
+
+    def _summarize(self, session, snapshot, generation):
+        try:
+            text = "\n".join(_message_text(message) for message in snapshot)
+            summary = self.call_model(SUMMARY_PROMPT.format(conf().get("summary_max_length", 300), text))
+            if summary:
+                session.pending_summary = (snapshot, summary.strip(), generation)
+        except Exception as e:
+            logger.warning("[Summary] summarize failed, session_id={}, err={}".format(session.session_id, e))
+        finally:
+            with self.lock:
+                self.running.discard(session.session_id)
+
+    @staticmethod
+    def call_model(prompt):
+        import openai
+
+        pool = get_key_pool("open_ai", conf().get("open_ai_api_key"))
+        lease = pool.acquire()
+        if lease is None and pool.keys:
+            raise Exception("no available api key")
+        try:
+            response = openai.ChatCompletion.create(
+                api_key=lease.key if lease else None,
+                model=conf().get("summary_model") or "gpt-3.5-turbo",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,
+                request_timeout=conf().get("request_timeout", 180),
+            )
+        except Exception as e:
+            if lease:
+                pool.release(lease, status_code=status_code_of(e))
+            raise
+        if lease:
+            pool.release(lease, tokens=response["usage"]["total_tokens"])
+        return response.choices[0]["message"]["content"]
+
+    @staticmethod
+    def apply(session):
+        """在会话的处理线程中调用，把已完成的摘要替换到会话中"""
+        pending = session.pending_summary
+        if pending is None:
+            return
+        session.pending_summary = None
+        snapshot, summary, generation = pending
+        if generation != session.history.generation:
+            return  # 总结期间会话已被重置（如更换了人设），摘要作废
+        session.compact(snapshot, [
+            {"role": "user", "content": SUMMARY_QUERY.format(summary)},
+            {"role": "assistant", "content": SUMMARY_ACK},
+        ])
+        logger.info("[Summary] session compacted, session_id={}, summarized={}".format(session.session_id, len(snapshot)))
+
+
+summarizer = SessionSummarizer()
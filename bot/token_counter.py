@@ -0,0 +1,146 @@
+import threading
+
+from common import const
+from common.log import logger
+
+
+class CharacterTokenCounter(object):
+    """按字符数粗略估算token数，用于没有公开tokenizer的模型"""
+
+    reply_primer = 0
+
+    def count_message(self, message):
+        return len(message["content"])
+
+
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+class TiktokenCounter(object):
+    """使用tiktoken计算token数，编码器在首次计数时解析一次"""
+
+    reply_primer = 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def __init__(self, model):
+        self.model = model
+        self.encoding = None
+        if model == "gpt-3.5-turbo":
+            self.tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+            self.tokens_per_name = -1  # if there's a name, the role is omitted
+        else:
+            self.tokens_per_message = 3
+            self.tokens_per_name = 1
+
+    def _get_encoding(self):
+        if self.encoding is None:
+            import tiktoken
+
+            try:
+                self.encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                logger.debug("Warning: model not found. Using cl100k_base encoding.")
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        return self.encoding
+
+    def count_message(self, message):
+        encoding = self._get_encoding()
+        num_tokens = self.tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += self.tokens_per_name
+        return num_tokens
+
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+def _resolve_model(model):
+    if model in ["wenxin", "xunfei", const.GEMINI]:
+        return None
+    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
+        return "gpt-3.5-turbo"
+    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                   const.GPT_4o, const.LINKAI_4o, const.LINKAI_4_TURBO]:
+        return "gpt-4"
+    elif model.startswith("claude-3"):
+        return "gpt-3.5-turbo"
+    elif model not in ["gpt-3.5-turbo", "gpt-4"]:
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        return "gpt-3.5-turbo"
+    return model
+
+
+def get_token_counter(model):
+    """
+    获取模型对应的token计数器，同一模型的计数器（及其tiktoken编码器）在所有会话间共享
+    :param model: 模型名称，传None使用按字符估算的计数器
+    """
+    counter = _counters.get(model)
+    if counter is None:
+        with _counters_lock:
+            counter = _counters.get(model)
+            if counter is None:
+                resolved = _resolve_model(model) if model is not None else None
+                if resolved is None:
+                    counter = CharacterTokenCounter()
+                else:
+                    counter = _counters.get(resolved) or TiktokenCounter(resolved)
+                    _counters[resolved] = counter
+                _counters[model] = counter
+    return counter
+
+
+class TokenLedger(object):
+    """
+    会话消息的token账本，与Session.history一一对应缓存每条消息的token数并维护总数。
+    新消息在首次需要总数时才计数，裁剪消息时直接减去缓存值，避免反复对整段历史重新编码。
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.counts = []
+        self.total = 0
+        self.uncounted = 0  # 尚未计数的消息数，总是位于counts末尾
+
+    def reset(self, messages):
+        self.counts = [None] * len(messages)
+        self.total = 0
+        self.uncounted = len(messages)
+
+    def sync(self, messages):
+        # messages被外部直接修改导致长度不一致时，整体重新计数
+        if len(self.counts) != len(messages):
+            self.reset(messages)
+
+    def append(self):
+        self.counts.append(None)
+        self.uncounted += 1
+
+    def pop(self, index):
+        count = self.counts.pop(index)
+        if count is None:
+            self.uncounted -= 1
+        else:
+            self.total -= count
+
+    def pop_many(self, index, count):
+        """移除从index开始的count条消息的计数"""
+        removed = self.counts[index:index + count]
+        del self.counts[index:index + count]
+        for count in removed:
+            if count is None:
+                self.uncounted -= 1
+            else:
+                self.total -= count
+
+    def tokens(self, messages):
+        self.sync(messages)
+        while self.uncounted > 0:
+            index = len(self.counts) - self.uncounted
+            count = self.counter.count_message(messages[index])
+            self.counts[index] = count
+            self.total += count
+            self.uncounted -= 1
+        return self.total + self.counter.reply_primer
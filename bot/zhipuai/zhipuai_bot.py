@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,8 +8,9 @@ from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
-from config import conf, load_config
+from config import conf, reload_config
 from zhipuai import ZhipuAI
 
 
@@ -19,7 +18,7 @@ from zhipuai import ZhipuAI
 class ZHIPUAIBot(Bot, ZhipuAIImage):
     def __init__(self):
         super().__init__()
-        self.sessions = SessionManager(ZhipuAISession, model=conf().get("model") or "ZHIPU_AI")
+        self.sessions = SessionManager(ZhipuAISession, namespace=type(self).__name__, model=conf().get("model") or "ZHIPU_AI")
         self.args = {
             "model": conf().get("model") or "glm-4",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在(0,1)之间(智谱AI 的温度不能取 0 或者 1)
@@ -42,12 +41,12 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 self.sessions.clear_all_session()
                 reply = Reply(ReplyType.INFO, "所有人记忆已清除")
             elif query == "#更新配置":
-                load_config()
+                reload_config()
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
-            logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
+            logger.debug("[ZHIPU_AI] session query=%s", session.messages)
 
             api_key = context.get("openai_api_key") or openai.api_key
             model = context.get("gpt_model")
@@ -59,24 +58,11 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            try:
+                reply_content = self.reply_text(session, api_key, args=new_args)
+            except retry.RetryLater as e:
+                raise e.then(lambda content: self._build_reply(session, content))
+            return self._build_reply(session, reply_content)
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
             reply = None
@@ -90,6 +76,18 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    def _build_reply(self, session, reply_content: dict) -> Reply:
+        logger.debug("[ZHIPU_AI] new_query=%s, session_id=%s, reply_cont=%s, completion_tokens=%s", session.messages, session.session_id, reply_content["content"], reply_content["completion_tokens"])
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[ZHIPU_AI] reply %s used 0 tokens.", reply_content)
+        return reply
+
     def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -117,33 +115,29 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
         except Exception as e:
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            base_delay = None
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
+                base_delay = 10
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                base_delay = 5
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
             if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                delay = retry.backoff(retry_count, base_delay, retry_after=retry.get_retry_after(e))
+                logger.warn("[ZHIPU_AI] 第{}次重试, {:.1f}秒后执行".format(retry_count + 1, delay))
+                return retry.retry(delay, lambda: self.reply_text(session, api_key, args, retry_count + 1), result)
             else:
                 return result
@@ -1,66 +1,113 @@
+import time
+
+from bot.api_key_pool import reset_key_pools
 from bot.bot_factory import create_bot
 from bridge.context import Context
-from bridge.reply import Reply
-from common import const
+from bridge.hedged_router import HedgedRouter
+from bridge.reply import Reply, ReplyType
+from bridge.reply_cache import ReplyCache
+from common import const, metrics
+from common.retry import RetryLater
 from common.log import logger
 from common.singleton import singleton
-from config import conf
+from config import conf, subscribe_config
 from translate.factory import create_translator
 from voice.factory import create_voice
 
 
+def resolve_bot_types():
+    """根据配置确定各类bot的类型"""
+    btype = {
+        "chat": const.CHATGPT,
+        "voice_to_text": conf().get("voice_to_text", "openai"),
+        "text_to_voice": conf().get("text_to_voice", "google"),
+        "translate": conf().get("translate", "baidu"),
+    }
+    # 这边取配置的模型
+    bot_type = conf().get("bot_type")
+    if bot_type:
+        btype["chat"] = bot_type
+    else:
+        model_type = conf().get("model") or const.GPT35
+        if model_type in ["text-davinci-003"]:
+            btype["chat"] = const.OPEN_AI
+        if conf().get("use_azure_chatgpt", False):
+            btype["chat"] = const.CHATGPTONAZURE
+        if model_type in ["wenxin", "wenxin-4"]:
+            btype["chat"] = const.BAIDU
+        if model_type in ["xunfei"]:
+            btype["chat"] = const.XUNFEI
+        if model_type in [const.QWEN]:
+            btype["chat"] = const.QWEN
+        if model_type in [const.QWEN_TURBO, const.QWEN_PLUS, const.QWEN_MAX]:
+            btype["chat"] = const.QWEN_DASHSCOPE
+        if model_type in [const.GEMINI]:
+            btype["chat"] = const.GEMINI
+        if model_type in [const.ZHIPU_AI]:
+            btype["chat"] = const.ZHIPU_AI
+        if model_type and model_type.startswith("claude-3"):
+            btype["chat"] = const.CLAUDEAPI
+
+        if model_type in ["claude"]:
+            btype["chat"] = const.CLAUDEAI
+
+        if model_type in ["moonshot-v1-8k", "moonshot-v1-32k", "moonshot-v1-128k"]:
+            btype["chat"] = const.MOONSHOT
+
+        if model_type in ["abab6.5-chat"]:
+            btype["chat"] = const.MiniMax
+
+        if conf().get("use_linkai") and conf().get("linkai_api_key"):
+            btype["chat"] = const.LINKAI
+            if not conf().get("voice_to_text") or conf().get("voice_to_text") in ["openai"]:
+                btype["voice_to_text"] = const.LINKAI
+            if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
+                btype["text_to_voice"] = const.LINKAI
+
+    return btype
+
+
+# 以下配置只在bot创建时读取，变化后需要重建bot
+BOT_INIT_KEYS = {"model", "temperature", "top_p", "frequency_penalty", "presence_penalty", "request_timeout", "proxy",
+                 "expires_in_seconds", "max_session_count", "api_key_max_in_flight", "character_desc"}
+BOT_KEY_PREFIXES = {
+    const.OPEN_AI: ("open_ai_",),
+    const.CHATGPT: ("open_ai_",),
+    const.CHATGPTONAZURE: ("open_ai_", "azure_"),
+    const.LINKAI: ("linkai_",),
+    const.BAIDU: ("baidu_wenxin_",),
+    const.XUNFEI: ("xunfei_",),
+    const.QWEN: ("qwen_",),
+    const.QWEN_DASHSCOPE: ("dashscope_",),
+    const.GEMINI: ("gemini_",),
+    const.ZHIPU_AI: ("zhipu_ai_",),
+    const.CLAUDEAI: ("claude_",),
+    const.CLAUDEAPI: ("claude_",),
+    const.MOONSHOT: ("moonshot_",),
+    const.MiniMax: ("Minimax_",),
+}
+RATE_LIMIT_KEYS = {"rate_limit_chatgpt", "rate_limit_chatgpt_tpm", "rate_limit_session", "rate_limit_dalle"}
+REPLY_CACHE_KEYS = {"reply_cache_ttl", "reply_cache_max_size", "semantic_cache_enabled", "semantic_cache_threshold",
+                    "semantic_cache_max_size", "semantic_cache_dim"}
+
+_subscribed = False
+
+
+def _on_config_change(old_config, new_config, changed_keys):
+    Bridge().on_config_change(changed_keys)
+
+
 @singleton
 class Bridge(object):
     def __init__(self):
-        self.btype = {
-            "chat": const.CHATGPT,
-            "voice_to_text": conf().get("voice_to_text", "openai"),
-            "text_to_voice": conf().get("text_to_voice", "google"),
-            "translate": conf().get("translate", "baidu"),
-        }
-        # 这边取配置的模型
-        bot_type = conf().get("bot_type")
-        if bot_type:
-            self.btype["chat"] = bot_type
-        else:
-            model_type = conf().get("model") or const.GPT35
-            if model_type in ["text-davinci-003"]:
-                self.btype["chat"] = const.OPEN_AI
-            if conf().get("use_azure_chatgpt", False):
-                self.btype["chat"] = const.CHATGPTONAZURE
-            if model_type in ["wenxin", "wenxin-4"]:
-                self.btype["chat"] = const.BAIDU
-            if model_type in ["xunfei"]:
-                self.btype["chat"] = const.XUNFEI
-            if model_type in [const.QWEN]:
-                self.btype["chat"] = const.QWEN
-            if model_type in [const.QWEN_TURBO, const.QWEN_PLUS, const.QWEN_MAX]:
-                self.btype["chat"] = const.QWEN_DASHSCOPE
-            if model_type in [const.GEMINI]:
-                self.btype["chat"] = const.GEMINI
-            if model_type in [const.ZHIPU_AI]:
-                self.btype["chat"] = const.ZHIPU_AI
-            if model_type and model_type.startswith("claude-3"):
-                self.btype["chat"] = const.CLAUDEAPI
-
-            if model_type in ["claude"]:
-                self.btype["chat"] = const.CLAUDEAI
-
-            if model_type in ["moonshot-v1-8k", "moonshot-v1-32k", "moonshot-v1-128k"]:
-                self.btype["chat"] = const.MOONSHOT
-
-            if model_type in ["abab6.5-chat"]:
-                self.btype["chat"] = const.MiniMax
-
-            if conf().get("use_linkai") and conf().get("linkai_api_key"):
-                self.btype["chat"] = const.LINKAI
-                if not conf().get("voice_to_text") or conf().get("voice_to_text") in ["openai"]:
-                    self.btype["voice_to_text"] = const.LINKAI
-                if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
-                    self.btype["text_to_voice"] = const.LINKAI
-
+        global _subscribed
+        self.btype = resolve_bot_types()
         self.bots = {}
         self.chat_bots = {}
+        self.router = None
+        if not _subscribed:
+            _subscribed = True
+            subscribe_config(_on_config_change)
 
     # 模型对应的接口
     def get_bot(self, typename):
@@ -80,22 +127,133 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        bot = self.get_bot("chat")
+        cache = ReplyCache()
+        cache_key = cache.build_key(query, context, bot)
+        if cache_key:
+            reply = cache.get(cache_key, query, context, bot)
+            if reply:
+                logger.info("[Bridge] reply cache hit, query={}".format(query))
+                cache.apply_hit(bot, query, context, reply)
+                return reply
+        router = self.get_router()
+        try:
+            with metrics.timer("bot_reply_seconds", bot=self.btype["chat"]):
+                reply = router.reply(query, context) if router else bot.reply(query, context)
+        except RetryLater as e:
+            if cache_key:
+                raise e.then(lambda r: cache.put(cache_key, r, query, context, bot))
+            raise
+        if cache_key:
+            cache.put(cache_key, reply, query, context, bot)
+        return reply
+
+    def fetch_reply_stream(self, query, context: Context):
+        bot = self.get_bot("chat")
+        bot_type = self.btype["chat"]
+        cache = ReplyCache()
+        cache_key = cache.build_key(query, context, bot)
+        if cache_key:
+            reply = cache.get(cache_key, query, context, bot)
+            if reply:
+                logger.info("[Bridge] reply cache hit, query={}".format(query))
+                cache.apply_hit(bot, query, context, reply)
+                yield reply
+                return
+        router = self.get_router()
+        start = time.monotonic()
+        first = True
+        texts = []
+        # 流式回复边生成边发送，总耗时包含发送时间，因此与bot_reply_seconds分开统计
+        with metrics.timer("bot_stream_seconds", bot=bot_type):
+            for reply in (router.reply_stream(query, context) if router else bot.reply_stream(query, context)):
+                if first:
+                    metrics.observe("bot_first_chunk_seconds", time.monotonic() - start, bot=bot_type)
+                    first = False
+                if texts is not None and reply and reply.type == ReplyType.TEXT:
+                    texts.append(reply.content)
+                else:
+                    texts = None  # 包含错误等非文本回复时不缓存
+                yield reply
+        if cache_key and texts:
+            cache.put(cache_key, Reply(ReplyType.TEXT, "".join(texts)), query, context, bot)
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
-        return self.get_bot("voice_to_text").voiceToText(voiceFile)
+        with metrics.timer("voice_to_text_seconds", engine=self.btype["voice_to_text"]):
+            return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
     def fetch_text_to_voice(self, text) -> Reply:
-        return self.get_bot("text_to_voice").textToVoice(text)
+        with metrics.timer("text_to_voice_seconds", engine=self.btype["text_to_voice"]):
+            return self.get_bot("text_to_voice").textToVoice(text)
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
         return self.get_bot("translate").translate(text, from_lang, to_lang)
 
+    def get_router(self):
+        """配置了备用模型(hedge_backup_bot_type)时返回对冲路由，否则返回None"""
+        backup = conf().get("hedge_backup_bot_type")
+        if not backup or backup == self.btype["chat"]:
+            return None
+        if self.router is None or self.router.backup != backup:
+            primary = self.btype["chat"]
+            self.router = HedgedRouter(lambda bot_type: self.get_bot("chat") if bot_type == primary else self.find_chat_bot(bot_type), primary, backup)
+        return self.router
+
     def find_chat_bot(self, bot_type: str):
         if self.chat_bots.get(bot_type) is None:
             self.chat_bots[bot_type] = create_bot(bot_type)
         return self.chat_bots.get(bot_type)
 
+    def on_config_change(self, changed_keys):
+        """
+        配置热更新：只刷新受变化配置影响的bot，其余bot及其会话保持不变。
+        只有限流配置变化时直接重建限流器；需要重建的对话bot会迁移原有会话
+        """
+        if any(key.endswith(("_api_key", "_api_keys")) or key == "api_key_max_in_flight" for key in changed_keys):
+            reset_key_pools()
+        if changed_keys & REPLY_CACHE_KEYS:
+            ReplyCache().__init__()
+        old_btype, self.btype = self.btype, resolve_bot_types()
+        for typename in list(self.bots.keys()):
+            bot_type = self.btype[typename]
+            if bot_type != old_btype[typename]:
+                logger.info("[Bridge] {} bot changed from {} to {}".format(typename, old_btype[typename], bot_type))
+                del self.bots[typename]
+            elif typename == "chat":
+                self._refresh_chat_bot(self.bots, typename, bot_type, changed_keys)
+            elif any(key.startswith(BOT_KEY_PREFIXES.get(bot_type, (bot_type + "_",))) for key in changed_keys):
+                del self.bots[typename]
+        for bot_type in list(self.chat_bots.keys()):
+            self._refresh_chat_bot(self.chat_bots, bot_type, bot_type, changed_keys)
+        if self.router and self.router.primary != self.btype["chat"]:
+            self.router = None
+
+    @staticmethod
+    def _refresh_chat_bot(bots, name, bot_type, changed_keys):
+        bot = bots[name]
+        prefixes = BOT_KEY_PREFIXES.get(bot_type, ())
+        if changed_keys & BOT_INIT_KEYS or any(key.startswith(prefixes) for key in changed_keys):
+            try:
+                new_bot = create_bot(bot_type)
+            except Exception as e:
+                logger.warning("[Bridge] rebuild bot {} failed, will create on next use: {}".format(bot_type, e))
+                del bots[name]
+                return
+            old_sessions = getattr(bot, "sessions", None)
+            new_sessions = getattr(new_bot, "sessions", None)
+            if old_sessions is not None and new_sessions is not None and old_sessions.sessioncls is new_sessions.sessioncls:
+                # 逐个迁移到新的容器中，使expires_in_seconds、max_session_count的修改生效
+                model = new_sessions.session_args.get("model")
+                for session_id, session in list(old_sessions.sessions.items()):
+                    if model and getattr(session, "model", model) != model:
+                        session.set_model(model)
+                    new_sessions.sessions[session_id] = session
+            bots[name] = new_bot
+            logger.info("[Bridge] bot {} rebuilt".format(bot_type))
+        elif changed_keys & RATE_LIMIT_KEYS and hasattr(bot, "init_rate_limiters"):
+            bot.init_rate_limiters()
+            logger.info("[Bridge] rate limiters of {} refreshed".format(bot_type))
+
     def reset_bot(self):
         """
         重置bot路由
@@ -0,0 +1,247 @@
+"""
+对冲请求：主模型在自适应阈值（近期耗时的分位数）内没有返回时，同时向备用模型发起请求，采用先成功的回复；
+主模型直接报错（如连接失败）时立即切换到备用模型。没被采用的请求无法中断，其结果会被忽略。
+每次请求在会话的临时副本上执行，只把采用的问答写入两个模型的原会话，两边的对话历史保持一致。
+流式回复已发送的片段无法撤回，因此不做对冲，只在主模型输出第一段之前失败时切换到备用模型。
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics, retry
+from common.log import logger
+from config import conf
+
+hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")  # 执行对冲请求的线程池
+SESSION_COMMANDS = ["#清除所有", "#更新配置"]  # 除clear_memory_commands外由bot处理的会话指令
+
+
+def is_session_command(query):
+    return query in conf().get("clear_memory_commands", ["#清除记忆"]) or query in SESSION_COMMANDS
+
+
+class LatencyTracker(object):
+    """每个模型最近window次调用的耗时和成功率"""
+
+    def __init__(self, window=200):
+        self.window = window
+        self.latencies = {}  # bot_type -> deque of seconds，只记录成功的调用
+        self.results = {}  # bot_type -> deque of bool
+        self.lock = threading.Lock()
+
+    def record(self, bot_type, seconds, success):
+        with self.lock:
+            if success:
+                self.latencies.setdefault(bot_type, deque(maxlen=self.window)).append(seconds)
+            self.results.setdefault(bot_type, deque(maxlen=self.window)).append(success)
+
+    def quantile(self, bot_type, q):
+        """返回最近耗时的分位数，样本不足时返回None"""
+        with self.lock:
+            samples = sorted(self.latencies.get(bot_type, ()))
+        if len(samples) < conf().get("hedge_min_samples", 20):
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def stats(self):
+        result = {}
+        with self.lock:
+            bot_types = list(self.results.keys())
+        for bot_type in bot_types:
+            with self.lock:
+                samples = sorted(self.latencies.get(bot_type, ()))
+                results = list(self.results.get(bot_type, ()))
+
+            def pick(q):
+                return round(samples[min(int(q * len(samples)), len(samples) - 1)], 3) if samples else None
+
+            result[bot_type] = {
+                "count": len(results),
+                "error_rate": round(1 - sum(results) / len(results), 3) if results else 0,
+                "p50": pick(0.5),
+                "p90": pick(0.9),
+                "p99": pick(0.99),
+            }
+        return result
+
+
+class HedgedRouter(object):
+    """
+    :param get_bot: 根据bot_type返回bot实例的函数
+    :param primary: 主模型的bot_type
+    :param backup: 备用模型的bot_type
+    """
+
+    def __init__(self, get_bot, primary, backup):
+        self.get_bot = get_bot
+        self.primary = primary
+        self.backup = backup
+        self.tracker = LatencyTracker()
+
+    def hedge_delay(self):
+        """主模型等待多久后发起对冲：近期耗时的分位数，限制在[hedge_min_delay, hedge_max_delay]内"""
+        delay = self.tracker.quantile(self.primary, conf().get("hedge_quantile", 0.9))
+        if delay is None:
+            delay = conf().get("hedge_default_delay", 8)
+        return min(max(delay, conf().get("hedge_min_delay", 2)), conf().get("hedge_max_delay", 30))
+
+    def _call(self, bot, bot_type, query, context, deadline):
+        start = time.monotonic()
+        try:
+            # 在对冲线程中沿用调用方的截止时间，没被采用的请求的重试不会无限等待
+            with retry.with_deadline(deadline):
+                reply = bot.reply(query, context)
+        except Exception as e:
+            logger.warning("[Hedge] {} failed: {}".format(bot_type, e))
+            self.tracker.record(bot_type, time.monotonic() - start, False)
+            raise
+        elapsed = time.monotonic() - start
+        success = reply is not None and reply.type != ReplyType.ERROR
+        self.tracker.record(bot_type, elapsed, success)
+        metrics.observe("bot_provider_seconds", elapsed, bot=bot_type, success=success)
+        return reply
+
+    def _fork(self, bot_type, context: Context):
+        """复制context和会话，返回(bot, context, drop)，drop用于调用结束后删除会话副本"""
+        # 两个模型各用一份context和会话副本，避免互相影响
+        context = Context(context.type, context.content, dict(context.kwargs))
+        bot = self.get_bot(bot_type)
+        sessions = getattr(bot, "sessions", None)
+        session_id = context.get("session_id")
+        if sessions is None or session_id is None:
+            return bot, context, lambda: None
+        fork_id = "{}#hedge-{}".format(session_id, uuid.uuid4().hex)
+        sessions.fork_session(session_id, fork_id)
+        context["session_id"] = fork_id
+        return bot, context, lambda: sessions.drop_fork(fork_id)
+
+    def _submit(self, bot_type, query, context: Context):
+        bot, context, drop = self._fork(bot_type, context)
+        future = hedge_pool.submit(self._call, bot, bot_type, query, context, retry.current_deadline())
+        future.bot_type = bot_type
+        future.add_done_callback(lambda _: drop())
+        return future
+
+    def _commit(self, query, context: Context, reply: Reply):
+        """把采用的问答写入两个模型的原会话"""
+        session_id = context.get("session_id")
+        if session_id is None or reply is None or reply.type != ReplyType.TEXT:
+            return reply
+        for bot_type in (self.primary, self.backup):
+            sessions = getattr(self.get_bot(bot_type), "sessions", None)
+            if sessions is None:
+                continue
+            try:
+                sessions.session_query(query, session_id)
+                sessions.session_reply(reply.content, session_id)
+            except Exception as e:
+                logger.warning("[Hedge] update {} session error: {}".format(bot_type, e))
+        return reply
+
+    @staticmethod
+    def _succeeded(future):
+        if future.exception() is not None:
+            return False
+        reply = future.result()
+        return reply is not None and reply.type != ReplyType.ERROR
+
+    def reply(self, query, context: Context) -> Reply:
+        if context.type != ContextType.TEXT:
+            return self.get_bot(self.primary).reply(query, context)
+        if is_session_command(query):
+            # 清除记忆等会话指令对两个模型都执行，以主模型的回复为准
+            try:
+                self.get_bot(self.backup).reply(query, context)
+            except Exception as e:
+                logger.warning("[Hedge] backup command failed: {}".format(e))
+            return self.get_bot(self.primary).reply(query, context)
+
+        pending = {self._submit(self.primary, query, context)}
+        done, _ = wait(pending, timeout=self.hedge_delay())
+        primary_future = next(iter(pending))
+        if done and self._succeeded(primary_future):
+            return self._commit(query, context, primary_future.result())
+        if done:
+            logger.warning("[Hedge] primary {} failed, fail over to {}".format(self.primary, self.backup))
+            metrics.inc("hedge_requests_total", reason="failover")
+        else:
+            logger.info("[Hedge] primary {} slow, send hedged request to {}".format(self.primary, self.backup))
+            metrics.inc("hedge_requests_total", reason="slow")
+        pending.add(self._submit(self.backup, query, context))
+
+        finished = []
+        not_done = {future for future in pending if not future.done()}
+        finished.extend(future for future in pending if future.done())
+        while True:
+            for future in finished:
+                if self._succeeded(future):
+                    if future.bot_type == self.backup:
+                        metrics.inc("hedge_wins_total", bot=self.backup)
+                    return self._commit(query, context, future.result())
+            if not not_done:
+                break
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+            finished = list(done)
+        # 都失败时优先返回主模型的错误回复
+        if primary_future.exception() is None and primary_future.result() is not None:
+            return primary_future.result()
+        for future in pending:
+            if future.exception() is None and future.result() is not None:
+                return future.result()
+        return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+
+    def reply_stream(self, query, context: Context):
+        """
+        流式回复：主模型在输出第一段之前出错时切换到备用模型，开始输出后不再切换
+        """
+        if context.type != ContextType.TEXT or is_session_command(query):
+            yield self.reply(query, context)
+            return
+        deadline = retry.current_deadline()
+        for bot_type in (self.primary, self.backup):
+            bot, fork_context, drop = self._fork(bot_type, context)
+            texts = []
+            stream = None
+            try:
+                stream = bot.reply_stream(query, fork_context)
+                try:
+                    first = self._next(stream, deadline)
+                except Exception as e:
+                    logger.warning("[Hedge] {} stream failed: {}".format(bot_type, e))
+                    first = None
+                    if bot_type == self.backup:
+                        raise
+                if bot_type == self.primary and (first is None or first.type == ReplyType.ERROR):
+                    logger.warning("[Hedge] primary {} stream failed, fail over to {}".format(self.primary, self.backup))
+                    metrics.inc("hedge_requests_total", reason="stream_failover")
+                    continue
+                reply = first
+                while reply is not None:
+                    if reply.type == ReplyType.TEXT:
+                        texts.append(reply.content)
+                    yield reply
+                    reply = self._next(stream, deadline)
+            finally:
+                if stream is not None:
+                    stream.close()
+                drop()
+            if bot_type == self.backup:
+                metrics.inc("hedge_wins_total", bot=self.backup)
+            if texts:
+                self._commit(query, context, Reply(ReplyType.TEXT, "".join(texts)))
+            return
+
+    @staticmethod
+    def _next(stream, deadline):
+        # 只在取下一段时沿用截止时间并在当前线程重试：会话副本在调用结束后即删除，不能交给调用方延迟重试；
+        # 两次取值之间调用方发送回复的代码不受影响
+        with retry.with_deadline(deadline):
+            return next(stream, None)
+
+    def stats(self):
+        return self.tracker.stats()
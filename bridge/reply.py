@@ -20,6 +20,7 @@ class ReplyType(Enum):
     LINK = 14  # 链接
     CALL_UP = 15  # 打电话
     GIF = 16  # 发动图
+    STREAM = 17  # 流式回复，content为Reply的迭代器，仅在channel内部拆分发送，不会交给send
 
     def __str__(self):
         return self.name
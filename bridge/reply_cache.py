@@ -0,0 +1,146 @@
+import hashlib
+import re
+import unicodedata
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+TRAILING_PUNCTUATION = "?？!！。.~～…"
+
+
+def normalize_query(query):
+    """归一化问题文本：全角转半角、合并空白、忽略大小写和结尾的语气标点"""
+    text = unicodedata.normalize("NFKC", query or "")
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return text.rstrip(TRAILING_PUNCTUATION).strip()
+
+
+@singleton
+class ReplyCache(object):
+    """
+    对完全相同的问题直接返回缓存的回复，省去重复的模型调用，主要用于大群中反复出现的常见问题。
+    缓存key由归一化后的问题、模型、人设以及可选的最近N轮对话组成，只缓存文本回复。
+    命中时仍会把问答写入会话，保证后续对话的上下文与实际调用时一致。
+    """
+
+    def __init__(self):
+        self.cache = ExpiredDict(conf().get("reply_cache_ttl", 3600), max_size=conf().get("reply_cache_max_size", 1000))
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.semantic = None
+        if conf().get("semantic_cache_enabled"):
+            try:
+                from bridge.semantic_cache import SemanticCache
+
+                self.semantic = SemanticCache(
+                    conf().get("semantic_cache_threshold", 0.85),
+                    conf().get("semantic_cache_max_size", 2000),
+                    conf().get("semantic_cache_dim", 1024),
+                    conf().get("reply_cache_ttl", 3600),
+                )
+            except ImportError as e:
+                logger.warning("[ReplyCache] semantic cache disabled, numpy is required: {}".format(e))
+
+    def enabled_for(self, context: Context):
+        if not conf().get("reply_cache_enabled") or context is None or context.type != ContextType.TEXT:
+            return False
+        if context.get("isgroup", False):
+            group_names = conf().get("reply_cache_group_names", [])
+            msg = context.get("msg")
+            group_name = msg.other_user_nickname if msg else None
+            return "ALL_GROUP" in group_names or group_name in group_names
+        return conf().get("reply_cache_single_chat", False)
+
+    def build_key(self, query, context: Context, bot):
+        """不适用缓存时返回None"""
+        if not query or query.startswith("#") or not self.enabled_for(context):  # 指令不缓存
+            return None
+        parts = [
+            normalize_query(query),
+            context.get("gpt_model") or conf().get("model") or "",
+            self._system_prompt(context, bot),
+        ]
+        turns = conf().get("reply_cache_context_turns", 0)
+        if turns:
+            sessions = getattr(bot, "sessions", None)
+            session_id = context.get("session_id")
+            if sessions is None or session_id is None:
+                return None
+            # 只取问答消息，每轮包含一问一答
+            messages = [m for m in sessions.build_session(session_id).messages if m.get("role") != "system"]
+            for message in messages[-turns * 2:]:
+                parts.append("{}:{}".format(message.get("role"), message.get("content")))
+        return hashlib.sha1("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _system_prompt(context: Context, bot):
+        """会话实际使用的人设，角色扮演等插件会为单个会话设置不同的system_prompt"""
+        sessions = getattr(bot, "sessions", None)
+        session_id = context.get("session_id")
+        if sessions is not None and session_id is not None:
+            system_prompt = getattr(sessions.build_session(session_id), "system_prompt", None)
+            if system_prompt is not None:
+                return system_prompt
+        return conf().get("character_desc", "")
+
+    @classmethod
+    def _semantic_partition(cls, context: Context, bot):
+        # 历史对话参与缓存key时，只按问题相似度匹配会忽略上下文，因此不使用语义缓存
+        if conf().get("reply_cache_context_turns", 0):
+            return None
+        system_prompt = cls._system_prompt(context, bot)
+        return context.get("gpt_model") or conf().get("model") or "", hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+
+    def get(self, key, query=None, context: Context = None, bot=None):
+        """先精确匹配，未命中时再按语义相似度匹配(需开启semantic_cache_enabled)"""
+        reply = self.cache.get(key)
+        if reply is not None:
+            self.hits += 1
+            metrics.inc("reply_cache_requests_total", result="hit")
+            return Reply(reply.type, reply.content)
+        if self.semantic and query and context is not None:
+            partition = self._semantic_partition(context, bot)
+            if partition is not None:
+                reply = self.semantic.lookup(query, partition)
+                if reply is not None:
+                    self.semantic_hits += 1
+                    metrics.inc("reply_cache_requests_total", result="semantic_hit")
+                    return reply
+        self.misses += 1
+        metrics.inc("reply_cache_requests_total", result="miss")
+        return None
+
+    def put(self, key, reply: Reply, query=None, context: Context = None, bot=None):
+        if reply and reply.type == ReplyType.TEXT and reply.content:
+            self.cache[key] = Reply(reply.type, reply.content)
+            if self.semantic and query and context is not None:
+                partition = self._semantic_partition(context, bot)
+                if partition is not None:
+                    self.semantic.add(query, partition, reply)
+        return reply
+
+    def apply_hit(self, bot, query, context: Context, reply: Reply):
+        """命中缓存时把本轮问答写入会话"""
+        sessions = getattr(bot, "sessions", None)
+        session_id = context.get("session_id")
+        if sessions is None or session_id is None:
+            return
+        try:
+            sessions.session_query(query, session_id)
+            sessions.session_reply(reply.content, session_id)
+        except Exception as e:
+            logger.warning("[ReplyCache] update session error: {}".format(e))
+
+    def clear(self):
+        self.cache.clear()
+        if self.semantic:
+            self.semantic.clear()
+
+    def stats(self):
+        return {"size": len(self.cache), "hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses}
@@ -0,0 +1,191 @@
+"""
+语义近似的回复缓存：在本地把问题编码为字符n-gram哈希向量，按余弦相似度匹配换了说法的相同问题。
+不依赖网络和模型，每个模型/人设一个NumPy矩阵，查找为一次矩阵乘法。
+
+离线评估：python -m bridge.semantic_cache messages.log [--threshold 0.85] [--bot-latency 3]
+messages.log每行一个问题，或每行一个json（{"query": ..., "latency": 模型实际耗时秒数}）
+"""
+
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from bridge.reply import Reply
+from bridge.reply_cache import normalize_query
+
+
+class HashedNgramEmbedder(object):
+    """把文本的字符n-gram哈希到固定维度并做L2归一化，向量点积即余弦相似度"""
+
+    def __init__(self, dim=1024, ngram_range=(1, 3)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def embed(self, text):
+        text = normalize_query(text)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        grams = [text[i:i + n] for n in range(self.ngram_range[0], self.ngram_range[1] + 1) for i in range(len(text) - n + 1)]
+        if not grams:
+            return vector
+        hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+        # 用哈希的最高位决定符号，减少哈希冲突带来的偏差
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dim, signs)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_batch(self, texts):
+        return np.stack([self.embed(text) for text in texts]) if texts else np.zeros((0, self.dim), dtype=np.float32)
+
+
+class SemanticIndex(object):
+    """
+    固定容量的向量索引，满了之后淘汰最久未命中的条目
+    :param ttl: 条目有效期(秒)，过期条目不参与匹配并优先被替换，None表示不过期
+    """
+
+    def __init__(self, dim, capacity, ttl=None):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.replies = [None] * capacity
+        self.capacity = capacity
+        self.ttl = ttl
+        self.size = 0
+        self.clock = 0  # 逻辑时钟，用于LRU
+
+    def search(self, vectors):
+        """批量查找，返回每个向量最相似条目的(下标, 相似度)，索引为空时下标为-1"""
+        if self.size == 0:
+            return [(-1, 0.0)] * len(vectors)
+        sims = vectors @ self.vectors[:self.size].T
+        if self.ttl:
+            expired = self.created[:self.size] < time.monotonic() - self.ttl
+            sims[:, expired] = -1.0
+        best = sims.argmax(axis=1)
+        scores = sims[np.arange(len(vectors)), best]
+        return list(zip(best.tolist(), scores.tolist()))
+
+    def touch(self, index):
+        self.clock += 1
+        self.last_used[index] = self.clock
+
+    def add(self, vector, reply):
+        if self.size < self.capacity:
+            index = self.size
+            self.size += 1
+        else:
+            index = int(self.last_used.argmin())  # 过期条目不会再被命中，自然会先被淘汰
+        self.vectors[index] = vector
+        self.replies[index] = reply
+        self.created[index] = time.monotonic()
+        self.touch(index)
+
+
+class SemanticCache(object):
+    """按分区（模型+人设）维护向量索引，相似度达到threshold时返回缓存的回复"""
+
+    def __init__(self, threshold=0.85, capacity=2000, dim=1024, ttl=None):
+        if np is None:
+            raise ImportError("numpy is required for semantic cache")
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.embedder = HashedNgramEmbedder(dim)
+        self.indexes = {}  # partition -> SemanticIndex
+        self.lock = threading.Lock()
+
+    def _get_index(self, partition):
+        index = self.indexes.get(partition)
+        if index is None:
+            index = self.indexes[partition] = SemanticIndex(self.embedder.dim, self.capacity, self.ttl)
+        return index
+
+    def lookup_batch(self, queries, partition):
+        """返回每个问题命中的回复，未命中为None"""
+        vectors = self.embedder.embed_batch(queries)
+        results = []
+        with self.lock:
+            index = self._get_index(partition)
+            for i, score in index.search(vectors):
+                if i >= 0 and score >= self.threshold:
+                    index.touch(i)
+                    reply = index.replies[i]
+                    results.append(Reply(reply.type, reply.content))
+                else:
+                    results.append(None)
+        return results
+
+    def lookup(self, query, partition):
+        return self.lookup_batch([query], partition)[0]
+
+    def add(self, query, partition, reply: Reply):
+        vector = self.embedder.embed(query)
+        with self.lock:
+            self._get_index(partition).add(vector, Reply(reply.type, reply.content))
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+
+
+def _load_log(path):
+    import json
+
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                data = json.loads(line)
+                items.append((data.get("query", ""), data.get("latency")))
+            else:
+                items.append((line, None))
+    return items
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from bridge.reply import ReplyType
+
+    parser = argparse.ArgumentParser(description="按消息日志回放，评估语义缓存的命中率和节省的耗时")
+    parser.add_argument("log", help="消息日志，每行一个问题或一个json")
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--capacity", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--bot-latency", type=float, default=3.0, help="日志中没有记录耗时时，假定每次模型调用的耗时(秒)")
+    parser.add_argument("--show", type=int, default=10, help="打印的命中样例数")
+    args = parser.parse_args()
+
+    items = _load_log(args.log)
+    cache = SemanticCache(args.threshold, args.capacity, args.dim)
+    hits = 0
+    saved = 0.0
+    lookup_cost = 0.0
+    samples = []
+    for query, latency in items:
+        start = time.perf_counter()
+        reply = cache.lookup(query, "benchmark")
+        lookup_cost += time.perf_counter() - start
+        if reply is not None:
+            hits += 1
+            saved += latency if latency is not None else args.bot_latency
+            if len(samples) < args.show:
+                samples.append((query, reply.content))
+        else:
+            # 以首次出现的问题作为“回复”，便于查看命中的是哪个问题
+            cache.add(query, "benchmark", Reply(ReplyType.TEXT, query))
+    total = len(items)
+    print("messages: {}, hits: {}, hit rate: {:.2%}".format(total, hits, hits / total if total else 0))
+    print("latency saved: {:.1f}s, lookup cost: {:.1f}ms total, {:.3f}ms per message".format(
+        saved, lookup_cost * 1000, lookup_cost * 1000 / total if total else 0))
+    for query, matched in samples:
+        print("  {} -> {}".format(query, matched))
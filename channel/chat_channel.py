@@ -1,15 +1,17 @@
 import os
-import re
 import threading
 import time
-from asyncio import CancelledError
+from collections import OrderedDict
 from concurrent.futures import Future, ThreadPoolExecutor
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.trigger_matcher import get_trigger_matcher, strip_at
 from common.dequeue import Dequeue
-from common import memory
+from common import memory, metrics, retry
+from common.retry import RetryLater
+from common.utils import split_stream_by_sentence
 from plugins import *
 
 try:
@@ -26,7 +28,13 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    lock = threading.RLock()  # 用于控制对sessions的访问
+    cond = threading.Condition(lock)  # 有新消息或任务完成时唤醒consume线程
+    ready_sessions = OrderedDict()  # 有待处理消息且并发未满的session_id，按就绪先后排列
+    # 流式回复的发送方式：incremental按句子分段逐条发送，accumulate收齐后一次发送（适用于一问只能一答的渠道）
+    STREAM_REPLY_MODE = "accumulate"
+    # 渠道允许的回复时间(秒)，超过后回复无法送达，bot延迟重试不会超过该时间；None表示只受retry_deadline配置限制
+    REPLY_WINDOW = None
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -34,6 +42,7 @@ class ChatChannel(Channel):
         _thread.start()
 
     # 根据消息构造context，消息内容相关的触发项写在这里
+    @metrics.timer("chat_compose_context_seconds")
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -47,6 +56,7 @@ class ChatChannel(Channel):
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
+            matcher = get_trigger_matcher()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
@@ -55,26 +65,12 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.group_allowed(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if group_name in matcher.group_chat_in_one_session:
                         session_id = group_id
                 else:
-                    logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
+                    logger.debug("No need reply, groupName not in whitelist, group_name=%s", group_name)
                     return None
                 context["session_id"] = session_id
                 context["receiver"] = group_id
@@ -96,14 +92,15 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
+            matcher = get_trigger_matcher()
+            nick_name_black_list = matcher.nick_name_black_list
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.group_chat_prefix.match(content)
+                match_contain = matcher.group_chat_keyword.contains(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
-                    if match_prefix is not None or match_contain is not None:
+                    if match_prefix is not None or match_contain:
                         flag = True
                         if match_prefix:
                             content = content.replace(match_prefix, "", 1).strip()
@@ -118,16 +115,12 @@ class ChatChannel(Channel):
                         if not conf().get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = strip_at(content, [self.name])
                         if isinstance(context["msg"].at_list, list):
-                            for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                            subtract_res = strip_at(subtract_res, context["msg"].at_list)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = strip_at(content, [context["msg"].self_display_name])
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -140,7 +133,7 @@ class ChatChannel(Channel):
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -148,7 +141,7 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
@@ -162,14 +155,41 @@ class ChatChannel(Channel):
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
+    @metrics.timer("chat_handle_seconds")
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
-        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        logger.debug("[chat_channel] ready to handle context: %s", context)
+        # bot出错需要延迟重试时不阻塞当前线程，而是抛出RetryLater，到期后重新提交到线程池
+        if "retry_deadline" not in context:
+            context["retry_deadline"] = time.monotonic() + self._retry_deadline()
         # reply的构建步骤
-        reply = self._generate_reply(context)
-
-        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+        try:
+            reply = self._generate_reply(context)
+            self._process_reply(context, reply)
+        except RetryLater as e:
+            # 由线程池回调安排重试，重试结束前保留会话的并发名额，同一会话的后续消息等待重试完成后再处理，保证回复顺序
+            context["retry_later"] = e
+
+    def _retry_deadline(self):
+        """bot延迟重试的截止秒数：retry_deadlines中按渠道配置的值优先，否则取retry_deadline与渠道回复时间的较小值"""
+        deadlines = conf().get("retry_deadlines") or {}
+        channel_type = conf().get("channel_type")
+        if channel_type in deadlines:
+            return deadlines[channel_type]
+        deadline = conf().get("retry_deadline", 120)
+        if self.REPLY_WINDOW is not None:
+            deadline = min(deadline, self.REPLY_WINDOW)
+        return deadline
+
+    def _process_reply(self, context: Context, reply: Reply):
+        logger.debug("[chat_channel] ready to decorate reply: %s", reply)
+
+        if reply and reply.type == ReplyType.STREAM:
+            # 流式回复在发送时才调用bot，与非流式回复一样延迟重试并遵守截止时间
+            with retry.deferrable(context.get("retry_deadline")):
+                self._send_stream_reply(context, reply.content)
+            return
 
         # reply的包装步骤
         if reply and reply.content:
@@ -178,6 +198,24 @@ class ChatChannel(Channel):
             # reply的发送步骤
             self._send_reply(context, reply)
 
+    def _schedule_retry(self, context: Context, retry_later: RetryLater):
+        logger.info("[chat_channel] retry in {:.1f}s, session_id={}".format(retry_later.delay, context.get("session_id")))
+
+        def run():
+            exception = None
+            try:
+                with retry.deferrable(context.get("retry_deadline")):
+                    reply = retry_later.func()
+                self._process_reply(context, reply)
+            except RetryLater as e:
+                self._schedule_retry(context, e)
+                return
+            except Exception as e:
+                exception = e
+            self._finish_task(context["session_id"], exception, context=context)
+
+        retry.scheduler.schedule(retry_later.delay, lambda: handler_pool.submit(run))
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
             EventContext(
@@ -188,10 +226,15 @@ class ChatChannel(Channel):
         reply = e_context["reply"]
         if not e_context.is_pass():
             config = conf()
-            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            logger.debug("[chat_channel] ready to handle context: type=%s, content=%s", context.type, context.content)
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
+                if context.type == ContextType.TEXT and config.get("stream_reply") and context.get("desire_rtype") != ReplyType.VOICE:
+                    reply = Reply(ReplyType.STREAM, super().build_reply_stream(context.content, context))
+                else:
+                    # 只有bot调用允许延迟重试，插件中直接调用bot时仍在当前线程重试
+                    with retry.deferrable(context.get("retry_deadline")):
+                        reply = super().build_reply_content(context.content, context)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
@@ -288,12 +331,16 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
+                    # 流式回复分段发送时，@和前缀只加在第一段，后缀只加在最后一段
+                    stream_first = context.get("stream_first", True)
+                    stream_last = context.get("stream_last", True)
                     if context.get("isgroup", False):
-                        if not context.get("no_need_at", False):
+                        if not context.get("no_need_at", False) and stream_first:
                             reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                        prefix, suffix = conf().get("group_chat_reply_prefix", ""), conf().get("group_chat_reply_suffix", "")
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        prefix, suffix = conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", "")
+                    reply_text = (prefix if stream_first else "") + reply_text + (suffix if stream_last else "")
                     reply.content = reply_text
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
@@ -334,12 +381,58 @@ class ChatChannel(Channel):
             )
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
-                logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
+                logger.debug("[chat_channel] ready to send reply: %s, context: %s", reply, context)
                 self._send(reply, context)
 
+    def _send_stream_reply(self, context: Context, replies):
+        """
+        发送流式回复，文本片段按句子重新切分后逐段走包装和发送流程，插件对每一段都生效
+        """
+        texts = []
+
+        def text_iter():
+            for reply in replies:
+                if reply is None or not reply.content:
+                    continue
+                if reply.type == ReplyType.TEXT:
+                    texts.append(reply.content)
+                    yield reply.content
+                else:  # 错误提示等非文本回复直接发送
+                    self._send_reply(context, self._decorate_reply(context, reply))
+
+        if self.STREAM_REPLY_MODE != "incremental":
+            for _ in text_iter():
+                pass
+            if texts:
+                reply = self._decorate_reply(context, Reply(ReplyType.TEXT, "".join(texts)))
+                self._send_reply(context, reply)
+            return
+
+        chunks = split_stream_by_sentence(
+            text_iter(),
+            conf().get("stream_reply_min_length", 20),
+            conf().get("stream_reply_max_length", 500),
+        )
+        try:
+            # 预读一段，用于判断当前段是否为最后一段
+            pending = next(chunks, None)
+            first = True
+            while pending is not None:
+                chunk = pending
+                pending = next(chunks, None)
+                context["stream_first"] = first
+                context["stream_last"] = pending is None
+                first = False
+                reply = self._decorate_reply(context, Reply(ReplyType.TEXT, chunk.strip()))
+                self._send_reply(context, reply)
+        finally:
+            context.kwargs.pop("stream_first", None)
+            context.kwargs.pop("stream_last", None)
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
-            self.send(reply, context)
+            with metrics.timer("chat_send_seconds", channel=conf().get("channel_type"), type=reply.type.name):
+                self.send(reply, context)
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
@@ -350,85 +443,117 @@ class ChatChannel(Channel):
                 self._send(reply, context, retry_cnt + 1)
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
-        logger.debug("Worker return success, session_id = {}".format(session_id))
+        logger.debug("Worker return success, session_id = %s", session_id)
 
     def _fail_callback(self, session_id, exception, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("Worker return exception: {}".format(exception))
 
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
-            try:
-                worker_exception = worker.exception()
-                if worker_exception:
-                    self._fail_callback(session_id, exception=worker_exception, **kwargs)
-                else:
-                    self._success_callback(session_id, **kwargs)
-            except CancelledError as e:
+            context = kwargs.get("context")
+            if not worker.cancelled() and worker.exception() is None and context is not None and "retry_later" in context:
+                retry_later = context["retry_later"]
+                del context["retry_later"]
+                with self.cond:
+                    self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                # 重试结束时再调用_finish_task释放会话
+                self._schedule_retry(context, retry_later)
+                return
+            if worker.cancelled():
+                # 被取消的任务没有执行，不调用回调，只归还并发名额
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
-            except Exception as e:
-                logger.exception("Worker raise exception: {}".format(e))
-            with self.lock:
-                self.sessions[session_id][1].release()
+                self._release_session(session_id)
+                return
+            self._finish_task(session_id, worker.exception(), **kwargs)
 
         return func
 
+    def _finish_task(self, session_id, exception=None, **kwargs):
+        """消息处理结束(包括延迟重试结束)后调用回调，并释放会话的并发名额"""
+        try:
+            if exception:
+                self._fail_callback(session_id, exception=exception, **kwargs)
+            else:
+                self._success_callback(session_id, **kwargs)
+        except Exception as e:
+            logger.exception("Worker raise exception: {}".format(e))
+        finally:
+            self._release_session(session_id)
+
+    def _release_session(self, session_id):
+        with self.cond:
+            self.sessions[session_id][1].release()
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            self._schedule(session_id)
+
+    # 需持有self.lock调用，会话有待处理消息且并发未满时加入就绪队列并唤醒consume线程
+    def _schedule(self, session_id):
+        context_queue, semaphore = self.sessions[session_id]
+        if context_queue.empty():
+            if semaphore._initial_value == semaphore._value:  # 没有排队也没有处理中的任务，回收会话
+                if not self.futures.get(session_id):
+                    self.futures.pop(session_id, None)
+                    self.ready_sessions.pop(session_id, None)
+                    del self.sessions[session_id]
+            return
+        if semaphore._value > 0 and session_id not in self.ready_sessions:
+            self.ready_sessions[session_id] = True
+            self.cond.notify()
+
     def produce(self, context: Context):
         session_id = context["session_id"]
-        with self.lock:
+        with self.cond:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
                 ]
+            # 队列中保存(context, 入队时间)，用于统计排队耗时
             if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                self.sessions[session_id][0].putleft((context, time.monotonic()))  # 优先处理管理命令
             else:
-                self.sessions[session_id][0].put(context)
+                self.sessions[session_id][0].put((context, time.monotonic()))
+            metrics.inc("chat_messages_received_total", type=context.type.name)
+            self._schedule(session_id)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，用于从消息队列中取出消息并处理，只在有就绪会话时被唤醒
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[chat_channel] consume context: {}".format(context))
-                            future: Future = handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+            with self.cond:
+                while not self.ready_sessions:
+                    self.cond.wait()
+                session_id, _ = self.ready_sessions.popitem(last=False)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if not context_queue.empty() and semaphore.acquire(blocking=False):
+                    context, enqueue_time = context_queue.get()
+                    metrics.observe("chat_queue_wait_seconds", time.monotonic() - enqueue_time)
+                    logger.debug("[chat_channel] consume context: %s", context)
+                    future: Future = handler_pool.submit(self._handle, context)
+                    if session_id not in self.futures:
+                        self.futures[session_id] = []
+                    self.futures[session_id].append(future)
+                    future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+                if session_id in self.sessions:
+                    self._schedule(session_id)
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
+                # 取消future会同步触发回调并可能回收会话，因此放在最后
+                for future in list(self.futures.get(session_id, [])):
+                    future.cancel()
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions.keys()):
+                self.cancel_session(session_id)
 
 
 def check_prefix(content, prefix_list):
@@ -71,10 +71,10 @@ def _check(func):
         self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[DingTalk] History message {} skipped".format(msgId))
+            logger.debug("[DingTalk] History message %s skipped", msgId)
             return
         if cmsg.my_msg and not cmsg.is_group:
-            logger.debug("[DingTalk] My message {} skipped".format(msgId))
+            logger.debug("[DingTalk] My message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -83,6 +83,7 @@ def _check(func):
 
 @singleton
 class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
+    STREAM_REPLY_MODE = "incremental"
     dingtalk_client_id = conf().get('dingtalk_client_id')
     dingtalk_client_secret = conf().get('dingtalk_client_secret')
 
@@ -134,17 +135,17 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
     def handle_single(self, cmsg: DingTalkMessage):
         # 处理单聊消息
         if cmsg.ctype == ContextType.VOICE:
-            logger.debug("[DingTalk]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[DingTalk]receive image msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE_CREATE:
-            logger.debug("[DingTalk]receive image create msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive image create msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[DingTalk]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[DingTalk]receive text msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive text msg: %s", cmsg.content)
         else:
-            logger.debug("[DingTalk]receive other msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive other msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -155,17 +156,17 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
     def handle_group(self, cmsg: DingTalkMessage):
         # 处理群聊消息
         if cmsg.ctype == ContextType.VOICE:
-            logger.debug("[DingTalk]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[DingTalk]receive image msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE_CREATE:
-            logger.debug("[DingTalk]receive image create msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive image create msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[DingTalk]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[DingTalk]receive text msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive text msg: %s", cmsg.content)
         else:
-            logger.debug("[DingTalk]receive other msg: {}".format(cmsg.content))
+            logger.debug("[DingTalk]receive other msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg)
         context['no_need_at'] = True
         if context:
@@ -220,6 +221,6 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
 {reply_text}
 
                                 """
-        logger.debug(f"[Dingtalk] generate_button_markdown_content, button_list={button_list} , markdown_content={markdown_content}")
+        logger.debug("[Dingtalk] generate_button_markdown_content, button_list=%s , markdown_content=%s", button_list, markdown_content)
 
         return button_list, markdown_content
@@ -1,11 +1,11 @@
 import os
 
-import requests
 from dingtalk_stream import ChatbotMessage
 
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 # -*- coding=utf-8 -*-
+from common import http_client
 from common.log import logger
 from common.tmp_dir import TmpDir
 
@@ -44,7 +44,7 @@ class DingTalkMessage(ChatMessage):
                 download_url = image_download_handler.get_image_download_url(download_code)
                 self.content = download_image_file(download_url, TmpDir().path())
             else:
-                logger.debug(f"[Dingtalk] messageType :{self.message_type} , imageList isEmpty")
+                logger.debug("[Dingtalk] messageType :%s , imageList isEmpty", self.message_type)
 
         if self.is_group:
             self.from_user_id = event.conversation_id
@@ -64,7 +64,7 @@ def download_image_file(image_url, temp_dir):
     # 设置代理
     # self.proxies
     # , proxies=self.proxies
-    response = requests.get(image_url, headers=headers, stream=True, timeout=60 * 5)
+    response = http_client.get(image_url, headers=headers, stream=True, timeout=60 * 5)
     if response.status_code == 200:
 
         # 生成文件名
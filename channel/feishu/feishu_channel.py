@@ -6,28 +6,29 @@
 """
 
 # -*- coding=utf-8 -*-
-import uuid
 
-import requests
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
+from common import http_client, media_downloader, metrics, webhook_server
 from common.log import logger
 from common.singleton import singleton
+from common.token_cache import get_token_cache
 from config import conf
 from common.expired_dict import ExpiredDict
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
-from common import utils
 import json
-import os
 
 URL_VERIFICATION = "url_verification"
+# tenant_access_token无效或已过期的错误码
+INVALID_TOKEN_CODES = (99991661, 99991663, 99991664)
 
 
 @singleton
 class FeiShuChanel(ChatChannel):
+    STREAM_REPLY_MODE = "incremental"
     feishu_app_id = conf().get('feishu_app_id')
     feishu_app_secret = conf().get('feishu_app_secret')
     feishu_token = conf().get('feishu_token')
@@ -35,7 +36,7 @@ class FeiShuChanel(ChatChannel):
     def __init__(self):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1, max_size=100000)
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -48,15 +49,13 @@ class FeiShuChanel(ChatChannel):
         )
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("feishu_port", 9891)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        webhook_server.serve(app.wsgifunc(), port, name="feishu")
 
     def send(self, reply: Reply, context: Context):
         msg = context.get("msg")
         is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
+        # token有缓存，回复耗时较长时也不会使用收到消息时已过期的token
+        access_token = self.fetch_access_token()
         headers = {
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
@@ -80,7 +79,7 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
@@ -89,15 +88,28 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+            if res.get("code") in INVALID_TOKEN_CODES:
+                self._token_cache().invalidate()
 
 
     def fetch_access_token(self) -> str:
+        """返回缓存的tenant_access_token，过期前在后台刷新"""
+        try:
+            return self._token_cache().get()
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, err={e}")
+            return ""
+
+    def _token_cache(self):
+        return get_token_cache("feishu:" + str(self.feishu_app_id), self._request_access_token)
+
+    def _request_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,27 +119,18 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
-        if response.status_code == 200:
-            res = response.json()
-            if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+        response = http_client.post(url=url, data=data, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"res={response}")
+        res = response.json()
+        if res.get("code") != 0:
+            raise Exception(f"get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
+        return res.get("tenant_access_token"), res.get("expire")
 
 
     def _upload_image_url(self, img_url, access_token):
-        logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
-        suffix = utils.get_path_suffix(img_url)
-        temp_name = str(uuid.uuid4()) + "." + suffix
-        if response.status_code == 200:
-            # 将图片内容保存为临时文件
-            with open(temp_name, "wb") as file:
-                file.write(response.content)
+        logger.debug("[WX] start download image, img_url=%s", img_url)
+        image_path = media_downloader.download(img_url)
 
         # upload
         upload_url = "https://open.feishu.cn/open-apis/im/v1/images"
@@ -137,10 +140,9 @@ class FeiShuChanel(ChatChannel):
         headers = {
             'Authorization': f'Bearer {access_token}',
         }
-        with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+        with open(image_path, "rb") as file:
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
-            os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
 
 
@@ -159,7 +161,7 @@ class FeishuController:
             channel = FeiShuChanel()
 
             request = json.loads(web.data().decode("utf-8"))
-            logger.debug(f"[FeiShu] receive request: {request}")
+            logger.debug("[FeiShu] receive request: %s", request)
 
             # 1.事件订阅回调验证
             if request.get("type") == URL_VERIFICATION:
@@ -203,28 +205,33 @@ class FeishuController:
                 else:
                     logger.warning("[FeiShu] message ignore")
                     return self.SUCCESS_MSG
-                # 构造飞书消息对象
-                feishu_msg = FeishuMessage(event, is_group=is_group, access_token=channel.fetch_access_token())
-                if not feishu_msg:
-                    return self.SUCCESS_MSG
-
-                context = self._compose_context(
-                    feishu_msg.ctype,
-                    feishu_msg.content,
-                    isgroup=is_group,
-                    msg=feishu_msg,
-                    receive_id_type=receive_id_type,
-                    no_need_at=True
-                )
-                if context:
-                    channel.produce(context)
-                logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+                # 获取token、构造消息可能需要请求接口，先返回成功，在后台线程中处理
+                webhook_server.dispatch(self._handle_message, channel, event, is_group, receive_id_type, key=msg.get("chat_id"))
             return self.SUCCESS_MSG
 
         except Exception as e:
             logger.error(e)
             return self.FAILED_MSG
 
+    def _handle_message(self, channel, event, is_group, receive_id_type):
+        # 构造飞书消息对象
+        feishu_msg = FeishuMessage(event, is_group=is_group, access_token=channel.fetch_access_token())
+        if not feishu_msg:
+            return
+
+        context = self._compose_context(
+            feishu_msg.ctype,
+            feishu_msg.content,
+            isgroup=is_group,
+            msg=feishu_msg,
+            receive_id_type=receive_id_type,
+            no_need_at=True
+        )
+        if context:
+            channel.produce(context)
+        logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+
+    @metrics.timer("chat_compose_context_seconds")
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -4,6 +4,7 @@ from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from common import media_downloader
 from common.log import logger
 from config import conf
 
@@ -28,6 +29,7 @@ class TerminalMessage(ChatMessage):
 
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    STREAM_REPLY_MODE = "incremental"
 
     def send(self, reply: Reply, context: Context):
         print("\nBot:")
@@ -40,16 +42,10 @@ class TerminalChannel(ChatChannel):
             print("<IMAGE>")
             img.show()
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-            import io
-
-            import requests
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
+            image_storage = media_downloader.open_bytes(img_url)
             image_storage.seek(0)
             img = Image.open(image_storage)
             print(img_url)
@@ -0,0 +1,174 @@
+"""
+_compose_context中触发规则的预编译匹配器：前缀用字典树匹配，关键词用Aho-Corasick自动机匹配，
+名单用集合查找，@昵称的正则按昵称缓存。匹配器只在发布新的配置快照后重建。
+"""
+
+import re
+import threading
+from collections import deque
+from functools import lru_cache
+
+from config import conf, subscribe_config
+
+# 关键词较少时逐个用str的in查找（C实现）更快，超过该数量才使用自动机
+AUTOMATON_MIN_KEYWORDS = 16
+
+TRIGGER_CONFIG_KEYS = {
+    "group_name_white_list",
+    "group_name_keyword_white_list",
+    "group_chat_in_one_session",
+    "group_chat_prefix",
+    "group_chat_keyword",
+    "nick_name_black_list",
+    "single_chat_prefix",
+    "image_create_prefix",
+}
+
+
+class PrefixTrie(object):
+    """返回文本以之开头的前缀，多个前缀都匹配时返回列表中靠前的一个，与check_prefix一致"""
+
+    def __init__(self, prefixes):
+        self.root = {}
+        self.empty = False
+        self.order = {}  # prefix -> 在列表中的位置
+        for i, prefix in enumerate(prefixes or []):
+            self.order.setdefault(prefix, i)
+            if prefix == "":
+                self.empty = True
+                continue
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = prefix  # None键标记前缀结尾
+
+    def match(self, text):
+        best = "" if self.empty else None
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            prefix = node.get(None)
+            if prefix is not None and (best is None or self.order[prefix] < self.order[best]):
+                best = prefix
+        return best
+
+
+class KeywordMatcher(object):
+    """判断文本是否包含任一关键词，关键词较多时使用Aho-Corasick自动机，只需扫描一遍文本"""
+
+    def __init__(self, keywords):
+        self.keywords = tuple(k for k in dict.fromkeys(keywords or []))
+        self.always = "" in self.keywords
+        self.goto = None
+        if not self.always and len(self.keywords) >= AUTOMATON_MIN_KEYWORDS:
+            self._build()
+
+    def _build(self):
+        goto = [{}]
+        output = [False]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                nxt = goto[state].get(char)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][char] = nxt
+                    goto.append({})
+                    output.append(False)
+                state = nxt
+            output[state] = True
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(char, 0) if goto[f].get(char, 0) != nxt else 0
+                output[nxt] = output[nxt] or output[fail[nxt]]
+        self.goto, self.fail, self.output = goto, fail, output
+
+    def contains(self, text):
+        if not self.keywords:
+            return False
+        if self.always:
+            return True
+        if self.goto is None:
+            return any(keyword in text for keyword in self.keywords)
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                return True
+        return False
+
+
+class NameList(object):
+    """名单集合查找，包含ALL_GROUP时匹配所有名称"""
+
+    def __init__(self, names):
+        self.names = frozenset(names or [])
+        self.all = "ALL_GROUP" in self.names
+
+    def __contains__(self, name):
+        return self.all or name in self.names
+
+
+@lru_cache(maxsize=1024)
+def at_pattern(name):
+    return re.compile("@{}(\u2005|\u0020)".format(re.escape(name)))
+
+
+def strip_at(content, names):
+    """依次移除@name，names中的空值会被跳过"""
+    for name in names:
+        if name is not None:
+            content = at_pattern(name).sub("", content)
+    return content
+
+
+class TriggerMatcher(object):
+    def __init__(self, config):
+        self.group_name_white_list = NameList(config.get("group_name_white_list", []))
+        self.group_name_keyword_white_list = KeywordMatcher(config.get("group_name_keyword_white_list", []))
+        self.group_chat_in_one_session = NameList(config.get("group_chat_in_one_session", []))
+        self.group_chat_prefix = PrefixTrie(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordMatcher(config.get("group_chat_keyword"))
+        self.nick_name_black_list = frozenset(config.get("nick_name_black_list", []) or [])
+        self.single_chat_prefix = PrefixTrie(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixTrie(config.get("image_create_prefix", [""]))
+
+    def group_allowed(self, group_name):
+        return group_name in self.group_name_white_list or self.group_name_keyword_white_list.contains(group_name)
+
+
+_matcher = None
+_lock = threading.Lock()
+
+
+def _on_config_change(old_config, new_config, changed_keys):
+    global _matcher
+    if changed_keys & TRIGGER_CONFIG_KEYS:
+        _matcher = None  # 下次使用时按新配置重建
+
+
+subscribe_config(_on_config_change)
+
+
+def get_trigger_matcher():
+    """返回当前配置对应的匹配器，相关配置变化后重建"""
+    global _matcher
+    matcher = _matcher
+    if matcher is None:
+        with _lock:
+            matcher = _matcher
+            if matcher is None:
+                matcher = _matcher = TriggerMatcher(conf())
+    return matcher
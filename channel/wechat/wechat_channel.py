@@ -10,28 +10,33 @@ import os
 import threading
 import time
 
-import requests
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel import chat_channel
 from channel.wechat.wechat_message import *
+from common import media_downloader
 from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.media_id_cache import MediaIdCache
 from common.singleton import singleton
 from common.time_check import time_checker
 from config import conf, get_appdata_dir
 from lib import itchat
 from lib.itchat.content import *
 
+# 网页版微信未公开上传文件MediaId的有效期，保守缓存一段时间，发送失败时重新上传
+MEDIA_ID_SECONDS = 12 * 3600
+MEDIA_DEFAULT_NAMES = {"image": "tmp.jpg", "video": "tmp.mp4", "file": "tmp"}
+
 
 @itchat.msg_register([TEXT, VOICE, PICTURE, NOTE, ATTACHMENT, SHARING])
 def handler_single_msg(msg):
     try:
         cmsg = WechatMessage(msg, False)
     except NotImplementedError as e:
-        logger.debug("[WX]single message {} skipped: {}".format(msg["MsgId"], e))
+        logger.debug("[WX]single message %s skipped: %s", msg["MsgId"], e)
         return None
     WechatChannel().handle_single(cmsg)
     return None
@@ -42,7 +47,7 @@ def handler_group_msg(msg):
     try:
         cmsg = WechatMessage(msg, True)
     except NotImplementedError as e:
-        logger.debug("[WX]group message {} skipped: {}".format(msg["MsgId"], e))
+        logger.debug("[WX]group message %s skipped: %s", msg["MsgId"], e)
         return None
     WechatChannel().handle_group(cmsg)
     return None
@@ -57,10 +62,10 @@ def _check(func):
         self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[WX]history message {} skipped".format(msgId))
+            logger.debug("[WX]history message %s skipped", msgId)
             return
         if cmsg.my_msg and not cmsg.is_group:
-            logger.debug("[WX]my message {} skipped".format(msgId))
+            logger.debug("[WX]my message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -106,11 +111,13 @@ def qrCallback(uuid, status, qrcode):
 @singleton
 class WechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
         self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds"))
         self.auto_login_times = 0
+        self.media_ids = MediaIdCache("itchat_media", expires_in=MEDIA_ID_SECONDS)
 
     def startup(self):
         try:
@@ -171,15 +178,15 @@ class WechatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("speech_recognition") != True:
                 return
-            logger.debug("[WX]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", cmsg._rawmsg, cmsg)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -190,18 +197,18 @@ class WechatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if conf().get("group_speech_recognition") != True:
                 return
-            logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice for group msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image for group msg: %s", cmsg.content)
         elif cmsg.ctype in [ContextType.JOIN_GROUP, ContextType.PATPAT, ContextType.ACCEPT_FRIEND, ContextType.EXIT_GROUP]:
-            logger.debug("[WX]receive note msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive note msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
             # logger.debug("[WX]receive group msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
             pass
         elif cmsg.ctype == ContextType.FILE:
-            logger.debug(f"[WX]receive attachment msg, file_name={cmsg.content}")
+            logger.debug("[WX]receive attachment msg, file_name=%s", cmsg.content)
         else:
-            logger.debug("[WX]receive group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive group msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg)
         if context:
             self.produce(context)
@@ -216,48 +223,65 @@ class WechatChannel(ChatChannel):
             itchat.send(reply.content, toUserName=receiver)
             logger.info("[WX] sendMsg={}, receiver={}".format(reply, receiver))
         elif reply.type == ReplyType.VOICE:
-            itchat.send_file(reply.content, toUserName=receiver)
+            self._send_media(itchat.send_file, reply.content, receiver, "file")
             logger.info("[WX] sendFile={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            size = 0
-            for block in pic_res.iter_content(1024):
-                size += len(block)
-                image_storage.write(block)
-            logger.info(f"[WX] download image success, size={size}, img_url={img_url}")
-            image_storage.seek(0)
-            itchat.send_image(image_storage, toUserName=receiver)
+            logger.debug("[WX] start download image, img_url=%s", img_url)
+            image_path = media_downloader.download(img_url)
+            logger.info(f"[WX] download image success, path={image_path}, img_url={img_url}")
+            self._send_media(itchat.send_image, image_path, receiver, "image")
             logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
             image_storage.seek(0)
-            itchat.send_image(image_storage, toUserName=receiver)
+            self._send_media(itchat.send_image, image_storage, receiver, "image")
             logger.info("[WX] sendImage, receiver={}".format(receiver))
         elif reply.type == ReplyType.FILE:  # 新增文件回复类型
             file_storage = reply.content
-            itchat.send_file(file_storage, toUserName=receiver)
+            self._send_media(itchat.send_file, file_storage, receiver, "file")
             logger.info("[WX] sendFile, receiver={}".format(receiver))
         elif reply.type == ReplyType.VIDEO:  # 新增视频回复类型
             video_storage = reply.content
-            itchat.send_video(video_storage, toUserName=receiver)
+            self._send_media(itchat.send_video, video_storage, receiver, "video")
             logger.info("[WX] sendFile, receiver={}".format(receiver))
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
-            logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
-            video_storage = io.BytesIO()
-            size = 0
-            for block in video_res.iter_content(1024):
-                size += len(block)
-                video_storage.write(block)
-            logger.info(f"[WX] download video success, size={size}, video_url={video_url}")
-            video_storage.seek(0)
-            itchat.send_video(video_storage, toUserName=receiver)
+            logger.debug("[WX] start download video, video_url=%s", video_url)
+            video_path = media_downloader.download(video_url, suffix=".mp4")
+            logger.info(f"[WX] download video success, path={video_path}, video_url={video_url}")
+            self._send_media(itchat.send_video, video_path, receiver, "video")
             logger.info("[WX] sendVideo url={}, receiver={}".format(video_url, receiver))
 
+    def _send_media(self, send, content, receiver, kind):
+        """
+        发送图片、视频、文件，相同内容复用已上传的MediaId，MediaId失效导致发送失败时重新上传一次
+        :param send: itchat.send_image、itchat.send_video或itchat.send_file
+        :param content: 文件路径或文件对象
+        """
+        if hasattr(content, "read"):
+            file_dir, file_ = MEDIA_DEFAULT_NAMES[kind], content
+        else:
+            file_dir, file_ = content, None
+
+        def upload():
+            if file_:
+                file_.seek(0)
+            r = itchat.upload_file(file_dir, isPicture=kind == "image" and not file_dir.endswith(".gif"), isVideo=kind == "video", file_=file_)
+            if not r:
+                raise Exception("[WX] upload {} failed: {}".format(kind, r))
+            return r["MediaId"]
+
+        for retry in (False, True):
+            media_id = self.media_ids.get_or_upload(content, upload, kind)
+            if file_:
+                file_.seek(0)
+            r = send(file_dir, toUserName=receiver, mediaId=media_id, file_=file_)
+            if r or retry:
+                return r
+            logger.warning("[WX] send {} with media_id failed, upload again: {}".format(kind, r))
+            self.media_ids.invalidate(content, kind)
+
 def _send_login_success():
     try:
         from common.linkai_client import chat_client
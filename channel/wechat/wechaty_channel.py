@@ -31,6 +31,7 @@ except Exception as e:
 @singleton
 class WechatyChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
@@ -114,12 +115,12 @@ class WechatyChannel(ChatChannel):
         try:
             cmsg = await WechatyMessage(msg)
         except NotImplementedError as e:
-            logger.debug("[WX] {}".format(e))
+            logger.debug("[WX] %s", e)
             return
         except Exception as e:
             logger.exception("[WX] {}".format(e))
             return
-        logger.debug("[WX] message:{}".format(cmsg))
+        logger.debug("[WX] message:%s", cmsg)
         room = msg.room()  # 获取消息来自的群聊. 如果消息不是来自群聊, 则返回None
         isgroup = room is not None
         ctype = cmsg.ctype
@@ -1,9 +1,7 @@
 # -*- coding=utf-8 -*-
-import io
 import os
 import time
 
-import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -15,18 +13,22 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common import media_downloader, webhook_server
 from common.log import logger
+from common.media_id_cache import MediaIdCache
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length
 from config import conf, subscribe_msg
 from voice.audio_convert import any_to_amr, split_audio
 
 MAX_UTF8_LEN = 2048
+TEMP_MEDIA_SECONDS = 3 * 24 * 3600  # 临时素材的有效期，期间相同内容发给其他用户时复用media_id
 
 
 @singleton
 class WechatComAppChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
@@ -41,13 +43,14 @@ class WechatComAppChannel(ChatChannel):
         )
         self.crypto = WeChatCrypto(self.token, self.aes_key, self.corp_id)
         self.client = WechatComAppClient(self.corp_id, self.secret)
+        self.media_ids = MediaIdCache("wechatcom_media", expires_in=TEMP_MEDIA_SECONDS)
 
     def startup(self):
         # start message listener
         urls = ("/wxcomapp", "channel.wechatcom.wechatcomapp_channel.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatcomapp_port", 9898)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        webhook_server.serve(app.wsgifunc(), port, name="wechatcom")
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
@@ -71,9 +74,13 @@ class WechatComAppChannel(ChatChannel):
                 if len(files) > 1:
                     logger.info("[wechatcom] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                 for path in files:
-                    response = self.client.media.upload("voice", open(path, "rb"))
-                    logger.debug("[wechatcom] upload voice response: {}".format(response))
-                    media_ids.append(response["media_id"])
+                    def upload(path=path):
+                        with open(path, "rb") as f:
+                            response = self.client.media.upload("voice", f)
+                        logger.debug("[wechatcom] upload voice response: %s", response)
+                        return response["media_id"]
+
+                    media_ids.append(self.media_ids.get_or_upload(path, upload, "voice"))
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload voice failed: {}".format(e))
                 return
@@ -89,42 +96,35 @@ class WechatComAppChannel(ChatChannel):
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
+            image_storage = media_downloader.open_bytes(img_url)
             try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
+                media_id = self.media_ids.get_or_upload(image_storage, lambda: self._upload_image(image_storage), "image")
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
-
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            self.client.message.send_image(self.agent_id, receiver, media_id)
             logger.info("[wechatcom] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
             try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
+                media_id = self.media_ids.get_or_upload(image_storage, lambda: self._upload_image(image_storage), "image")
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            self.client.message.send_image(self.agent_id, receiver, media_id)
             logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
 
+    def _upload_image(self, image_storage):
+        sz = fsize(image_storage)
+        if sz >= 10 * 1024 * 1024:
+            logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
+            image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
+            logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
+        image_storage.seek(0)
+        response = self.client.media.upload("image", image_storage)
+        logger.debug("[wechatcom] upload image response: %s", response)
+        return response["media_id"]
+
 
 class Query:
     def GET(self):
@@ -153,7 +153,7 @@ class Query:
         except (InvalidSignatureException, InvalidCorpIdException):
             raise web.Forbidden()
         msg = parse_message(message)
-        logger.debug("[wechatcom] receive message: {}, msg= {}".format(message, msg))
+        logger.debug("[wechatcom] receive message: %s, msg= %s", message, msg)
         if msg.type == "event":
             if msg.event == "subscribe":
                 reply_content = subscribe_msg()
@@ -162,17 +162,22 @@ class Query:
                     res = channel.crypto.encrypt_message(reply, nonce, timestamp)
                     return res
         else:
-            try:
-                wechatcom_msg = WechatComAppMessage(msg, client=channel.client)
-            except NotImplementedError as e:
-                logger.debug("[wechatcom] " + str(e))
-                return "success"
-            context = channel._compose_context(
-                wechatcom_msg.ctype,
-                wechatcom_msg.content,
-                isgroup=False,
-                msg=wechatcom_msg,
-            )
-            if context:
-                channel.produce(context)
+            # 先返回success，消息在后台线程中处理
+            webhook_server.dispatch(self._handle_message, channel, msg, key=msg.source)
         return "success"
+
+    @staticmethod
+    def _handle_message(channel, msg):
+        try:
+            wechatcom_msg = WechatComAppMessage(msg, client=channel.client)
+        except NotImplementedError as e:
+            logger.debug("[wechatcom] " + str(e))
+            return
+        context = channel._compose_context(
+            wechatcom_msg.ctype,
+            wechatcom_msg.content,
+            isgroup=False,
+            msg=wechatcom_msg,
+        )
+        if context:
+            channel.produce(context)
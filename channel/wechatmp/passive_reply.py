@@ -1,4 +1,3 @@
-import asyncio
 import time
 
 import web
@@ -14,6 +13,10 @@ from common.log import logger
 from common.utils import split_string_by_utf8_length
 from config import conf, subscribe_msg
 
+# 公众号服务器5秒内收不到响应会断开并重试，共请求3次
+REPLY_WAIT_SECONDS = 4  # 在该时间内就绪的回复直接在本次请求中返回
+SERVER_TIMEOUT_SECONDS = 5.5  # 未就绪时保持连接到服务器断开，使其重试；提前返回success服务器就不会再重试
+
 
 # This class is instantiated once per query
 class Query:
@@ -59,10 +62,10 @@ class Query:
                         context = channel._compose_context(wechatmp_msg.ctype, content, isgroup=False, desire_rtype=ReplyType.VOICE, msg=wechatmp_msg)
                     else:
                         context = channel._compose_context(wechatmp_msg.ctype, content, isgroup=False, msg=wechatmp_msg)
-                    logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
+                    logger.debug("[wechatmp] context: %s %s %s", context, wechatmp_msg, supported)
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        channel.running[from_user] = True
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -100,20 +103,14 @@ class Query:
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
+                # 回复缓存或任务结束时立即被唤醒
+                ready = channel.wait_reply(from_user, request_time + REPLY_WAIT_SECONDS - time.time())
 
                 reply_text = ""
-                if task_running:
+                if not ready:
                     if request_cnt < 3:
                         # waiting for timeout (the POST request will be closed by Wechat official server)
-                        time.sleep(2)
+                        time.sleep(max(request_time + SERVER_TIMEOUT_SECONDS - time.time(), 0))
                         # and do nothing, waiting for the next request
                         return "success"
                     else:  # request_cnt == 3:
@@ -123,7 +120,7 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # reply is ready
-                channel.request_cnt.pop(message_id)
+                channel.request_cnt.pop(message_id, None)
 
                 # no return because of bandwords or other reasons
                 if from_user not in channel.cache_dict and from_user not in channel.running:
@@ -134,7 +131,7 @@ class Query:
                     (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
                     if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
                         del channel.cache_dict[from_user]
-                except IndexError:
+                except (IndexError, KeyError):
                     return "success"
 
                 if reply_type == "text":
@@ -148,7 +145,7 @@ class Query:
                             max_split=1,
                         )
                         reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
+                        channel.cache_reply(from_user, ("text", splits[1]))
 
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
@@ -164,7 +161,6 @@ class Query:
 
                 elif reply_type == "voice":
                     media_id = reply_content
-                    asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {} voice media_id {}".format(
                             request_cnt,
@@ -180,7 +176,6 @@ class Query:
 
                 elif reply_type == "image":
                     media_id = reply_content
-                    asyncio.run_coroutine_threadsafe(channel.delete_media(media_id), channel.delete_media_loop)
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {} image media_id {}".format(
                             request_cnt,
@@ -1,23 +1,24 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import atexit
 import imghdr
-import io
 import os
 import threading
 import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common import media_downloader, webhook_server
+from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.media_id_cache import MediaIdCache
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length
 from config import conf
@@ -31,12 +32,30 @@ from voice.audio_convert import any_to_mp3, split_audio
 #         private_key='/ssl/cert.key')
 
 
+# 被动回复的状态都有过期时间，未被取走的回复、未正常结束的任务不会一直占用内存
+REPLY_CACHE_SECONDS = 3600  # 未被用户取走的回复保留的时间
+RUNNING_SECONDS = 600  # 超过该时间仍未结束的任务视为已结束，用户可以重新提问
+REQUEST_CNT_SECONDS = 60  # 公众号服务器对同一条消息的重试在15秒内完成
+REPLY_COND_COUNT = 64
+PASSIVE_REPLY_WINDOW = 12  # 被动回复时bot延迟重试的截止秒数，低于公众号约15秒的回复时限
+# 相同内容的图片、语音、视频发给多个用户时复用已上传的media_id
+TEMP_MEDIA_SECONDS = 3 * 24 * 3600  # 临时素材的有效期
+# 永久素材数量有上限，超过一段时间未被使用或超出数量时删除；不短于回复缓存时间，避免缓存的回复引用已删除的素材
+MATERIAL_IDLE_SECONDS = REPLY_CACHE_SECONDS
+MATERIAL_CACHE_SIZE = 500
+MATERIAL_RECHECK_SECONDS = 60  # 待删除的素材仍被未取走的回复引用时，间隔该秒数后再检查
+
+
 @singleton
 class WechatMPChannel(ChatChannel):
     def __init__(self, passive_reply=True):
         super().__init__()
         self.passive_reply = passive_reply
         self.NOT_SUPPORT_REPLYTYPE = []
+        # 被动回复一问只能一答，流式回复需收齐后一次发送
+        self.STREAM_REPLY_MODE = "accumulate" if passive_reply else "incremental"
+        # 被动回复需在公众号服务器的三次请求(约15秒)内完成，重试不超过该时间
+        self.REPLY_WINDOW = PASSIVE_REPLY_WINDOW if passive_reply else None
         appid = conf().get("wechatmp_app_id")
         secret = conf().get("wechatmp_app_secret")
         token = conf().get("wechatmp_token")
@@ -47,16 +66,27 @@ class WechatMPChannel(ChatChannel):
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
             # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
+            self.cache_dict = ExpiredDict(REPLY_CACHE_SECONDS)
             # Record whether the current message is being processed
-            self.running = set()
+            self.running = ExpiredDict(RUNNING_SECONDS)
             # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            self.request_cnt = ExpiredDict(REQUEST_CNT_SECONDS)
+            # 等待回复的请求线程按用户分组等待在条件变量上，回复缓存或任务结束时立即唤醒
+            self.reply_conds = [threading.Condition() for _ in range(REPLY_COND_COUNT)]
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
             t.setDaemon(True)
             t.start()
+            # 永久素材移出缓存时才删除，缓存期间发给其他用户可直接复用
+            self.media_ids = MediaIdCache(
+                "wechatmp_material", idle_seconds=MATERIAL_IDLE_SECONDS, max_size=MATERIAL_CACHE_SIZE, on_evict=self._schedule_delete_media
+            )
+            self.pending_deletes = set()  # 已移出缓存、等待删除的永久素材
+            # 退出时删除缓存中和等待删除的永久素材，避免每次重启都遗留素材占用数量上限
+            atexit.register(self._delete_all_media)
+        else:
+            self.media_ids = MediaIdCache("wechatmp_media", expires_in=TEMP_MEDIA_SECONDS)
 
     def startup(self):
         if self.passive_reply:
@@ -65,25 +95,76 @@ class WechatMPChannel(ChatChannel):
             urls = ("/wx", "channel.wechatmp.active_reply.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        webhook_server.serve(app.wsgifunc(), port, name="wechatmp")
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
         loop.run_forever()
 
+    def _schedule_delete_media(self, media_id):
+        self.pending_deletes.add(media_id)
+        asyncio.run_coroutine_threadsafe(self.delete_media(media_id), self.delete_media_loop)
+
+    def _media_referenced(self, media_id):
+        """素材是否仍被未取走的缓存回复引用"""
+        return any(content == media_id for items in self.cache_dict.values() for _, content in items)
+
     async def delete_media(self, media_id):
-        logger.debug("[wechatmp] permanent media {} will be deleted in 10s".format(media_id))
+        logger.debug("[wechatmp] permanent media %s will be deleted in 10s", media_id)
         await asyncio.sleep(10)
+        # 因超出数量被移出缓存的素材可能仍在等待用户取走的回复中，等回复取走或过期后再删除
+        while self._media_referenced(media_id):
+            await asyncio.sleep(MATERIAL_RECHECK_SECONDS)
+        if media_id not in self.pending_deletes:
+            return
+        self.pending_deletes.discard(media_id)
         self.client.material.delete(media_id)
         logger.info("[wechatmp] permanent media {} has been deleted".format(media_id))
 
+    def _delete_all_media(self):
+        media_ids = set(self.media_ids.drain()) | self.pending_deletes
+        self.pending_deletes = set()
+        for media_id in media_ids:
+            try:
+                self.client.material.delete(media_id)
+            except Exception as e:
+                logger.warning("[wechatmp] delete permanent media {} failed: {}".format(media_id, e))
+        if media_ids:
+            logger.info("[wechatmp] deleted {} permanent media before exit".format(len(media_ids)))
+
+    def _reply_cond(self, user):
+        return self.reply_conds[hash(user) % len(self.reply_conds)]
+
+    def _notify_reply(self, user):
+        cond = self._reply_cond(user)
+        with cond:
+            cond.notify_all()
+
+    def cache_reply(self, user, item):
+        """缓存回复并唤醒等待该用户回复的请求"""
+        self.cache_dict.setdefault(user, []).append(item)
+        self._notify_reply(user)
+
+    def finish_task(self, user):
+        self.running.pop(user, None)
+        self._notify_reply(user)
+
+    def wait_reply(self, user, timeout):
+        """
+        等待用户有缓存的回复或任务已结束，返回是否就绪
+        :param timeout: 最长等待的秒数
+        """
+        cond = self._reply_cond(user)
+        with cond:
+            return bool(cond.wait_for(lambda: self.cache_dict.get(user) or user not in self.running, max(timeout, 0)))
+
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
         if self.passive_reply:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self.cache_reply(receiver, ("text", reply_text))
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -92,89 +173,62 @@ class WechatMPChannel(ChatChannel):
 
                 for path in files:
                     # support: <2M, <60s, mp3/wma/wav/amr
-                    try:
+                    def upload(path=path):
                         with open(path, "rb") as f:
                             response = self.client.material.add("voice", f)
-                            logger.debug("[wechatmp] upload voice response: {}".format(response))
+                            logger.debug("[wechatmp] upload voice response: %s", response)
                             f_size = os.fstat(f.fileno()).st_size
                             time.sleep(1.0 + 2 * f_size / 1024 / 1024)
                             # todo check media_id
+                        return response["media_id"]
+
+                    try:
+                        media_id = self.media_ids.get_or_upload(path, upload, "voice")
                     except WeChatClientException as e:
                         logger.error("[wechatmp] upload voice failed: {}".format(e))
                         return
-                    media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
+                    self.cache_reply(receiver, ("voice", media_id))
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
+                image_storage = media_downloader.open_bytes(img_url)
                 try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
+                    media_id = self._upload_media("image", receiver, context, image_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, ("image", media_id))
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
                 try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
+                    media_id = self._upload_media("image", receiver, context, image_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, ("image", media_id))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
+                video_storage = media_downloader.open_bytes(video_url)
                 try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
+                    media_id = self._upload_media("video", receiver, context, video_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, ("video", media_id))
 
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
                 try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
+                    media_id = self._upload_media("video", receiver, context, video_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, ("video", media_id))
 
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
@@ -209,9 +263,13 @@ class WechatMPChannel(ChatChannel):
                         logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
                     for path in files:
                         # support: <2M, <60s, AMR\MP3
-                        response = self.client.media.upload("voice", (os.path.basename(path), open(path, "rb"), file_type))
-                        logger.debug("[wechatcom] upload voice response: {}".format(response))
-                        media_ids.append(response["media_id"])
+                        def upload(path=path):
+                            with open(path, "rb") as f:
+                                response = self.client.media.upload("voice", (os.path.basename(path), f, file_type))
+                            logger.debug("[wechatmp] upload voice response: %s", response)
+                            return response["media_id"]
+
+                        media_ids.append(self.media_ids.get_or_upload(path, upload, "voice"))
                         os.remove(path)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload voice failed: {}".format(e))
@@ -228,77 +286,67 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
+                image_storage = media_downloader.open_bytes(img_url)
                 try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
+                    media_id = self._upload_media("image", receiver, context, image_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.client.message.send_image(receiver, media_id)
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
                 try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
+                    media_id = self._upload_media("image", receiver, context, image_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.client.message.send_image(receiver, media_id)
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
+                video_storage = media_downloader.open_bytes(video_url)
                 try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
+                    media_id = self._upload_media("video", receiver, context, video_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
+                self.client.message.send_video(receiver, media_id)
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
                 try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
+                    media_id = self._upload_media("video", receiver, context, video_storage)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
+                self.client.message.send_video(receiver, media_id)
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
         return
 
+    def _upload_media(self, media_type, receiver, context, storage):
+        """上传图片或视频，相同内容复用已上传的media_id。被动回复上传为永久素材，主动回复上传为临时素材"""
+        storage.seek(0)
+        file_type = imghdr.what(storage) if media_type == "image" else "mp4"
+        filename = receiver + "-" + str(context["msg"].msg_id) + "." + file_type
+        content_type = media_type + "/" + file_type
+        add = self.client.material.add if self.passive_reply else self.client.media.upload
+
+        def upload():
+            storage.seek(0)
+            response = add(media_type, (filename, storage, content_type))
+            logger.debug("[wechatmp] upload %s response: %s", media_type, response)
+            return response["media_id"]
+
+        return self.media_ids.get_or_upload(storage, upload, media_type)
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
-        logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
+        logger.debug("[wechatmp] Success to generate reply, msgId=%s", context["msg"].msg_id)
         if self.passive_reply:
-            self.running.remove(session_id)
+            self.finish_task(session_id)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
             assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self.finish_task(session_id)
@@ -42,7 +42,7 @@ class WechatMPClient(WeChatClient):
                     if self.last_clear_quota_time == -1 or time.time() - self.last_clear_quota_time > 60:
                         self.last_clear_quota_time = time.time()
                         response = self.clear_quota_v2()
-                        logger.debug("[wechatmp] API quata has been cleard, {}".format(response))
+                        logger.debug("[wechatmp] API quata has been cleard, %s", response)
                 return super()._request(method, url_or_endpoint, **kwargs)
             else:
                 logger.error("[wechatmp] last clear quota time is {}, less than 60s, skip clear quota")
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from common.log import logger
+from common.singleton import singleton
+
+
+@singleton
+class ContactStore(object):
+    """
+    进程内的联系人/群/群成员索引，以wxid为键，替代每条消息重复读取tmp下的json文件。
+    startup时全量加载一次，之后根据进群/退群通知增量更新，落盘只在后台线程进行。
+    """
+
+    def __init__(self, persist_delay=5):
+        self.lock = threading.RLock()
+        self.contacts = {}  # wxid -> contact
+        self.rooms = {}  # room_wxid -> room
+        self.room_members = {}  # room_wxid -> {wxid: member}
+        self.room_name_index = {}  # room_wxid -> {display_name/nickname: wxid}
+        self.persist_delay = persist_delay  # 落盘延迟，合并短时间内的多次变更
+        self.directory = os.path.join(os.getcwd(), "tmp")
+        self._persist_timer = None
+
+    def load(self, wechat):
+        """从客户端全量拉取联系人、群和群成员，仅在startup时调用"""
+        contacts = wechat.get_contacts()
+        rooms = wechat.get_rooms()
+        room_members = {}
+        for room in rooms:
+            room_wxid = room["wxid"]
+            room_members[room_wxid] = wechat.get_room_members(room_wxid)
+        self.load_from_data(contacts, rooms, room_members)
+        self.schedule_persist()
+
+    def load_from_data(self, contacts, rooms, room_members):
+        members = {}
+        name_index = {}
+        for room_wxid, info in room_members.items():
+            member_list = (info or {}).get("member_list") or []
+            members[room_wxid] = {member["wxid"]: member for member in member_list}
+            name_index[room_wxid] = self._build_name_index(member_list)
+        with self.lock:
+            self.contacts = {contact["wxid"]: contact for contact in contacts}
+            self.rooms = {room["wxid"]: room for room in rooms}
+            self.room_members = members
+            self.room_name_index = name_index
+        logger.info("[WX] contact store loaded, contacts={}, rooms={}".format(len(self.contacts), len(self.rooms)))
+
+    @staticmethod
+    def _build_name_index(member_list):
+        index = {}
+        # 与原先线性查找保持一致：同名时取列表中靠前的成员
+        for member in member_list:
+            for name in (member.get("display_name"), member.get("nickname")):
+                if name:
+                    index.setdefault(name, member["wxid"])
+        return index
+
+    def get_nickname(self, wxid):
+        contact = self.contacts.get(wxid)
+        return contact.get("nickname") if contact else None
+
+    def get_room_name(self, room_wxid):
+        room = self.rooms.get(room_wxid)
+        return room.get("nickname") if room else None
+
+    def get_display_name_or_nickname(self, room_wxid, wxid):
+        member = self.room_members.get(room_wxid, {}).get(wxid)
+        if member is None:
+            return None
+        return member.get("display_name") or member.get("nickname")
+
+    def get_wxid_by_name(self, room_wxid, name):
+        return self.room_name_index.get(room_wxid, {}).get(name)
+
+    def add_room_members(self, room_wxid, member_list):
+        """处理MT_ROOM_ADD_MEMBER_NOTIFY_MSG，增量加入新成员"""
+        with self.lock:
+            members = self.room_members.setdefault(room_wxid, {})
+            name_index = self.room_name_index.setdefault(room_wxid, {})
+            for member in member_list:
+                member = dict(member)
+                member.setdefault("display_name", "")
+                members[member["wxid"]] = member
+                for name in (member.get("display_name"), member.get("nickname")):
+                    if name:
+                        name_index.setdefault(name, member["wxid"])
+        self.schedule_persist()
+
+    def remove_room_members(self, room_wxid, member_list):
+        """处理MT_ROOM_DEL_MEMBER_NOTIFY_MSG，增量移除成员"""
+        with self.lock:
+            members = self.room_members.get(room_wxid)
+            if members is None:
+                return
+            for member in member_list:
+                members.pop(member["wxid"], None)
+            self.room_name_index[room_wxid] = self._build_name_index(members.values())
+        self.schedule_persist()
+
+    def schedule_persist(self):
+        """延迟在后台线程落盘，期间的多次变更只写一次"""
+        with self.lock:
+            if self._persist_timer is not None:
+                return
+            self._persist_timer = threading.Timer(self.persist_delay, self._persist)
+            self._persist_timer.daemon = True
+            self._persist_timer.start()
+
+    def _persist(self):
+        with self.lock:
+            self._persist_timer = None
+            contacts = list(self.contacts.values())
+            rooms = list(self.rooms.values())
+            room_members = {room_wxid: {"member_list": list(members.values())} for room_wxid, members in self.room_members.items()}
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(os.path.join(self.directory, "wx_contacts.json"), "w", encoding="utf-8") as f:
+                json.dump(contacts, f, ensure_ascii=False, indent=4)
+            with open(os.path.join(self.directory, "wx_rooms.json"), "w", encoding="utf-8") as f:
+                json.dump(rooms, f, ensure_ascii=False, indent=4)
+            with open(os.path.join(self.directory, "wx_room_members.json"), "w", encoding="utf-8") as f:
+                json.dump(room_members, f, ensure_ascii=False, indent=4)
+            logger.debug("[WX] contact store persisted")
+        except Exception as e:
+            logger.error("[WX] contact store persist error: {}".format(e))
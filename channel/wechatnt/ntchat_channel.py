@@ -1,17 +1,16 @@
-import io
 import os.path
 import time
 import random
 import threading
-import uuid
 import xml.dom.minidom
-import requests
 
 from PIL import Image
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.wechatnt.contact_store import ContactStore
 from channel.wechatnt.ntchat_message import *
+from common import media_downloader
 from common.singleton import singleton
 from common.log import logger
 from common.time_check import time_checker
@@ -19,57 +18,27 @@ from config import conf
 from channel.wechatnt.nt_run import *
 
 
-def download_and_compress_image(url, filename, quality=80):
-    # 确定保存图片的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def download_and_compress_image(url, quality=80):
+    # 下载图片，相同内容的压缩结果保存在缓存目录中复用
+    image_path = media_downloader.download(url)
 
-    # 下载图片
-    response = requests.get(url)
-    image = Image.open(io.BytesIO(response.content))
+    def compress(src, dst):
+        Image.open(src).save(dst, "JPEG", quality=quality)
 
-    # 压缩图片
-    image_path = os.path.join(directory, f"{filename}.jpg")
-    image.save(image_path, "JPEG", quality=quality)
+    return media_downloader.derive(image_path, ".q{}.jpg".format(quality), compress)
 
-    return image_path
 
+def download_video(url):
+    # 下载视频，超过300MB时跳过并返回None
+    try:
+        return media_downloader.download(url, max_size=300 * 1024 * 1024, suffix=".mp4")
+    except media_downloader.MediaTooLarge:
+        logger.info("[WX] Video is larger than 300MB, skipping...")
+        return None
 
-def download_video(url, filename):
-    # 确定保存视频的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
 
-    # 下载视频
-    response = requests.get(url, stream=True)
-    total_size = 0
-
-    video_path = os.path.join(directory, f"{filename}.mp4")
-
-    with open(video_path, 'wb') as f:
-        for block in response.iter_content(1024):
-            total_size += len(block)
-
-            # 如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
-            if total_size > 300 * 1024 * 1024:
-                logger.info("[WX] Video is larger than 30MB, skipping...")
-                return None
-
-            f.write(block)
-
-    return video_path
-
-
-def get_wxid_by_name(room_members, group_wxid, name):
-    if group_wxid in room_members:
-        for member in room_members[group_wxid]['member_list']:
-            if member['display_name'] == name or member['nickname'] == name:
-                return member['wxid']
-    return None  # 如果没有找到对应的group_wxid或name，则返回None
+def get_wxid_by_name(group_wxid, name):
+    return ContactStore().get_wxid_by_name(group_wxid, name)  # 如果没有找到对应的group_wxid或name，则返回None
 
 
 def _check(func):
@@ -79,7 +48,7 @@ def _check(func):
         if create_time is None:
             return func(self, cmsg)
         if int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[WX]history message {} skipped".format(msgId))
+            logger.debug("[WX]history message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -90,7 +59,7 @@ def _check(func):
                         ntchat.MT_RECV_VOICE_MSG, ntchat.MT_ROOM_ADD_MEMBER_NOTIFY_MSG, ntchat.MT_RECV_EMOJI_MSG,ntchat.MT_RECV_OTHER_APP_MSG,ntchat.MT_RECV_OTHER_MSG,
                         ntchat.MT_RECV_SYSTEM_MSG,ntchat.MT_RECV_WCPAY_MSG,ntchat.MT_RECV_VIDEO_MSG,ntchat.MT_RECV_MINIAPP_MSG,ntchat.MT_ROOM_DEL_MEMBER_NOTIFY_MSG])
 def all_msg_handler(wechat_instance: ntchat.WeChat, message):
-    logger.debug(f"收到消息: {message}")
+    logger.debug("收到消息: %s", message)
     if message["data"]["room_wxid"]:
         try:
             cmsg = NtchatMessage(wechat_instance, message, True)
@@ -110,7 +79,7 @@ def all_msg_handler(wechat_instance: ntchat.WeChat, message):
         NtchatChannel().handle_group(cmsg)
     else:
         NtchatChannel().handle_single(cmsg)
-    logger.debug(f"收到cmsg: {cmsg}")
+    logger.debug("收到cmsg: %s", cmsg)
     return None
 
 
@@ -137,6 +106,7 @@ def on_recv_text_msg(wechat_instance: ntchat.WeChat, message):
 @singleton
 class NtchatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
@@ -147,33 +117,8 @@ class NtchatChannel(ChatChannel):
         wechatnt.wait_login()
         logger.info("等待登录······")
         login_info = wechatnt.get_login_info()
-        contacts = wechatnt.get_contacts()
-        directory = os.path.join(os.getcwd(), "tmp")
-        rooms = wechatnt.get_rooms()
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        # 将contacts保存到json文件中
-        with open(os.path.join(directory, 'wx_contacts.json'), 'w', encoding='utf-8') as f:
-            json.dump(contacts, f, ensure_ascii=False, indent=4)
-        with open(os.path.join(directory, 'wx_rooms.json'), 'w', encoding='utf-8') as f:
-            json.dump(rooms, f, ensure_ascii=False, indent=4)
-        # 创建一个空字典来保存结果
-        result = {}
-
-        # 遍历列表中的每个字典
-        for room in rooms:
-            # 获取聊天室ID
-            room_wxid = room['wxid']
-
-            # 获取聊天室成员
-            room_members = wechatnt.get_room_members(room_wxid)
-
-            # 将聊天室成员保存到结果字典中
-            result[room_wxid] = room_members
-
-        # 将结果保存到json文件中
-        with open(os.path.join(directory, 'wx_room_members.json'), 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=4)
+        # 联系人、群及群成员只在启动时全量加载一次，之后由进群/退群通知增量更新
+        ContactStore().load(wechatnt)
         self.user_id = login_info['wxid']
         self.name = login_info['nickname']
         logger.info(f"登录信息:>>>user_id:{self.user_id}>>>>>>>>name:{self.name}")
@@ -186,21 +131,21 @@ class NtchatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.VIDEO:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", cmsg._rawmsg, cmsg)
         elif cmsg.ctype == ContextType.QUOTE:
-            logger.debug("[WX]receive quote msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive quote msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.MP_LINK:
-            logger.debug("[WX]receive mp_link msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive mp_link msg: %s", cmsg.content)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -225,11 +170,11 @@ class NtchatChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice for group msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image for group msg: %s", cmsg.content)
         elif cmsg.ctype in [ContextType.LEAVE_GROUP, ContextType.JOIN_GROUP, ContextType.EXIT_GROUP, ContextType.PATPAT]:
-            logger.debug("[WX]receive note msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive note msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
             pass
         elif cmsg.ctype == ContextType.QUOTE:
@@ -239,7 +184,7 @@ class NtchatChannel(ChatChannel):
         elif cmsg.ctype == ContextType.MP_LINK:
             pass
         else:
-            logger.debug("[WX]receive group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive group msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg)
         if context:
             self.produce(context)
@@ -251,11 +196,7 @@ class NtchatChannel(ChatChannel):
             match = re.search(r"^@(.*?)\n", reply.content)
             if match:
                 name = match.group(1)  # 获取第一个组的内容，即名字
-                directory = os.path.join(os.getcwd(), "tmp")
-                file_path = os.path.join(directory, "wx_room_members.json")
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    room_members = json.load(file)
-                wxid = get_wxid_by_name(room_members, receiver, name)
+                wxid = get_wxid_by_name(receiver, name)
                 wxid_list = [wxid]
                 wechatnt.send_room_at_msg(receiver, reply.content, wxid_list)
             else:
@@ -263,15 +204,14 @@ class NtchatChannel(ChatChannel):
             logger.info("[WX] sendMsg={}, receiver={}".format(reply, receiver))
             if context.get("isgroup", False):
                 wait_seconds = random.uniform(conf().get("group_chat_reply_wait_min", 0), conf().get("group_chat_reply_wait_max", 0))
-                logger.debug(f"[WX] delay {wait_seconds} seconds to process the next message ...")
+                logger.debug("[WX] delay %s seconds to process the next message ...", wait_seconds)
                 time.sleep(wait_seconds)
         elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
             wechatnt.send_text(receiver, reply.content)
             logger.info("[WX] sendMsg={}, receiver={}".format(reply, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            filename = str(uuid.uuid4())
-            image_path = download_and_compress_image(img_url, filename)
+            image_path = download_and_compress_image(img_url)
             wechatnt.send_image(receiver, file_path=image_path)
             logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
@@ -285,9 +225,8 @@ class NtchatChannel(ChatChannel):
             logger.info("[WX] sendFile={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.VIDEO_URL:
             video_url = reply.content
-            filename = str(uuid.uuid4())
             # 调用你的函数，下载视频并保存为本地文件
-            video_path = download_video(video_url, filename)
+            video_path = download_video(video_url)
             if video_path is None:
                 # 如果视频太大，下载可能会被跳过，此时 video_path 将为 None
                 wechatnt.send_text(receiver, "抱歉，视频太大了！！！")
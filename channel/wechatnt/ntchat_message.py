@@ -6,6 +6,7 @@ import time
 import xml.etree.ElementTree as ET
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
+from channel.wechatnt.contact_store import ContactStore
 from channel.wechatnt.nt_run import wechatnt
 from channel.wechatnt.WechatImageDecoder import WechatImageDecoder
 from common.log import logger
@@ -64,19 +65,12 @@ def ensure_file_ready(file_path, timeout=10, interval=0.5):
             time.sleep(interval)
 
 
-def get_nickname(contacts, wxid):
-    for contact in contacts:
-        if contact['wxid'] == wxid:
-            return contact['nickname']
-    return None  # 如果没有找到对应的wxid，则返回None
+def get_nickname(wxid):
+    return ContactStore().get_nickname(wxid)  # 如果没有找到对应的wxid，则返回None
 
 
-def get_display_name_or_nickname(room_members, group_wxid, wxid):
-    if group_wxid in room_members:
-        for member in room_members[group_wxid]['member_list']:
-            if member['wxid'] == wxid:
-                return member['display_name'] if member['display_name'] else member['nickname']
-    return None  # 如果没有找到对应的group_wxid或wxid，则返回None
+def get_display_name_or_nickname(group_wxid, wxid):
+    return ContactStore().get_display_name_or_nickname(group_wxid, wxid)  # 如果没有找到对应的group_wxid或wxid，则返回None
 
 
 class NtchatMessage(ChatMessage):
@@ -89,19 +83,13 @@ class NtchatMessage(ChatMessage):
             self.wechat = wechat
 
             # 获取一些可能多次使用的值
-            current_dir = os.getcwd()
             login_info = self.wechat.get_login_info()
             nickname = login_info['nickname']
             user_id = login_info['wxid']
 
-            # 从文件读取数据，并构建以 wxid 为键的字典
-            with open(os.path.join(current_dir, "tmp", 'wx_contacts.json'), 'r', encoding='utf-8') as f:
-                contacts = {contact['wxid']: contact['nickname'] for contact in json.load(f)}
-            with open(os.path.join(current_dir, "tmp", 'wx_rooms.json'), 'r', encoding='utf-8') as f:
-                rooms = {room['wxid']: room['nickname'] for room in json.load(f)}
             data = wechat_msg['data']
             self.from_user_id = data.get('from_wxid', data.get("room_wxid"))
-            self.from_user_nickname = contacts.get(self.from_user_id)
+            self.from_user_nickname = get_nickname(self.from_user_id)
             self.to_user_id = user_id
             self.to_user_nickname = nickname
             self.other_user_nickname = self.from_user_nickname
@@ -140,12 +128,7 @@ class NtchatMessage(ChatMessage):
                 self.content = emoji_path
                 self._prepare_fn = lambda: None
                 if self.is_group:
-                    directory = os.path.join(os.getcwd(), "tmp")
-                    file_path = os.path.join(directory, "wx_room_members.json")
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        room_members = json.load(file)
-                    self.from_user_nickname = get_display_name_or_nickname(room_members, data.get('room_wxid'),
-                                                                           self.from_user_id)
+                    self.from_user_nickname = get_display_name_or_nickname(data.get('room_wxid'), self.from_user_id)
             elif wechat_msg["type"] == 11054:  # 分享链接消息类型
                 xmlContent = data["raw_msg"]
                 from_wxid = data["from_wxid"]
@@ -176,12 +159,7 @@ class NtchatMessage(ChatMessage):
                     self.ctype = ContextType.PATPAT
                     self.content = data.get('raw_msg')
                     if self.is_group:
-                        directory = os.path.join(os.getcwd(), "tmp")
-                        file_path = os.path.join(directory, "wx_room_members.json")
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            room_members = json.load(file)
-                        self.actual_user_nickname = get_display_name_or_nickname(room_members, data.get('room_wxid'),
-                                                                                 self.from_user_id)
+                        self.actual_user_nickname = get_display_name_or_nickname(data.get('room_wxid'), self.from_user_id)
                 else:
                     self.content = data.get('raw_msg')
                     if "移出了群聊" in self.content:
@@ -232,12 +210,7 @@ class NtchatMessage(ChatMessage):
 
                     if refermsg is not None:
                         if self.is_group:
-                            directory = os.path.join(os.getcwd(), "tmp")
-                            file_path = os.path.join(directory, "wx_room_members.json")
-                            with open(file_path, 'r', encoding='utf-8') as file:
-                                room_members = json.load(file)
-                            self.actual_user_nickname = get_display_name_or_nickname(room_members, data.get('room_wxid'),
-                                                                                     self.from_user_id)
+                            self.actual_user_nickname = get_display_name_or_nickname(data.get('room_wxid'), self.from_user_id)
                             self.content = msg.text
                             self.to_user_id = refwxid.text
                             self.ctype = ContextType.QUOTE
@@ -254,28 +227,19 @@ class NtchatMessage(ChatMessage):
                 self.ctype = ContextType.JOIN_GROUP
                 self.actual_user_nickname = data['member_list'][0]['nickname']
                 self.content = f"{self.actual_user_nickname}加入了群聊！"
-                directory = os.path.join(os.getcwd(), "tmp")
-                result = {}
-                for room_wxid in rooms.keys():
-                    room_members = wechatnt.get_room_members(room_wxid)
-                    result[room_wxid] = room_members
-                with open(os.path.join(directory, 'wx_room_members.json'), 'w', encoding='utf-8') as f:
-                    json.dump(result, f, ensure_ascii=False, indent=4)
+                ContactStore().add_room_members(data.get('room_wxid'), data['member_list'])
             elif wechat_msg["type"] == 11099:    #  退群通知
                 self.ctype = ContextType.LEAVE_GROUP
                 self.actual_user_nickname = data['member_list'][0]['nickname']
                 self.content = f"{self.actual_user_nickname}退出了群聊！"
+                ContactStore().remove_room_members(data.get('room_wxid'), data['member_list'])
 
             else:
                 raise NotImplementedError(
                     "Unsupported message type: Type:{} MsgType:{}".format(wechat_msg["type"], wechat_msg["type"]))
 
             if self.is_group:
-                directory = os.path.join(os.getcwd(), "tmp")
-                file_path = os.path.join(directory, "wx_room_members.json")
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    room_members = json.load(file)
-                self.other_user_nickname = rooms.get(data.get('room_wxid'))
+                self.other_user_nickname = ContactStore().get_room_name(data.get('room_wxid'))
                 self.other_user_id = data.get('room_wxid')
                 if self.from_user_id:
                     at_list = data.get('at_user_list', [])
@@ -285,13 +249,12 @@ class NtchatMessage(ChatMessage):
                     self.is_at |= bool(re.search(pattern, content))
                     self.actual_user_id = self.from_user_id
                     if not self.actual_user_nickname:
-                        self.actual_user_nickname = get_display_name_or_nickname(room_members, data.get('room_wxid'),
-                                                                                 self.from_user_id)
+                        self.actual_user_nickname = get_display_name_or_nickname(data.get('room_wxid'), self.from_user_id)
 
                 else:
                     logger.error("群聊消息中没有找到 conversation_id 或 room_wxid")
 
-            logger.debug(f"WechatMessage has be en successfully instantiated with message id: {self.msg_id}")
+            logger.debug("WechatMessage has be en successfully instantiated with message id: %s", self.msg_id)
         except Exception as e:
             logger.error(f"在 WechatMessage 的初始化过程中出现错误：{e}")
             raise e
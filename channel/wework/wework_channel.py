@@ -5,14 +5,13 @@ import tempfile
 import threading
 os.environ['ntwork_LOG'] = "ERROR"
 import ntwork
-import requests
-import uuid
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wework.wework_message import *
 from channel.wework.wework_message import WeworkMessage
+from common import media_downloader
 from common.singleton import singleton
 from common.log import logger
 from common.time_check import time_checker
@@ -31,78 +30,49 @@ def get_wxid_by_name(room_members, group_wxid, name):
     return None  # 如果没有找到对应的group_wxid或name，则返回None
 
 
-def download_and_compress_image(url, filename, quality=30):
-    # 确定保存图片的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def download_and_compress_image(url, quality=30):
+    # 下载图片，相同内容的转换结果保存在缓存目录中复用
+    image_path = media_downloader.download(url)
 
-    # 下载图片
-    pic_res = requests.get(url, stream=True)
-    image_storage = io.BytesIO()
-    for block in pic_res.iter_content(1024):
-        image_storage.write(block)
+    def compress(src, dst):
+        with open(src, "rb") as f:
+            image_storage = io.BytesIO(f.read())
+        # 检查图片大小并可能进行压缩
+        sz = fsize(image_storage)
+        if sz >= 10 * 1024 * 1024:  # 如果图片大于 10 MB
+            logger.info("[wework] image too large, ready to compress, sz={}".format(sz))
+            image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
+            logger.info("[wework] image compressed, sz={}".format(fsize(image_storage)))
+        # 将内存缓冲区的指针重置到起始位置
+        image_storage.seek(0)
+        Image.open(image_storage).save(dst, "png")
 
-    # 检查图片大小并可能进行压缩
-    sz = fsize(image_storage)
-    if sz >= 10 * 1024 * 1024:  # 如果图片大于 10 MB
-        logger.info("[wework] image too large, ready to compress, sz={}".format(sz))
-        image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-        logger.info("[wework] image compressed, sz={}".format(fsize(image_storage)))
+    return media_downloader.derive(image_path, ".wework.png", compress)
 
-    # 将内存缓冲区的指针重置到起始位置
-    image_storage.seek(0)
 
-    # 读取并保存图片
-    image = Image.open(image_storage)
-    image_path = os.path.join(directory, f"{filename}.png")
-    image.save(image_path, "png")
-
-    return image_path
-
-
-def download_video(url, filename):
-    # 确定保存视频的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    # 下载视频
-    response = requests.get(url, stream=True)
-    total_size = 0
-
-    video_path = os.path.join(directory, f"{filename}.mp4")
-
-    with open(video_path, 'wb') as f:
-        for block in response.iter_content(1024):
-            total_size += len(block)
-
-            # 如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
-            if total_size > 30 * 1024 * 1024:
-                logger.info("[WX] Video is larger than 30MB, skipping...")
-                return None
-
-            f.write(block)
-
-    return video_path
+def download_video(url):
+    # 下载视频，超过30MB时跳过并返回None
+    try:
+        return media_downloader.download(url, max_size=30 * 1024 * 1024, suffix=".mp4")
+    except media_downloader.MediaTooLarge:
+        logger.info("[WX] Video is larger than 30MB, skipping...")
+        return None
 
 
 def create_message(wework_instance, message, is_group):
-    logger.debug(f"正在为{'群聊' if is_group else '单聊'}创建 WeworkMessage")
+    logger.debug("正在为%s创建 WeworkMessage", '群聊' if is_group else '单聊')
     cmsg = WeworkMessage(message, wework=wework_instance, is_group=is_group)
-    logger.debug(f"cmsg:{cmsg}")
+    logger.debug("cmsg:%s", cmsg)
     return cmsg
 
 
 def handle_message(cmsg, is_group):
-    logger.debug(f"准备用 WeworkChannel 处理{'群聊' if is_group else '单聊'}消息")
+    logger.debug("准备用 WeworkChannel 处理%s消息", '群聊' if is_group else '单聊')
     if is_group:
         WeworkChannel().handle_group(cmsg)
     else:
         WeworkChannel().handle_single(cmsg)
-    logger.debug(f"已用 WeworkChannel 处理完{'群聊' if is_group else '单聊'}消息")
+    logger.debug("已用 WeworkChannel 处理完%s消息", '群聊' if is_group else '单聊')
 
 
 def _check(func):
@@ -112,7 +82,7 @@ def _check(func):
         if create_time is None:
             return func(self, cmsg)
         if int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[WX]history message {} skipped".format(msgId))
+            logger.debug("[WX]history message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -122,7 +92,7 @@ def _check(func):
 @wework.msg_register(
     [ntwork.MT_RECV_TEXT_MSG, ntwork.MT_RECV_IMAGE_MSG, 11072, ntwork.MT_RECV_LINK_CARD_MSG,ntwork.MT_RECV_FILE_MSG, ntwork.MT_RECV_VOICE_MSG])
 def all_msg_handler(wework_instance: ntwork.WeWork, message):
-    logger.debug(f"收到消息: {message}")
+    logger.debug("收到消息: %s", message)
     if 'data' in message:
         # 首先查找conversation_id，如果没有找到，则查找room_conversation_id
         conversation_id = message['data'].get('conversation_id', message['data'].get('room_conversation_id'))
@@ -144,7 +114,7 @@ def all_msg_handler(wework_instance: ntwork.WeWork, message):
 
 def accept_friend_with_retries(wework_instance, user_id, corp_id):
     result = wework_instance.accept_friend(user_id, corp_id)
-    logger.debug(f'result:{result}')
+    logger.debug("result:%s", result)
 
 
 # @wework.msg_register(ntwork.MT_RECV_FRIEND_MSG)
@@ -175,6 +145,7 @@ def get_with_retry(get_func, max_retries=5, delay=5):
 @singleton
 class WeworkChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
@@ -233,15 +204,15 @@ class WeworkChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", cmsg._rawmsg, cmsg)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -252,31 +223,31 @@ class WeworkChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice for group msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image for group msg: %s", cmsg.content)
         elif cmsg.ctype in [ContextType.JOIN_GROUP, ContextType.PATPAT]:
-            logger.debug("[WX]receive note msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive note msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
             pass
         else:
-            logger.debug("[WX]receive group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive group msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg)
         if context:
             self.produce(context)
 
     # 统一的发送函数，每个Channel自行实现，根据reply的type字段发送不同类型的消息
     def send(self, reply: Reply, context: Context):
-        logger.debug(f"context: {context}")
+        logger.debug("context: %s", context)
         receiver = context["receiver"]
         actual_user_id = context["msg"].actual_user_id
         if reply.type == ReplyType.TEXT or reply.type == ReplyType.TEXT_:
             match = re.search(r"^@(.*?)\n", reply.content)
-            logger.debug(f"match: {match}")
+            logger.debug("match: %s", match)
             if match:
                 new_content = re.sub(r"^@(.*?)\n", "\n", reply.content)
                 at_list = [actual_user_id]
-                logger.debug(f"new_content: {new_content}")
+                logger.debug("new_content: %s", new_content)
                 wework.send_room_at_msg(receiver, new_content, at_list)
             else:
                 wework.send_text(receiver, reply.content)
@@ -300,17 +271,15 @@ class WeworkChannel(ChatChannel):
             os.remove(temp_path)
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            filename = str(uuid.uuid4())
 
             # 调用你的函数，下载图片并保存为本地文件
-            image_path = download_and_compress_image(img_url, filename)
+            image_path = download_and_compress_image(img_url)
 
             wework.send_image(receiver, file_path=image_path)
             logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.VIDEO_URL:
             video_url = reply.content
-            filename = str(uuid.uuid4())
-            video_path = download_video(video_url, filename)
+            video_path = download_video(video_url)
 
             if video_path is None:
                 # 如果视频太大，下载可能会被跳过，此时 video_path 将为 None
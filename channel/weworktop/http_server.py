@@ -1,9 +1,9 @@
 # http_server.py
+import json
 import os
 import time
-import traceback
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import json
+
+from common import webhook_server
 from common.log import logger
 message_handlers = []
 
@@ -13,27 +13,41 @@ def register_handler(func):
     return func
 
 
-class MyHTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        try:
-            content_length = int(self.headers['Content-Length'])
-            body = self.rfile.read(content_length)
-            raw_message = body.decode()
-            message = json.loads(raw_message)
-            logger.debug(f"http服务接收到信息：{message}")
-            for handler in message_handlers:
-                handler(message)
-            self.send_response(200)
-        except Exception as e:
-            traceback.print_exc()  # 打印完整的堆栈跟踪
-            self.send_response(500)
-        finally:
-            self.end_headers()
+def _handle(message):
+    for handler in message_handlers:
+        handler(message)
+
+
+def _lane_key(message):
+    # 按会话分配处理队列，消息结构不符合预期时返回None，仍然正常分发
+    inner = message.get("message") if isinstance(message, dict) else None
+    data = inner.get("data") if isinstance(inner, dict) else None
+    if not isinstance(data, dict):
+        return None
+    return data.get("conversation_id", data.get("room_conversation_id"))
+
+
+def app(environ, start_response):
+    if environ.get("REQUEST_METHOD") != "POST":
+        start_response("405 Method Not Allowed", [("Content-Length", "0")])
+        return [b""]
+    try:
+        content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(content_length)
+        message = json.loads(body.decode())
+        logger.debug("http服务接收到信息：%s", message)
+        # 立即返回200，消息在后台线程中处理
+        webhook_server.dispatch(_handle, message, key=_lane_key(message))
+        status = "200 OK"
+    except Exception as e:
+        logger.exception("[weworktop] invalid callback: {}".format(e))
+        status = "500 Internal Server Error"
+    start_response(status, [("Content-Length", "0")])
+    return [b""]
 
 
 def run_server(port=8001):
-    httpd = HTTPServer(('localhost', port), MyHTTPRequestHandler)
-    httpd.serve_forever()
+    webhook_server.serve(app, port, host="localhost", name="weworktop")
 
 
 def forever():
@@ -1,17 +1,15 @@
-import io
 import random
 import tempfile
 import threading
 import time
 
-import requests
-import uuid
 from typing import Tuple
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.weworktop.weworktop_message import *
 from channel.weworktop.weworktop_message import WeworkMessage
+from common import media_downloader
 from common.singleton import singleton
 from common.log import logger
 from common.time_check import time_checker
@@ -32,56 +30,39 @@ def get_wxid_by_name(room_members, group_wxid, name):
     return None  # 如果没有找到对应的group_wxid或name，则返回None
 
 
-def download_and_compress_image(url, filename, quality=30):
-    # 确定保存图片的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    # 下载图片
-    response = requests.get(url)
-    image = Image.open(io.BytesIO(response.content))
-    # 压缩图片
-    image_path = os.path.join(directory, f"{filename}.jpg")
-    image.save(image_path, "JPEG", quality=quality)
-    return image_path
-
-
-def download_video(url, filename):
-    # 确定保存视频的目录
-    directory = os.path.join(os.getcwd(), "tmp")
-    # 如果目录不存在，则创建目录
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    # 下载视频
-    response = requests.get(url, stream=True)
-    total_size = 0
-    video_path = os.path.join(directory, f"{filename}.mp4")
-    with open(video_path, 'wb') as f:
-        for block in response.iter_content(1024):
-            total_size += len(block)
-            # 如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
-            if total_size > 30 * 1024 * 1024:
-                logger.info("[WX] Video is larger than 30MB, skipping...")
-                return None
-            f.write(block)
-    return video_path
+def download_and_compress_image(url, quality=30):
+    # 下载图片，相同内容的压缩结果保存在缓存目录中复用
+    image_path = media_downloader.download(url)
+
+    def compress(src, dst):
+        Image.open(src).save(dst, "JPEG", quality=quality)
+
+    return media_downloader.derive(image_path, ".q{}.jpg".format(quality), compress)
+
+
+def download_video(url):
+    # 下载视频，超过30MB时跳过并返回None
+    try:
+        return media_downloader.download(url, max_size=30 * 1024 * 1024, suffix=".mp4")
+    except media_downloader.MediaTooLarge:
+        logger.info("[WX] Video is larger than 30MB, skipping...")
+        return None
 
 
 def create_message(api_client, message, is_group):
-    logger.debug(f"正在为{'群聊' if is_group else '单聊'}创建 WeworkMessage")
+    logger.debug("正在为%s创建 WeworkMessage", '群聊' if is_group else '单聊')
     cmsg = WeworkMessage(api_client, message, is_group=is_group)
-    logger.debug(f"cmsg:{cmsg}")
+    logger.debug("cmsg:%s", cmsg)
     return cmsg
 
 
 def handle_message(cmsg, is_group):
-    logger.debug(f"准备用 WeworkTopChannel 处理{'群聊' if is_group else '单聊'}消息")
+    logger.debug("准备用 WeworkTopChannel 处理%s消息", '群聊' if is_group else '单聊')
     if is_group:
         WeworkTopChannel().handle_group(cmsg)
     else:
         WeworkTopChannel().handle_single(cmsg)
-    logger.debug(f"已用 WeworkTopChannel 处理完{'群聊' if is_group else '单聊'}消息")
+    logger.debug("已用 WeworkTopChannel 处理完%s消息", '群聊' if is_group else '单聊')
 
 
 def convert_to_silk(media_path: str) -> Tuple[str, int]:
@@ -108,7 +89,7 @@ def _check(func):
         if create_time is None:
             return func(self, cmsg)
         if int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
-            logger.debug("[WX]history message {} skipped".format(msgId))
+            logger.debug("[WX]history message %s skipped", msgId)
             return
         return func(self, cmsg)
 
@@ -172,6 +153,7 @@ def all_msg_handler(message):
 @singleton
 class WeworkTopChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    STREAM_REPLY_MODE = "incremental"
 
     def __init__(self):
         super().__init__()
@@ -186,22 +168,22 @@ class WeworkTopChannel(ChatChannel):
             server_thread.daemon = True
             server_thread.start()
             callback_url = f"http://127.0.0.1:{wework_callback_port}"
-            logger.debug(f"callback_url :{callback_url}")
+            logger.debug("callback_url :%s", callback_url)
             callback_url_response = api_client.client_set_callback_url(callback_url)
             self.guid = callback_url_response['data']['guid']
             if not self.guid:
                 raise Exception("启动失败，guid为空")
-            logger.debug(f"wework guid:{self.guid}")
+            logger.debug("wework guid:%s", self.guid)
             time.sleep(5)
             response = api_client.user_get_profile(self.guid)
-            logger.debug(f"user_get_profile response:{response}")
+            logger.debug("user_get_profile response:%s", response)
             self.login_info = response['data']
             self.user_id = self.login_info['user_id']
             self.name = self.login_info['nickname'] if self.login_info['nickname'] else self.login_info['username']
             logger.info(f"登录信息:>>>user_id:{self.user_id}>>>>>>>>name:{self.name}")
 
             contacts, rooms = api_client.get_external_contacts(self.guid, 1, 50000), api_client.get_rooms(self.guid)
-            logger.debug(f"获取到的群聊信息： \n {rooms}")
+            logger.debug("获取到的群聊信息： \n %s", rooms)
             if not contacts or not rooms:
                 raise Exception("获取contacts或rooms失败")
 
@@ -240,17 +222,17 @@ class WeworkTopChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.PATPAT:
-            logger.debug("[WX]receive patpat msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive patpat msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
-            logger.debug("[WX]receive text msg: {}, cmsg={}".format(json.dumps(cmsg._rawmsg, ensure_ascii=False), cmsg))
+            logger.debug("[WX]receive text msg: %s, cmsg=%s", cmsg._rawmsg, cmsg)
         elif cmsg.ctype == ContextType.FILE:
-            logger.debug("[WX]receive file msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive file msg: %s", cmsg.content)
         else:
-            logger.debug("[WX]receive msg: {}, cmsg={}".format(cmsg.content, cmsg))
+            logger.debug("[WX]receive msg: %s, cmsg=%s", cmsg.content, cmsg)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=False, msg=cmsg)
         if context:
             self.produce(context)
@@ -261,17 +243,17 @@ class WeworkTopChannel(ChatChannel):
         if cmsg.ctype == ContextType.VOICE:
             if not conf().get("speech_recognition"):
                 return
-            logger.debug("[WX]receive voice for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive voice for group msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.IMAGE:
-            logger.debug("[WX]receive image for group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive image for group msg: %s", cmsg.content)
         elif cmsg.ctype in [ContextType.JOIN_GROUP, ContextType.PATPAT]:
-            logger.debug("[WX]receive note msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive note msg: %s", cmsg.content)
         elif cmsg.ctype == ContextType.TEXT:
             pass
         elif cmsg.ctype == ContextType.FILE:
-            logger.debug("[WX]receive file msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive file msg: %s", cmsg.content)
         else:
-            logger.debug("[WX]receive group msg: {}".format(cmsg.content))
+            logger.debug("[WX]receive group msg: %s", cmsg.content)
         context = self._compose_context(cmsg.ctype, cmsg.content, isgroup=True, msg=cmsg)
         if context:
             self.produce(context)
@@ -308,14 +290,12 @@ class WeworkTopChannel(ChatChannel):
             os.remove(temp_path)
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            filename = str(uuid.uuid4())
-            image_path = download_and_compress_image(img_url, filename)
+            image_path = download_and_compress_image(img_url)
             api_client.send_image(self.guid, receiver, image_path)
             logger.info("[WX] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.VIDEO_URL:
             video_url = reply.content
-            filename = str(uuid.uuid4())
-            video_path = download_video(video_url, filename)
+            video_path = download_video(video_url)
             if video_path is None:
                 # 如果视频太大，下载可能会被跳过，此时 video_path 将为 None
                 api_client.msg_send_text(self.guid, receiver, "抱歉，视频太大了！！！")
@@ -332,7 +312,7 @@ class WeworkTopChannel(ChatChannel):
             silk_path, duration_s = convert_to_silk(wav_path)
             file_path = os.path.join(directory, silk_path)
             data_ = api_client.cdn_upload(self.guid, file_path, 5)
-            logger.debug(f"data_:{data_}")
+            logger.debug("data_:%s", data_)
             data = data_.get('data')
             if not data:
                 api_client.send_file(self.guid, receiver, wav_path)
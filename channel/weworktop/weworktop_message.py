@@ -15,7 +15,7 @@ LOGIN_INFO_CACHE = {}
 def get_room_info(conversation_id):
     directory = os.path.join(os.getcwd(), "tmp")
     file_path = os.path.join(directory, "wework_rooms.json")
-    logger.debug(f"传入的 conversation_id: {conversation_id}")
+    logger.debug("传入的 conversation_id: %s", conversation_id)
 
     # 从文件中读取群聊信息
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -27,7 +27,7 @@ def get_room_info(conversation_id):
 
     rooms = rooms_data['data']['room_list']
 
-    logger.debug(f"获取到的群聊信息: {rooms}")
+    logger.debug("获取到的群聊信息: %s", rooms)
     for room in rooms:
         if room['conversation_id'] == conversation_id:
             return room
@@ -70,9 +70,9 @@ class WeworkMessage(ChatMessage):
         try:
             super().__init__(message)
             data = message['message']['data']
-            logger.debug(f"message data:{data}")
+            logger.debug("message data:%s", data)
             self.guid = guid = message['guid']
-            logger.debug(f"message type：{message['message']['type']}   message guid:{guid}")
+            logger.debug("message type：%s   message guid:%s", message['message']['type'], guid)
             message = message['message']
             self.msg_id = data.get('conversation_id', data.get('room_conversation_id'))
             # 使用.get()防止 'send_time' 键不存在时抛出错误
@@ -183,7 +183,7 @@ class WeworkMessage(ChatMessage):
                     name = nickname
                     pattern = f"@{re.escape(name)}(\u2005|\u0020)"
                     if re.search(pattern, content):
-                        logger.debug(f"Wechaty message {self.msg_id} includes at")
+                        logger.debug("Wechaty message %s includes at", self.msg_id)
                         self.is_at = True
 
                     if not self.actual_user_id:
@@ -192,7 +192,7 @@ class WeworkMessage(ChatMessage):
                 else:
                     logger.error("群聊消息中没有找到 conversation_id 或 room_conversation_id")
 
-            logger.debug(f"WeworkMessage has been successfully instantiated with message id: {self.msg_id}")
+            logger.debug("WeworkMessage has been successfully instantiated with message id: %s", self.msg_id)
         except Exception as e:
             logger.error(f"在 WeworkMessage 的初始化过程中出现错误：{e}")
             raise e
@@ -0,0 +1,83 @@
+"""
+配置文件监听：后台线程定期检查文件的修改时间，文件停止变化debounce秒后调用对应的重载函数，
+避免编辑器分多次写入时重复加载或读到写了一半的文件。
+"""
+
+import os
+import threading
+import time
+
+from common.log import logger
+
+
+class ConfigWatcher(object):
+    def __init__(self, interval=2, debounce=1):
+        self.interval = interval
+        self.debounce = debounce
+        self.files = {}  # path -> [handler, mtime, changed_at]
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def watch(self, path, handler):
+        with self.lock:
+            self.files[path] = [handler, self._mtime(path), None]
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+            self.thread.start()
+            logger.info("[ConfigWatcher] watching {}".format(list(self.files.keys())))
+
+    def check(self):
+        """检查一次所有文件，返回本次触发重载的文件"""
+        reloaded = []
+        now = time.monotonic()
+        with self.lock:
+            items = list(self.files.items())
+        for path, state in items:
+            handler, mtime, changed_at = state
+            current = self._mtime(path)
+            if current != mtime:
+                # 文件仍在变化，重新计时
+                state[1], state[2] = current, now
+                continue
+            if changed_at is None or now - changed_at < self.debounce:
+                continue
+            state[2] = None
+            if current is None:
+                continue  # 文件被删除时保留当前配置
+            logger.info("[ConfigWatcher] {} changed, reloading".format(path))
+            try:
+                handler()
+                reloaded.append(path)
+            except Exception as e:
+                logger.exception("[ConfigWatcher] reload {} failed: {}".format(path, e))
+        return reloaded
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+watcher = None
+
+
+def start(interval, debounce, files):
+    """
+    :param files: {path: handler}
+    """
+    global watcher
+    if watcher is None:
+        watcher = ConfigWatcher(interval, debounce)
+        for path, handler in files.items():
+            watcher.watch(path, handler)
+        watcher.start()
+    return watcher
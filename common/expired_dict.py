@@ -1,22 +1,62 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的字典，读写会刷新过期时间。
+    所有key的有效期相同，因此按最近访问排序的OrderedDict同时也是按过期时间排序的：
+    过期清理只需从头部弹出，LRU淘汰同样从头部弹出，单次操作均为O(1)。
+    :param expires_in_seconds: 过期时间
+    :param max_size: 最多保留的条目数，超出时淘汰最久未访问的条目，0或None表示不限制
+    :param on_evict: 条目因过期或超出容量被移除时的回调，参数为(key, value)，显式删除不会触发
+    """
+
+    def __init__(self, expires_in_seconds, max_size=None, on_evict=None):
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (value, expiry_time)
+        self._lock = threading.RLock()
+        _sweeper.register(self)
+
+    def _expiry_time(self):
+        return time.monotonic() + self.expires_in_seconds
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        evicted = []
+        with self._lock:
+            value, expiry_time = self._data[key]
+            now = time.monotonic()
+            if now > expiry_time:
+                del self._data[key]
+                evicted.append((key, value))
+            else:
+                self._data[key] = (value, self._expiry_time())
+                self._data.move_to_end(key)
+        if evicted:
+            self._notify(evicted)
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
         return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            self._data[key] = (value, self._expiry_time())
+            self._data.move_to_end(key)
+            evicted = self._sweep_locked()
+            if self.max_size:
+                while len(self._data) > self.max_size:
+                    evicted.append(self._popfirst_locked())
+        self._notify(evicted)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def get(self, key, default=None):
         try:
@@ -25,18 +65,100 @@ class ExpiredDict(dict):
             return default
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        # 仅判断是否存在，不刷新过期时间
+        item = self._data.get(key)
+        return item is not None and time.monotonic() <= item[1]
+
+    def __len__(self):
+        self.sweep()
+        return len(self._data)
+
+    def __iter__(self):
+        # 遍历快照，跳过已过期的条目，不修改过期时间也不删除条目
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key, (_, expiry_time) in self._data.items() if now <= expiry_time]
+        return iter(keys)
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        return list(self.__iter__())
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expiry_time) in self._data.items() if now <= expiry_time]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def sweep(self):
+        """清理已过期的条目，返回清理的数量"""
+        with self._lock:
+            evicted = self._sweep_locked()
+        self._notify(evicted)
+        return len(evicted)
+
+    def _sweep_locked(self):
+        evicted = []
+        now = time.monotonic()
+        while self._data:
+            key, (value, expiry_time) = next(iter(self._data.items()))
+            if now <= expiry_time:
+                break
+            evicted.append(self._popfirst_locked())
+        return evicted
+
+    def _popfirst_locked(self):
+        key, (value, _) = self._data.popitem(last=False)
+        return key, value
+
+    def _notify(self, evicted):
+        if not self.on_evict:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.warning("[ExpiredDict] on_evict error, key={}, err={}".format(key, e))
+
+    def __repr__(self):
+        return "{}({}, expires_in_seconds={}, max_size={})".format(type(self).__name__, dict(self.items()), self.expires_in_seconds, self.max_size)
+
+
+class _Sweeper(object):
+    """所有ExpiredDict共享的后台清理线程，保证不再被访问的条目也会按时释放"""
+
+    interval = 30
+
+    def __init__(self):
+        self.refs = []  # ExpiredDict不可哈希，用弱引用列表代替WeakSet
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, expired_dict):
+        with self.lock:
+            self.refs.append(weakref.ref(expired_dict))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="expired-dict-sweeper", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                self.refs = [ref for ref in self.refs if ref() is not None]
+                dicts = [ref() for ref in self.refs]
+            for expired_dict in dicts:
+                if expired_dict is None:
+                    continue
+                try:
+                    expired_dict.sweep()
+                except Exception as e:
+                    logger.warning("[ExpiredDict] sweep error: {}".format(e))
+
+
+_sweeper = _Sweeper()
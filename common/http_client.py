@@ -0,0 +1,119 @@
+"""
+共享的HTTP客户端注册表，按base url(scheme://host:port)复用带连接池的requests.Session，
+避免每次请求重新建立TCP/TLS连接。
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from config import conf
+
+DEFAULT_TIMEOUT = (10, 180)  # (连接超时, 读取超时)，调用方显式传入timeout时以调用方为准
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "0.0.0.0", "::1")
+
+
+class HttpClient(object):
+    def __init__(self, base_url, timeout=None, use_proxy=False, pool_size=None):
+        """
+        :param base_url: scheme://host:port
+        :param timeout: 该host的默认超时，None时使用http_host_timeouts配置或DEFAULT_TIMEOUT
+        :param use_proxy: 是否使用conf()["proxy"]代理，本机地址始终直连
+        :param pool_size: 连接池大小，None时使用http_pool_size配置
+        """
+        self.base_url = base_url
+        self.host = urlparse(base_url).hostname or ""
+        host_timeouts = conf().get("http_host_timeouts") or {}
+        if timeout is None and self.host in host_timeouts:
+            timeout = tuple(host_timeouts[self.host]) if isinstance(host_timeouts[self.host], list) else host_timeouts[self.host]
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.use_proxy = use_proxy and self.host not in LOCAL_HOSTS
+        pool_size = pool_size or conf().get("http_pool_size", 16)
+        self.session = requests.Session()
+        # 会话在所有用户间共享，不保存服务端下发的cookie
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.use_proxy and "proxies" not in kwargs:
+            proxy = conf().get("proxy")
+            if proxy:
+                kwargs["proxies"] = {"http": proxy, "https": proxy}
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """连接复用统计：requests为发出的请求数，connections为新建的连接数"""
+        num_requests = 0
+        num_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": max(num_requests - num_connections, 0),
+        }
+
+
+_clients = {}  # (base_url, options) -> HttpClient
+_lock = threading.Lock()
+
+
+def _base_url(url):
+    parsed = urlparse(url)
+    return "{}://{}".format(parsed.scheme, parsed.netloc)
+
+
+def get_client(url, **options):
+    """
+    获取url所属host的共享客户端，host和options都相同的调用方共用同一个客户端
+    :param url: 任意属于该host的url
+    :param options: 见HttpClient的参数，不同的options(如是否使用代理)使用各自的客户端和连接池
+    """
+    key = (_base_url(url), tuple(sorted(options.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = HttpClient(key[0], **options)
+                _clients[key] = client
+                logger.debug("[HttpClient] create client for %s, options=%s", key[0], options)
+    return client
+
+
+def request(method, url, **kwargs):
+    return get_client(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stats():
+    result = {}
+    for (base_url, options), client in list(_clients.items()):
+        name = base_url if not options else "{} {}".format(base_url, dict(options))
+        result[name] = client.stats()
+    return result
@@ -2,7 +2,7 @@ from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from linkai import LinkAIClient, PushMsg
-from config import conf, pconf, plugin_config, available_setting
+from config import conf, pconf, plugin_config, available_setting, update_config
 from plugins import PluginManager
 import time
 
@@ -33,17 +33,20 @@ class ChatClient(LinkAIClient):
         if config.get("enabled") != "Y":
             return
 
-        local_config = conf()
+        # 收集所有修改后一次性发布新配置
+        changes = {}
         for key in config.keys():
             if key in available_setting and config.get(key) is not None:
-                local_config[key] = config.get(key)
+                changes[key] = config.get(key)
         # 语音配置
         reply_voice_mode = config.get("reply_voice_mode")
         if reply_voice_mode:
             if reply_voice_mode == "voice_reply_voice":
-                local_config["voice_reply_voice"] = True
+                changes["voice_reply_voice"] = True
             elif reply_voice_mode == "always_reply_voice":
-                local_config["always_reply_voice"] = True
+                changes["always_reply_voice"] = True
+        if changes:
+            update_config(changes)
 
         if config.get("admin_password") and plugin_config.get("Godcmd"):
             plugin_config["Godcmd"]["password"] = config.get("admin_password")
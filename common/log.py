@@ -1,5 +1,87 @@
+"""
+日志：业务线程只把日志记录放入队列，由后台线程负责格式化和写入控制台、文件，避免在处理消息的线程中做磁盘IO。
+日志文件按大小轮转，可选输出为每行一条的JSON，配置项见 log_max_bytes、log_backup_count、log_json。
+
+调用时请使用 logger.debug("xxx=%s", value) 的形式传参，日志级别未开启时不会格式化参数；
+参数本身计算开销较大时，先判断 logger.isEnabledFor(logging.DEBUG)。
+"""
+
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import time
+
+LOG_FILE = "run.log"
+LOG_FORMAT = "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，便于日志采集系统解析。异常堆栈已由QueueHandler合并到message中"""
+
+    def format(self, record):
+        data = {
+            "time": time.strftime(DATE_FORMAT, time.localtime(record.created)),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _build_file_handler(max_bytes, backup_count, json_format):
+    if max_bytes:
+        handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    else:
+        handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+    return handler
+
+
+def _build_console_handler():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+    return handler
+
+
+class _LogPipeline(object):
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.options = None
+        self.listener = None
+
+    def start(self, max_bytes=0, backup_count=0, json_format=False):
+        """按配置(重新)创建文件输出，配置未变化时不做任何操作"""
+        options = (max_bytes, backup_count, json_format)
+        if options == self.options:
+            return
+        old_listener = self.listener
+        if old_listener:
+            # 先写完队列中已有的日志，再切换输出
+            old_listener.stop()
+            for handler in old_listener.handlers:
+                handler.close()
+        self.options = options
+        self.listener = logging.handlers.QueueListener(
+            self.queue, _build_file_handler(*options), _build_console_handler(), respect_handler_level=False
+        )
+        self.listener.start()
+
+    def stop(self):
+        if self.listener:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+            self.options = None
+
+
+_pipeline = _LogPipeline()
 
 
 def _reset_logger(log):
@@ -9,22 +91,21 @@ def _reset_logger(log):
         del handler
     log.handlers.clear()
     log.propagate = False
-    console_handle = logging.StreamHandler(sys.stdout)
-    console_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-    )
-    file_handle = logging.FileHandler("run.log", encoding="utf-8")
-    file_handle.setFormatter(
-        logging.Formatter(
-            "[%(levelname)s][%(asctime)s][%(filename)s:%(lineno)d] - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-    )
-    log.addHandler(file_handle)
-    log.addHandler(console_handle)
+    # QueueHandler在调用线程中把参数合并到消息里，避免后台线程格式化时参数对象已被修改
+    log.addHandler(logging.handlers.QueueHandler(_pipeline.queue))
+    _pipeline.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(_pipeline.stop)
+
+
+def configure_logger(max_bytes=0, backup_count=0, json_format=False):
+    """
+    加载配置后调用，设置日志文件的轮转和输出格式
+    :param max_bytes: 单个日志文件的最大字节数，超过后轮转，0表示不轮转
+    :param backup_count: 保留的历史日志文件个数
+    :param json_format: 文件日志是否输出为JSON
+    """
+    _pipeline.start(max_bytes, backup_count, json_format)
 
 
 def _get_logger():
@@ -0,0 +1,219 @@
+"""
+媒体下载服务：各通道发送网络图片、视频、文件前统一通过这里下载。
+
+- 使用http_client按host复用的连接池，以大块流式写入磁盘，不在内存中拼接整个文件
+- 读取响应体之前先检查Content-Length，超过大小限制直接放弃；没有Content-Length时边下载边检查
+- 下载在有界线程池中并行执行，同一url以相同大小限制同时只下载一次，其他调用方等待同一个结果
+- 文件按内容的sha256命名保存在缓存目录中，相同url在缓存有效期内只下载一次，
+  同一张图片发到多个群时不会重复下载；内容相同的不同url也只保存一份
+"""
+
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from common import http_client
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+CHUNK_SIZE = 256 * 1024
+CLEANUP_INTERVAL = 600
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def _suffix_of(url, content_type=None):
+    suffix = os.path.splitext(urlparse(url).path)[1].lower()
+    if suffix and len(suffix) <= 6:
+        return suffix
+    if content_type:
+        return mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return ""
+
+
+class MediaDownloader(object):
+    def __init__(self, cache_dir, max_size, workers=4, cache_ttl=86400):
+        """
+        :param cache_dir: 缓存目录
+        :param max_size: 默认的最大文件字节数，0表示不限制
+        :param workers: 并行下载的线程数
+        :param cache_ttl: 缓存文件的保留秒数
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.cache_ttl = cache_ttl
+        os.makedirs(cache_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self.index = ExpiredDict(cache_ttl)  # url -> 缓存文件路径
+        self.inflight = {}  # (url, max_size) -> Future
+        self.lock = threading.Lock()
+        self.last_cleanup = time.monotonic()
+
+    def download(self, url, max_size=None, suffix=None, timeout=None):
+        """
+        下载url到缓存目录，返回文件路径。调用方只读使用该文件，不要删除或修改
+        :param max_size: 最大字节数，None时使用默认值
+        :param suffix: 文件扩展名(如".mp4")，None时根据url或Content-Type判断
+        :raise MediaTooLarge: 文件超过大小限制
+        """
+        if max_size is None:
+            max_size = self.max_size
+        path = self.submit(url, max_size, suffix).result(timeout)
+        # 缓存或合并的下载可能使用了不同的大小限制
+        if max_size and os.path.getsize(path) > max_size:
+            raise MediaTooLarge("{} is too large, max_size={}".format(url, max_size))
+        return path
+
+    def submit(self, url, max_size=None, suffix=None):
+        """提交下载任务，返回Future"""
+        path = self.index.get(url)
+        if path and os.path.exists(path):
+            return _done_future(path)
+        if max_size is None:
+            max_size = self.max_size
+        # 大小限制不同的调用方不共用下载，否则限制较大的调用方会因为先到者的限制而失败
+        key = (url, max_size)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.pool.submit(self._download, url, max_size, suffix)
+                self.inflight[key] = future
+                future.add_done_callback(lambda _: self._finish(key))
+        return future
+
+    def prefetch(self, urls, max_size=None):
+        """并行预先下载多个url，不等待结果，之后的download直接使用缓存"""
+        for url in urls:
+            self.submit(url, max_size)
+
+    def open_bytes(self, url, max_size=None):
+        """下载url并返回内容的BytesIO"""
+        with open(self.download(url, max_size), "rb") as f:
+            return io.BytesIO(f.read())
+
+    def derive(self, path, suffix, build):
+        """
+        缓存文件的转换结果(如压缩后的图片)同样保存在缓存目录中，相同内容只转换一次
+        :param path: download返回的缓存文件路径
+        :param suffix: 转换结果的后缀，如".q80.jpg"
+        :param build: build(src_path, dst_path)，把转换结果写入dst_path
+        """
+        target = os.path.splitext(path)[0] + suffix
+        if target == path:
+            raise ValueError("derive suffix {} would overwrite the source file {}".format(suffix, path))
+        if os.path.exists(target):
+            return target
+        tmp_path = os.path.join(self.cache_dir, "{}.part".format(uuid.uuid4().hex))
+        try:
+            build(path, tmp_path)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return target
+
+    def _finish(self, key):
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def _download(self, url, max_size, suffix):
+        start = time.monotonic()
+        with http_client.get(url, stream=True) as response:
+            response.raise_for_status()
+            length = int(response.headers.get("Content-Length") or 0)
+            if max_size and length > max_size:
+                raise MediaTooLarge("{} is too large, size={}, max_size={}".format(url, length, max_size))
+            if suffix is None:
+                suffix = _suffix_of(url, response.headers.get("Content-Type"))
+            tmp_path = os.path.join(self.cache_dir, "{}.part".format(uuid.uuid4().hex))
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        size += len(chunk)
+                        if max_size and size > max_size:
+                            raise MediaTooLarge("{} is too large, max_size={}".format(url, max_size))
+                        digest.update(chunk)
+                        f.write(chunk)
+                path = os.path.join(self.cache_dir, digest.hexdigest() + suffix)
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                    os.utime(path)
+                else:
+                    os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        self.index[url] = path
+        logger.debug("[MediaDownloader] downloaded %s, size=%s, cost=%.2fs", url, size, time.monotonic() - start)
+        self._maybe_cleanup()
+        return path
+
+    def _maybe_cleanup(self):
+        if time.monotonic() - self.last_cleanup < CLEANUP_INTERVAL:
+            return
+        self.last_cleanup = time.monotonic()
+        expire_before = time.time() - self.cache_ttl
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if os.path.getmtime(path) < expire_before:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.debug("[MediaDownloader] removed %s expired files", removed)
+
+
+def _done_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+
+def get_media_downloader():
+    global _downloader
+    if _downloader is None:
+        with _downloader_lock:
+            if _downloader is None:
+                cache_dir = conf().get("media_cache_dir") or os.path.join(os.getcwd(), "tmp", "media_cache")
+                _downloader = MediaDownloader(
+                    cache_dir,
+                    conf().get("media_max_size", 100 * 1024 * 1024),
+                    conf().get("media_download_workers", 4),
+                    conf().get("media_cache_ttl", 86400),
+                )
+    return _downloader
+
+
+def download(url, max_size=None, suffix=None):
+    return get_media_downloader().download(url, max_size, suffix)
+
+
+def open_bytes(url, max_size=None):
+    return get_media_downloader().open_bytes(url, max_size)
+
+
+def derive(path, suffix, build):
+    return get_media_downloader().derive(path, suffix, build)
+
+
+def prefetch(urls, max_size=None):
+    get_media_downloader().prefetch(urls, max_size)
@@ -0,0 +1,89 @@
+"""
+上传媒体的media_id缓存：同一张图片、同一段语音发给多个接收者时，相同内容只上传一次，之后直接使用平台返回的media_id。
+
+- 按内容的sha256查找，不同路径、不同请求生成的相同文件也能复用
+- media_id的有效期按各平台规则设置，从上传时开始计算，提前一段时间视为失效
+- 同一内容并发发送时只有一个线程上传，其他线程等待后直接使用结果
+"""
+
+import hashlib
+import threading
+import time
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
+CHUNK_SIZE = 256 * 1024
+SAFETY_MARGIN = 600  # 距平台过期不足该秒数的media_id不再使用
+LOCK_COUNT = 64
+
+
+def content_hash(content):
+    """
+    计算内容的sha256
+    :param content: 文件路径、bytes或文件对象，文件对象读取后恢复原来的读取位置
+    """
+    digest = hashlib.sha256()
+    if isinstance(content, (bytes, bytearray)):
+        digest.update(content)
+    elif hasattr(content, "read"):
+        position = content.tell()
+        content.seek(0)
+        for chunk in iter(lambda: content.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+        content.seek(position)
+    else:
+        with open(content, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaIdCache(object):
+    """
+    :param name: 名称，用于日志
+    :param expires_in: 平台上media_id从上传起的有效秒数，None表示永久有效(如永久素材)
+    :param idle_seconds: 多久未被使用后移出缓存
+    :param max_size: 最多缓存的条目数，超出时移除最久未使用的条目
+    :param on_evict: 条目过期或超出容量被移除时的回调，参数为media_id，可用于删除平台上的永久素材
+    """
+
+    def __init__(self, name, expires_in=None, idle_seconds=3600, max_size=1000, on_evict=None):
+        self.name = name
+        self.expires_in = expires_in
+        self.on_evict = on_evict
+        self.entries = ExpiredDict(idle_seconds, max_size, on_evict=self._evicted)  # (kind, sha256) -> (media_id, expire_at)
+        self.locks = [threading.Lock() for _ in range(LOCK_COUNT)]
+
+    def _evicted(self, key, entry):
+        if self.on_evict:
+            self.on_evict(entry[0])
+
+    def get_or_upload(self, content, upload, kind=""):
+        """
+        返回内容对应的有效media_id，缓存中没有时调用upload上传
+        :param content: 文件路径、bytes或文件对象，用于计算内容hash
+        :param upload: 上传函数，无参数，返回media_id，失败时抛出异常
+        :param kind: 媒体类型，如image、voice，相同内容按不同类型上传时分别缓存
+        """
+        key = (kind, content_hash(content))
+        with self.locks[hash(key) % LOCK_COUNT]:
+            entry = self.entries.get(key)
+            if entry and (entry[1] is None or time.monotonic() < entry[1]):
+                logger.debug("[MediaIdCache] %s reuse %s media_id %s", self.name, kind, entry[0])
+                return entry[0]
+            media_id = upload()
+            expire_at = time.monotonic() + self.expires_in - SAFETY_MARGIN if self.expires_in else None
+            self.entries[key] = (media_id, expire_at)
+            return media_id
+
+    def invalidate(self, content, kind=""):
+        """media_id被平台拒绝时调用，下次发送重新上传"""
+        self.entries.pop((kind, content_hash(content)), None)
+
+    def drain(self):
+        """清空缓存并返回其中所有的media_id，用于退出前删除永久素材。已过期的条目照常触发on_evict"""
+        self.entries.sweep()
+        media_ids = [entry[0] for entry in self.entries.values()]
+        self.entries.clear()
+        return media_ids
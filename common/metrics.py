@@ -0,0 +1,222 @@
+"""
+进程内的轻量指标收集，用于定位消息处理链路中各阶段的耗时和吞吐。
+指标按(名称, 标签)区分，支持计数器和直方图，可导出为Prometheus文本格式，
+也可通过本地HTTP端口(metrics_port配置)供Prometheus抓取。
+"""
+
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from common.log import logger
+
+# 直方图的桶上界(秒)，覆盖从插件处理的毫秒级到模型调用的分钟级
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为+Inf桶
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """根据桶分布估算分位数，返回所在桶的上界"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, cnt in enumerate(self.counts):
+            cumulative += cnt
+            if cumulative >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> Counter
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = Counter()
+            counter.inc(value)
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            typed = set()
+            for (name, labels), counter in counters:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE {} counter".format(name))
+                lines.append("{}{} {}".format(name, _format_labels(labels), counter.value))
+            for (name, labels), histogram in histograms:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE {} histogram".format(name))
+                cumulative = 0
+                for bound, cnt in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += cnt
+                    lines.append("{}_bucket{} {}".format(name, _format_labels(labels + (("le", str(bound)),)), cumulative))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), round(histogram.sum, 6)))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """生成便于在聊天中查看的文本摘要"""
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if histogram.count == 0:
+                    continue
+                label_text = ",".join("{}={}".format(k, v) for k, v in labels)
+                lines.append(
+                    "{}{}: n={}, avg={:.3f}s, p50<={}s, p95<={}s".format(
+                        name,
+                        "[" + label_text + "]" if label_text else "",
+                        histogram.count,
+                        histogram.sum / histogram.count,
+                        histogram.quantile(0.5),
+                        histogram.quantile(0.95),
+                    )
+                )
+            for (name, labels), counter in sorted(self.counters.items()):
+                label_text = ",".join("{}={}".format(k, v) for k, v in labels)
+                lines.append("{}{}: {}".format(name, "[" + label_text + "]" if label_text else "", counter.value))
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+class timer(object):
+    """
+    记录代码块耗时到直方图name，代码块抛出异常时额外累加计数器name_errors_total
+    可作为上下文管理器或装饰器使用
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe(self.name, time.monotonic() - self.start, **self.labels)
+        if exc_type is not None:
+            inc(self.name + "_errors_total", **self.labels)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(self.name, **self.labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def render_prometheus():
+    return registry.render_prometheus()
+
+
+def summary():
+    return registry.summary()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+_server = None
+
+
+def start_server(port, host="127.0.0.1"):
+    """在后台线程启动/metrics端口，重复调用只启动一次"""
+    global _server
+    if _server is not None or not port:
+        return _server
+    try:
+        _server = _ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    except Exception as e:
+        logger.error("[Metrics] start server on {}:{} failed: {}".format(host, port, e))
+        return None
+    thread = threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("[Metrics] serving prometheus metrics on http://{}:{}/metrics".format(host, port))
+    return _server
@@ -0,0 +1,166 @@
+"""
+bot接口出错时的重试策略：指数退避+随机抖动，并遵循服务端返回的Retry-After。
+在ChatChannel的处理线程中，需要延迟的重试不会sleep占用线程，而是抛出RetryLater，
+由channel通过RetryScheduler在到期后重新提交到线程池执行；其他调用方（如插件直接调用bot）仍在当前线程等待后重试。
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from common.log import logger
+from config import conf
+
+
+class RetryLater(Exception):
+    """
+    需要延迟重试，delay秒后调用func获取结果
+    调用方可通过then追加对结果的处理，使重新执行时得到与直接调用相同的返回值
+    """
+
+    def __init__(self, delay, func):
+        super().__init__("retry in {:.1f}s".format(delay))
+        self.delay = delay
+        self.func = func
+
+    def then(self, callback):
+        func = self.func
+
+        def wrapped():
+            try:
+                result = func()
+            except RetryLater as e:
+                # 重试时再次需要延迟，后续处理跟随到新的RetryLater上
+                raise e.then(callback)
+            return callback(result)
+
+        self.func = wrapped
+        return self
+
+
+_local = threading.local()
+
+
+class deferrable(object):
+    """
+    在此范围内，bot的延迟重试以RetryLater抛出交由调用方调度
+    :param deadline: time.monotonic()时间戳，重试预计超过该时间时放弃重试
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = (getattr(_local, "deferrable", False), getattr(_local, "deadline", None))
+        _local.deferrable = True
+        _local.deadline = self.deadline
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.deferrable, _local.deadline = self.previous
+        return False
+
+
+class with_deadline(deferrable):
+    """只沿用截止时间，重试仍在当前线程等待。用于在其他线程中代为执行的调用(如对冲请求)"""
+
+    def __enter__(self):
+        super().__enter__()
+        _local.deferrable = False
+        return self
+
+
+def current_deadline():
+    return getattr(_local, "deadline", None)
+
+
+def parse_retry_after(value):
+    """解析Retry-After头，支持秒数和HTTP日期两种格式"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+
+def get_retry_after(e):
+    """从openai或requests的异常中获取Retry-After，没有时返回None"""
+    headers = getattr(e, "headers", None)
+    if headers is None and getattr(e, "response", None) is not None:
+        headers = getattr(e.response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return parse_retry_after(headers.get("Retry-After") or headers.get("retry-after"))
+    except Exception:
+        return None
+
+
+def backoff(attempt, base_delay=None, max_delay=None, retry_after=None):
+    """
+    计算第attempt次(从0开始)重试前的等待时间
+    指数增长并在[delay/2, delay]内随机抖动，避免同时失败的请求同时重试；服务端给出Retry-After时不早于该时间
+    """
+    base_delay = base_delay if base_delay is not None else conf().get("retry_base_delay", 2)
+    max_delay = max_delay if max_delay is not None else conf().get("retry_max_delay", 60)
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def retry(delay, func, fallback=None):
+    """
+    delay秒后重试func
+    在deferrable范围内抛出RetryLater，否则在当前线程等待后直接调用；预计超过截止时间时放弃重试，返回fallback
+    """
+    deadline = getattr(_local, "deadline", None)
+    if deadline is not None and time.monotonic() + delay > deadline:
+        logger.warn("[Retry] retry in {:.1f}s would exceed the deadline, give up".format(delay))
+        return fallback
+    if getattr(_local, "deferrable", False):
+        raise RetryLater(delay, func)
+    time.sleep(delay)
+    return func()
+
+
+class RetryScheduler(object):
+    """单个后台线程维护的定时任务队列，到期后执行回调，回调应尽快返回（通常只是提交到线程池）"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tasks = []  # (due_time, seq, callback)
+        self.counter = itertools.count()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        with self.cond:
+            heapq.heappush(self.tasks, (time.monotonic() + delay, next(self.counter), callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.tasks or self.tasks[0][0] > time.monotonic():
+                    self.cond.wait(self.tasks[0][0] - time.monotonic() if self.tasks else None)
+                _, _, callback = heapq.heappop(self.tasks)
+            try:
+                callback()
+            except Exception as e:
+                logger.exception("[Retry] scheduled callback error: {}".format(e))
+
+
+scheduler = RetryScheduler()
@@ -1,39 +1,103 @@
 import threading
 import time
+from collections import OrderedDict
+
+
+class RateLimiter(object):
+    """
+    多key的令牌桶限流器，令牌按距离上次访问的时间差惰性补充，不需要后台线程。
+    同一个实例可以同时按用户、群、api_key等不同维度限流，每个key独立计数。
+    :param rate_per_minute: 每分钟补充的令牌数
+    :param capacity: 桶容量，即允许的突发量，默认与rate_per_minute相同
+    :param max_keys: 最多记录的key数量，超出时丢弃最久未访问的key（空闲足够久的桶本就是满的）
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, max_keys=10000):
+        self.rate = float(rate_per_minute) / 60  # 每秒补充的令牌数
+        self.capacity = float(capacity or rate_per_minute)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> [tokens, last_time]
+        self.lock = threading.Lock()
+
+    def _refill(self, key, now):
+        # 需持有self.lock调用，返回补充后的桶
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [self.capacity, now]
+            self.buckets[key] = bucket
+            if self.max_keys and len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def _wait_time(self, bucket, cost):
+        if bucket[0] >= cost:
+            return 0
+        if self.rate <= 0:
+            return float("inf")
+        return (cost - bucket[0]) / self.rate
+
+    def try_acquire(self, key=None, cost=1):
+        """非阻塞获取令牌，令牌不足时立即返回False"""
+        return self.acquire(key, cost, timeout=0)
+
+    def acquire(self, key=None, cost=1, timeout=None):
+        """
+        获取cost个令牌，令牌不足时最多等待timeout秒，timeout为None表示一直等待
+        :return: 是否获取成功
+        """
+        cost = min(cost, self.capacity)  # 超过桶容量的请求在桶满时放行，避免永远无法获取
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                bucket = self._refill(key, now)
+                wait = self._wait_time(bucket, cost)
+                if wait == 0:
+                    bucket[0] -= cost
+                    return True
+            if deadline is not None:
+                remaining = deadline - now
+                if remaining <= 0 or wait > remaining:
+                    return False
+            time.sleep(wait)
+
+    def consume(self, key=None, cost=1):
+        """
+        直接扣除令牌，允许扣成负数，用于请求完成后按实际用量（如回复的token数）记账，
+        欠下的令牌会让后续请求等待相应的时间
+        """
+        with self.lock:
+            bucket = self._refill(key, time.monotonic())
+            bucket[0] -= cost
+
+    def available(self, key=None):
+        with self.lock:
+            return self._refill(key, time.monotonic())[0]
+
+    def wait_time(self, key=None, cost=1):
+        """获取cost个令牌还需要等待的秒数"""
+        with self.lock:
+            bucket = self._refill(key, time.monotonic())
+            return self._wait_time(bucket, min(cost, self.capacity))
 
 
 class TokenBucket:
+    """单key的令牌桶，保留原有接口，内部使用RateLimiter"""
+
     def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
-        self.rate = int(tpm) / 60  # 令牌每秒生成速率
+        self.limiter = RateLimiter(tpm)
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
+
+    def get_token(self, cost=1):
         """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
-        return True
+        return self.limiter.acquire(None, cost, self.timeout)
 
     def close(self):
-        self.is_running = False
+        pass
 
 
 if __name__ == "__main__":
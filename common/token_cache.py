@@ -0,0 +1,106 @@
+"""
+访问凭证缓存：飞书tenant_access_token、百度access_token、阿里云token等有过期时间的凭证在过期前一直复用，
+不在每次请求时重新获取。
+
+- 距过期不足refresh_ahead秒时返回当前凭证，同时在后台线程中提前刷新
+- 凭证已过期或不存在时同步获取，并发的获取合并为一次请求，其他线程等待结果
+- 后台刷新失败后FAILURE_BACKOFF秒内不再后台刷新，避免凭证服务异常时每次get都发起请求
+- 凭证被服务端拒绝(如返回token失效的错误码)时，调用方调用invalidate，下次get重新获取
+"""
+
+import threading
+import time
+
+from common.log import logger
+
+FAILURE_BACKOFF = 30
+
+
+class TokenCache(object):
+    """
+    :param name: 名称，用于日志
+    :param fetch: 获取凭证的函数，返回(token, expires_in)，expires_in为有效秒数；获取失败时抛出异常
+    :param refresh_ahead: 距过期不足该秒数时在后台提前刷新
+    :param safety_margin: 提前该秒数视为已过期，避免凭证在请求途中失效
+    """
+
+    def __init__(self, name, fetch, refresh_ahead=300, safety_margin=60):
+        self.name = name
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.safety_margin = safety_margin
+        self.token = None
+        self.expire_at = 0
+        self.refresh_at = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.failed_at = None  # 最近一次后台刷新失败的时间
+
+    def _valid(self, now):
+        return self.token is not None and now < self.expire_at
+
+    def get(self):
+        now = time.monotonic()
+        if self._valid(now):
+            if now >= self.refresh_at and (self.failed_at is None or now - self.failed_at >= FAILURE_BACKOFF):
+                self._refresh_in_background()
+            return self.token
+        with self.lock:
+            # 等待锁期间可能已由其他线程获取
+            if not self._valid(time.monotonic()):
+                self._refresh_locked()
+            return self.token
+
+    def invalidate(self):
+        """凭证被服务端拒绝时调用，下次get重新获取"""
+        with self.lock:
+            self.token = None
+
+    def _refresh_locked(self):
+        token, expires_in = self.fetch()
+        if not token:
+            raise Exception("[TokenCache] {} fetch returned empty token".format(self.name))
+        now = time.monotonic()
+        expires_in = float(expires_in or 0)
+        self.token = token
+        self.expire_at = now + max(expires_in - self.safety_margin, 0)
+        self.refresh_at = now + max(expires_in - self.refresh_ahead, 0)
+        self.failed_at = None
+        logger.debug("[TokenCache] %s refreshed, expires_in=%s", self.name, expires_in)
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh, name="token-refresh", daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                if time.monotonic() >= self.refresh_at:
+                    self._refresh_locked()
+        except Exception as e:
+            # 当前凭证仍然有效，等待FAILURE_BACKOFF秒后再尝试刷新
+            self.failed_at = time.monotonic()
+            logger.warning("[TokenCache] {} refresh failed: {}".format(self.name, e))
+        finally:
+            self.refreshing = False
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_token_cache(key, fetch, refresh_ahead=300, safety_margin=60):
+    """
+    按key返回共享的TokenCache，相同凭证(如相同的app_id)的调用方共用一个缓存
+    :param key: 凭证标识，建议包含服务名和app_id
+    """
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = _caches[key] = TokenCache(key, fetch, refresh_ahead, safety_margin)
+    return cache
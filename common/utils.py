@@ -51,6 +51,43 @@ def split_string_by_utf8_length(string, max_length, max_split=0):
     return result
 
 
+SENTENCE_ENDINGS = "。！？!?；;\n"
+
+
+def _is_sentence_end(text, i):
+    if text[i] in SENTENCE_ENDINGS:
+        return True
+    # 英文句号后面需要跟空白才算句子结尾，避免从小数、网址、缩写中间切开
+    return text[i] == "." and i + 1 < len(text) and text[i + 1].isspace()
+
+
+def split_stream_by_sentence(text_iter, min_length=20, max_length=500):
+    """
+    将流式返回的文本片段重新切分为适合逐条发送的段落
+    :param text_iter: 文本片段的迭代器
+    :param min_length: 每段的最小长度，不足时即使遇到句子结尾也继续累积
+    :param max_length: 每段的最大长度，超过时即使没有句子结尾也强制切分
+    """
+    buffer = ""
+    for text in text_iter:
+        buffer += text
+        while len(buffer) >= min_length:
+            cut = 0
+            for i in range(min(len(buffer), max_length) - 1, min_length - 2, -1):
+                if _is_sentence_end(buffer, i):
+                    cut = i + 1
+                    break
+            if not cut and len(buffer) >= max_length:
+                cut = max_length
+            if not cut:
+                break
+            chunk, buffer = buffer[:cut], buffer[cut:]
+            if chunk.strip():
+                yield chunk
+    if buffer.strip():
+        yield buffer
+
+
 def get_path_suffix(path):
     path = urlparse(path).path
     return os.path.splitext(path)[-1].lstrip('.')
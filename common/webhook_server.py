@@ -0,0 +1,129 @@
+"""
+回调(webhook)类通道共用的HTTP服务：公众号、企业微信应用、飞书、weworktop的消息回调。
+
+- 使用cheroot的线程池WSGI服务，支持keep-alive，线程数、连接超时、请求体大小可配置
+- 收到回调后，校验、去重等轻量处理在请求线程中完成并立即返回200，构造消息（可能需要请求接口、下载文件）
+  和生成context交给dispatch的后台线程执行，再由produce()放入消息队列；同一会话的消息由同一个线程按顺序处理
+- 进程退出时先停止接收新请求，等待处理中的请求和已提交的后台任务完成
+"""
+
+import atexit
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+from config import conf
+
+_lanes = None  # 每个lane是一个单线程的执行器
+_lanes_lock = threading.Lock()
+_counter = itertools.count()
+_servers = []
+
+
+def _get_lanes():
+    global _lanes
+    if _lanes is None:
+        with _lanes_lock:
+            if _lanes is None:
+                count = max(conf().get("webhook_dispatch_threads", 8), 1)
+                _lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook-{}".format(i)) for i in range(count)]
+    return _lanes
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.exception("[Webhook] handle message failed: {}".format(e))
+
+
+def dispatch(func, *args, key=None):
+    """
+    在后台线程中处理回调消息，异常只记录日志
+    :param key: 会话标识，相同key的消息按提交顺序处理，为None时轮流分配
+    """
+    lanes = _get_lanes()
+    index = hash(key) if key is not None else next(_counter)
+    lanes[index % len(lanes)].submit(_run, func, args)
+
+
+def _limit_body_size(wsgi_app, max_body_size):
+    """请求体超过限制时直接返回413，不读取请求体"""
+
+    def app(environ, start_response):
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        if max_body_size and length > max_body_size:
+            start_response("413 Payload Too Large", [("Content-Type", "text/plain"), ("Content-Length", "0")])
+            return [b""]
+        return wsgi_app(environ, start_response)
+
+    return app
+
+
+def _create_server(wsgi_app, host, port, name):
+    max_body_size = conf().get("webhook_max_body_size", 2 * 1024 * 1024)
+    wsgi_app = _limit_body_size(wsgi_app, max_body_size)
+    threads = conf().get("webhook_server_threads", 32)
+    try:
+        from cheroot import wsgi
+
+        server = wsgi.Server(
+            (host, int(port)),
+            wsgi_app,
+            numthreads=threads,
+            request_queue_size=conf().get("webhook_request_queue_size", 128),
+            timeout=conf().get("webhook_keepalive_timeout", 10),
+            shutdown_timeout=conf().get("webhook_shutdown_timeout", 10),
+            server_name=name,
+        )
+        server.max_request_body_size = max_body_size
+        return server
+    except ImportError:
+        # 未安装cheroot(web.py的依赖)时使用标准库的多线程服务，不支持线程数限制
+        from socketserver import ThreadingMixIn
+        from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = False
+            block_on_close = True
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+        logger.warning("[Webhook] cheroot not installed, fallback to wsgiref server")
+        return make_server(host, int(port), wsgi_app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+
+
+def serve(wsgi_app, port, host="0.0.0.0", name="webhook"):
+    """启动回调服务并阻塞当前线程"""
+    server = _create_server(wsgi_app, host, port, name)
+    _servers.append(server)
+    logger.info("[Webhook] {} server listening on {}:{}".format(name, host, port))
+    if hasattr(server, "safe_start"):
+        server.safe_start()
+    else:
+        server.serve_forever()
+
+
+def shutdown():
+    """停止接收新请求，等待处理中的请求和后台任务完成"""
+    while _servers:
+        server = _servers.pop()
+        try:
+            if hasattr(server, "safe_start"):
+                server.stop()
+            else:
+                server.shutdown()
+                server.server_close()
+        except Exception as e:
+            logger.warning("[Webhook] stop server error: {}".format(e))
+    for lane in _lanes or []:
+        lane.shutdown(wait=True)
+
+
+atexit.register(shutdown)
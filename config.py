@@ -5,8 +5,9 @@ import logging
 import os
 import pickle
 import copy
+import threading
 
-from common.log import logger
+from common.log import configure_logger, logger
 
 # 将所有可用的配置项写在字典里, 请使用小写字母
 # 此处的配置值无实际意义，程序不会读取此处的配置，仅用于提示格式，请将配置加入到config.json中
@@ -56,17 +57,71 @@ available_setting = {
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "max_session_count": 0,  # 内存中最多保留的会话数，超出时淘汰最久未使用的会话，0为不限制
+    "session_store": "",  # 会话持久化方式，可选 memory、sqlite、shelve，为空时不持久化，重启后会话丢失
+    "session_store_path": "",  # 持久化文件路径(不含扩展名)，默认为数据目录下的sessions
+    "session_store_flush_interval": 5,  # 会话修改写入存储的间隔秒数
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    # 会话历史压缩：超过conversation_max_tokens * summary_trigger_ratio时，后台把较早的对话总结为摘要，代替直接丢弃
+    "summary_enabled": False,
+    "summary_model": "gpt-3.5-turbo",  # 生成摘要使用的模型，通过open_ai_api_base调用，建议使用便宜的模型
+    "summary_trigger_ratio": 0.8,
+    "summary_keep_turns": 2,  # 保留最近几轮对话不参与总结
+    "summary_max_length": 300,  # 摘要的最大字数
+    # 流式回复配置
+    "stream_reply": False,  # 是否开启流式回复，开启后长回复会按句子分段发送
+    "stream_reply_min_length": 20,  # 流式回复每段的最小长度
+    "stream_reply_max_length": 500,  # 流式回复每段的最大长度
+    # 对冲请求配置，主模型响应慢或出错时请求备用模型，采用先成功的回复
+    "hedge_backup_bot_type": "",  # 备用模型的bot_type，为空表示不开启
+    "hedge_quantile": 0.9,  # 主模型等待时间取其近期耗时的该分位数
+    "hedge_default_delay": 8,  # 样本不足时主模型的等待时间(秒)
+    "hedge_min_delay": 2,  # 主模型最短等待时间(秒)
+    "hedge_max_delay": 30,  # 主模型最长等待时间(秒)
+    "hedge_min_samples": 20,  # 计算分位数所需的最少样本数
+    # 回复缓存配置，相同的问题直接返回缓存的回复
+    "reply_cache_enabled": False,  # 是否开启回复缓存
+    "reply_cache_group_names": [],  # 开启回复缓存的群名称，"ALL_GROUP"表示所有群
+    "reply_cache_single_chat": False,  # 私聊是否开启回复缓存
+    "reply_cache_ttl": 3600,  # 缓存有效期(秒)
+    "reply_cache_max_size": 1000,  # 最多缓存的回复数，超出时淘汰最久未使用的
+    "reply_cache_context_turns": 0,  # 缓存key包含的最近对话轮数，0表示只按问题本身匹配
+    "semantic_cache_enabled": False,  # 是否按语义相似度匹配换了说法的问题(需要numpy)，仅在reply_cache_context_turns为0时生效
+    "semantic_cache_threshold": 0.85,  # 余弦相似度阈值，越大越严格
+    "semantic_cache_max_size": 2000,  # 每个模型/人设最多缓存的问题数
+    "semantic_cache_dim": 1024,  # 问题向量的维度
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟消耗的token数限制，按回复返回的实际用量计算，0表示不限制
+    "rate_limit_session": 0,  # 每个会话(用户或群)每分钟的提问次数限制，0表示不限制
+    "rate_limit_wait": 0,  # 触发限流时最多等待的秒数，0表示立即回复繁忙，不占用处理线程
+    # bot接口出错时的重试配置，等待时间按指数退避，服务端返回Retry-After时以其为准
+    "retry_base_delay": 2,  # 首次重试的基础等待秒数
+    "retry_max_delay": 60,  # 单次重试的最长等待秒数
+    "retry_deadline": 120,  # 从开始处理消息起，超过该秒数不再重试，有回复时间限制的渠道(如公众号被动回复)自动取两者的较小值
+    "retry_deadlines": {},  # 按渠道类型覆盖retry_deadline，如{"wechatmp": 10}
+    # 多api_key负载均衡，列表元素为key字符串或{"key": "", "weight": 1, "max_in_flight": 0, "tokens_per_minute": 0}，为空时使用对应的单个api_key
+    "open_ai_api_keys": [],
+    "linkai_api_keys": [],
+    "claude_api_keys": [],
+    "moonshot_api_keys": [],
+    "api_key_max_in_flight": 0,  # 每个key同时进行中的请求数上限，0表示不限制
+    "api_key_evict_seconds": 60,  # key返回429后暂停选用的秒数，返回401时为10倍
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
+    "http_pool_size": 16,  # 每个host共享连接池的最大连接数
+    "http_host_timeouts": {},  # 按host配置的默认超时，如 {"api.openai.com": [5, 180]}，单位秒
+    # 发送网络图片、视频、文件时的下载配置
+    "media_cache_dir": "",  # 下载缓存目录，为空时使用tmp/media_cache
+    "media_max_size": 100 * 1024 * 1024,  # 单个文件的最大字节数，超过时不下载，0表示不限制
+    "media_download_workers": 4,  # 并行下载的线程数
+    "media_cache_ttl": 86400,  # 缓存文件保留的秒数，有效期内相同url不重复下载
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
@@ -153,6 +208,13 @@ available_setting = {
     "feishu_app_secret": "",  # 飞书机器人APP secret
     "feishu_token": "",  # 飞书 verification token
     "feishu_bot_name": "",  # 飞书机器人的名字
+    # 回调服务配置(公众号、企业微信应用、飞书、weworktop共用)
+    "webhook_server_threads": 32,  # 处理回调请求的线程数
+    "webhook_request_queue_size": 128,  # 等待处理的连接队列长度
+    "webhook_keepalive_timeout": 10,  # 连接空闲超时秒数，超时后关闭keep-alive连接
+    "webhook_max_body_size": 2 * 1024 * 1024,  # 请求体最大字节数，超出返回413，0表示不限制
+    "webhook_dispatch_threads": 8,  # 收到回调后构造消息的后台线程数
+    "webhook_shutdown_timeout": 10,  # 退出时等待处理中请求完成的最长秒数
     # 钉钉配置
     "dingtalk_client_id": "",  # 钉钉机器人Client ID 
     "dingtalk_client_secret": "",  # 钉钉机器人Client Secret
@@ -164,6 +226,13 @@ available_setting = {
     "channel_type": "",  # 通道类型，支持：{wx,wxy,ntchat,terminal,wechatmp,wechatmp_service,wechatcom_app,wework,weworktop,feishu,dingtalk}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
+    "log_max_bytes": 50 * 1024 * 1024,  # 日志文件run.log超过该大小后轮转，0表示不轮转
+    "log_backup_count": 5,  # 保留的历史日志文件个数
+    "log_json": False,  # 日志文件是否输出为每行一条的JSON
+    "metrics_port": 0,  # 本地指标端口，开启后可通过http://metrics_host:metrics_port/metrics获取Prometheus格式的指标，0表示不开启
+    "metrics_host": "127.0.0.1",  # 指标端口监听的地址
+    "config_watch_interval": 0,  # 检查config.json和plugins/config.json是否修改的间隔秒数，修改后自动热更新，0表示不开启
+    "config_watch_debounce": 1,  # 文件停止变化多少秒后再重新加载，避免读到写了一半的文件
     "appdata_dir": "",  # 数据目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
@@ -189,9 +258,19 @@ available_setting = {
 }
 
 
+_MISSING = object()
+
+
 class Config(dict):
+    """
+    配置快照。发布后（conf()返回的对象）不再原地修改：写入配置项时基于当前配置生成新版本并原子替换，
+    已经拿到旧快照的调用方不会读到修改了一半的配置。每次发布version加一，可通过subscribe_config订阅变化。
+    """
+
     def __init__(self, d=None):
         super().__init__()
+        self.frozen = False
+        self.version = 0
         if d is None:
             d = {}
         for k, v in d.items():
@@ -200,22 +279,65 @@ class Config(dict):
         self.user_datas = {}
 
     def __getitem__(self, key):
-        if key not in available_setting:
-            raise Exception("key {} not in available_setting".format(key))
-        return super().__getitem__(key)
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        if self.frozen:
+            update_config({key: value})
+            return
         return super().__setitem__(key, value)
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
+        # 写入时已校验key，这里只有缺失时才检查key是否合法
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
             return default
-        except Exception as e:
-            raise e
+        return value
+
+    def _check_mutable(self):
+        if self.frozen:
+            raise TypeError("published config is immutable, use update_config instead")
+
+    def __delitem__(self, key):
+        self._check_mutable()
+        return super().__delitem__(key)
+
+    def pop(self, *args):
+        self._check_mutable()
+        return super().pop(*args)
+
+    def update(self, *args, **kwargs):
+        self._check_mutable()
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def setdefault(self, key, default=None):
+        self._check_mutable()
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        self._check_mutable()
+        return super().clear()
+
+    def copy(self):
+        """返回可修改的副本，共享user_datas"""
+        new_config = Config(dict(self))
+        new_config.user_datas = self.user_datas
+        return new_config
+
+    def __reduce__(self):
+        return Config, (dict(self),)
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
@@ -244,6 +366,59 @@ class Config(dict):
 
 
 config = Config()
+config.frozen = True
+_config_lock = threading.RLock()
+_subscribers = []
+# 运行中通过update_config修改的配置项，如通道启动时设置的白名单、#model、LinkAI开关等，
+# reload_config重新读取配置文件后会覆盖在文件配置之上，避免热更新丢失这些修改
+_runtime_overrides = {}
+
+
+def subscribe_config(callback):
+    """
+    订阅配置变化，每次发布新配置后调用callback(old_config, new_config, changed_keys)
+    回调在发布配置的线程中执行，应尽快返回
+    """
+    _subscribers.append(callback)
+
+
+def _swap_config(new_config):
+    # 需持有_config_lock调用，只替换全局配置，返回旧配置
+    global config
+    old_config = config
+    new_config.version = old_config.version + 1
+    new_config.frozen = True
+    config = new_config
+    return old_config
+
+
+def _notify_subscribers(old_config, new_config):
+    # 在_config_lock之外调用，订阅者中再读写配置或执行耗时操作不会阻塞其他线程
+    changed_keys = set(k for k in set(old_config) | set(new_config) if dict.get(old_config, k, _MISSING) != dict.get(new_config, k, _MISSING))
+    for callback in list(_subscribers):
+        try:
+            callback(old_config, new_config, changed_keys)
+        except Exception as e:
+            logger.exception("[Config] subscriber error: {}".format(e))
+    return changed_keys
+
+
+def publish_config(new_config):
+    """原子替换全局配置并通知订阅者，返回变化的配置项"""
+    with _config_lock:
+        old_config = _swap_config(new_config)
+    return _notify_subscribers(old_config, new_config)
+
+
+def update_config(changes: dict):
+    """基于当前配置修改部分配置项并发布新版本，修改会在reload_config后保留"""
+    with _config_lock:
+        new_config = config.copy()
+        for k, v in changes.items():
+            new_config[k] = v
+        _runtime_overrides.update(changes)
+        old_config = _swap_config(new_config)
+    return _notify_subscribers(old_config, new_config)
 
 
 def drag_sensitive(config):
@@ -258,7 +433,7 @@ def drag_sensitive(config):
             return json.dumps(conf_dict_copy, indent=4)
 
         elif isinstance(config, dict):
-            config_copy = copy.deepcopy(config)
+            config_copy = copy.deepcopy(dict(config))
             for key in config:
                 if "key" in key or "secret" in key:
                     if isinstance(config_copy[key], str):
@@ -270,44 +445,89 @@ def drag_sensitive(config):
     return config
 
 
-def load_config():
-    global config
+_env_overrides = None
+
+
+def _get_env_overrides():
+    # 环境变量在进程运行期间不会变化，只在首次加载时解析
+    global _env_overrides
+    if _env_overrides is None:
+        _env_overrides = {}
+        for name, value in os.environ.items():
+            name = name.lower()
+            if name in available_setting:
+                logger.info("[INIT] override config by environ args: {}={}".format(name, value))
+                try:
+                    _env_overrides[name] = eval(value)
+                except:
+                    if value == "false":
+                        _env_overrides[name] = False
+                    elif value == "true":
+                        _env_overrides[name] = True
+                    else:
+                        _env_overrides[name] = value
+    return _env_overrides
+
+
+def get_config_path():
     config_path = "./config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
         config_path = "./config-template.json"
+    return config_path
+
 
-    config_str = read_file(config_path)
-    logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
+def _read_config():
+    config_str = read_file(get_config_path())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[INIT] config str: %s", drag_sensitive(config_str))
 
-    # 将json字符串反序列化为dict类型
+    # 将json字符串反序列化为dict类型，全部处理完成后再替换全局配置
     config = Config(json.loads(config_str))
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
-    for name, value in os.environ.items():
-        name = name.lower()
-        if name in available_setting:
-            logger.info("[INIT] override config by environ args: {}={}".format(name, value))
-            try:
-                config[name] = eval(value)
-            except:
-                if value == "false":
-                    config[name] = False
-                elif value == "true":
-                    config[name] = True
-                else:
-                    config[name] = value
+    for name, value in _get_env_overrides().items():
+        config[name] = value
+
+    configure_logger(config.get("log_max_bytes", 50 * 1024 * 1024), config.get("log_backup_count", 5), config.get("log_json", False))
+    return config
+
 
+def _apply_log_level(config):
+    logger.setLevel(logging.DEBUG if config.get("debug", False) else logging.INFO)
     if config.get("debug", False):
-        logger.setLevel(logging.DEBUG)
         logger.debug("[INIT] set log level to DEBUG")
 
+
+def load_config():
+    config = _read_config()
+    _apply_log_level(config)
     logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
 
+    publish_config(config)
     config.load_user_datas()
 
 
+def reload_config():
+    """
+    运行中重新读取配置文件，保留内存中的用户数据和运行中修改的配置项，返回变化的配置项。
+    各组件通过subscribe_config只刷新受影响的部分
+    """
+    new_config = _read_config()
+    with _config_lock:
+        for k, v in _runtime_overrides.items():
+            new_config[k] = v
+        new_config.user_datas = conf().user_datas
+        old_config = _swap_config(new_config)
+    changed_keys = _notify_subscribers(old_config, new_config)
+    # 只有配置文件中的debug发生变化时才调整日志级别，保留#debug命令在运行中的切换
+    if "debug" in changed_keys:
+        _apply_log_level(new_config)
+    logger.info("[Config] config reloaded, changed keys: {}".format(sorted(changed_keys)))
+    return changed_keys
+
+
 def get_root():
     return os.path.dirname(os.path.abspath(__file__))
 
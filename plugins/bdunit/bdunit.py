@@ -10,8 +10,12 @@ import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.token_cache import get_token_cache
 from plugins import *
 
+# access_token无效或已过期的错误码
+INVALID_TOKEN_CODES = (110, 111)
+
 """利用百度UNIT实现智能对话
     如果命中意图，返回意图对应的回复，否则返回继续交付给下个插件处理
 """
@@ -35,7 +39,7 @@ class BDunit(Plugin):
             self.service_id = conf["service_id"]
             self.api_key = conf["api_key"]
             self.secret_key = conf["secret_key"]
-            self.access_token = self.get_token()
+            self.get_token()  # 初始化时检查api_key和secret_key是否可用
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             logger.info("[BDunit] inited")
         except Exception as e:
@@ -65,12 +69,21 @@ class BDunit(Plugin):
         return help_text
 
     def get_token(self):
-        """获取访问百度UUNIT 的access_token
+        """获取访问百度UUNIT 的access_token，有效期内复用缓存
         #param api_key: UNIT apk_key
         #param secret_key: UNIT secret_key
         Returns:
             string: access_token
         """
+        return get_token_cache("baidu:" + str(self.api_key), self._request_token).get()
+
+    def _check_token(self, parsed):
+        """access_token失效时清除缓存，下次请求重新获取"""
+        if parsed and parsed.get("error_code") in INVALID_TOKEN_CODES:
+            get_token_cache("baidu:" + str(self.api_key), self._request_token).invalidate()
+        return parsed
+
+    def _request_token(self):
         url = "https://aip.baidubce.com/oauth/2.0/token?client_id={}&client_secret={}&grant_type=client_credentials".format(self.api_key, self.secret_key)
         payload = ""
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
@@ -78,7 +91,8 @@ class BDunit(Plugin):
         response = requests.request("POST", url, headers=headers, data=payload)
 
         # print(response.text)
-        return response.json()["access_token"]
+        res = response.json()
+        return res["access_token"], res.get("expires_in")
 
     def getUnit(self, query):
         """
@@ -87,7 +101,7 @@ class BDunit(Plugin):
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
 
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + self.access_token
+        url = "https://aip.baidubce.com/rpc/2.0/unit/service/v3/chat?access_token=" + self.get_token()
         request = {
             "query": query,
             "user_id": str(get_mac())[:32],
@@ -103,7 +117,7 @@ class BDunit(Plugin):
         try:
             headers = {"Content-Type": "application/json"}
             response = requests.post(url, json=body, headers=headers)
-            return json.loads(response.text)
+            return self._check_token(json.loads(response.text))
         except Exception:
             return None
 
@@ -114,7 +128,7 @@ class BDunit(Plugin):
         :param query: 用户的指令字符串
         :returns: UNIT 解析结果。如果解析失败，返回 None
         """
-        url = "https://aip.baidubce.com/rpc/2.0/unit/service/chat?access_token=" + self.access_token
+        url = "https://aip.baidubce.com/rpc/2.0/unit/service/chat?access_token=" + self.get_token()
         request = {"query": query, "user_id": str(get_mac())[:32]}
         body = {
             "log_id": str(uuid.uuid1()),
@@ -126,7 +140,7 @@ class BDunit(Plugin):
         try:
             headers = {"Content-Type": "application/json"}
             response = requests.post(url, json=body, headers=headers)
-            return json.loads(response.text)
+            return self._check_token(json.loads(response.text))
         except Exception:
             return None
 
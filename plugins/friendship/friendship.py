@@ -26,7 +26,7 @@ class FriendshipChat:
     def chat(self, content):
         session = self.bot.sessions.build_session(self.sessionid)
         if session.system_prompt != self.character_desc:  # 目前没有触发session过期事件，这里先简单判断，然后重置
-            session.set_system_prompt(self.character_desc)
+            self.bot.sessions.build_session(self.sessionid, system_prompt=self.character_desc)
         new_content = content  # 暂时没有修改content
         return new_content
 
@@ -12,8 +12,8 @@ import plugins
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from common import const
-from config import conf, load_config, global_config
+from common import const, http_client, metrics
+from config import conf, reload_config, global_config
 from plugins import *
 
 # 定义指令集
@@ -135,6 +135,10 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "stats": {
+        "alias": ["stats", "统计"],
+        "desc": "查看消息处理各阶段的耗时和HTTP连接复用统计",
+    },
 }
 
 
@@ -276,8 +280,8 @@ class Godcmd(Plugin):
                         if args[0] not in const.MODEL_LIST:
                             ok, result = False, "模型名称不存在"
                         else:
+                            # 发布新配置后由Bridge只重建对话bot，并保留已有会话
                             conf()["model"] = self.model_mapping(args[0])
-                            Bridge().reset_bot()
                             model = conf().get("model") or const.GPT35
                             ok, result = True, "模型设置为: " + str(model)
                 elif cmd == "id":
@@ -349,8 +353,8 @@ class Godcmd(Plugin):
                             else:
                                 ok, result = True, f"亲爱的，{to_user_nickname}正在这里玩得不亦乐乎呢~✨不许打扰我的快乐时光哦🎈"
                         elif cmd == "reconf":
-                            load_config()
-                            ok, result = True, "配置已重载"
+                            changed_keys = reload_config()
+                            ok, result = True, "配置已重载，变化的配置项: {}".format(", ".join(sorted(changed_keys)) or "无")
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI,
                                            const.BAIDU, const.XUNFEI, const.QWEN, const.GEMINI, const.ZHIPU_AI, const.MOONSHOT]:
@@ -366,6 +370,14 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "stats":
+                            ok, result = True, "各阶段耗时统计：\n" + (metrics.summary() or "暂无数据")
+                            router = Bridge().get_router()
+                            if router:
+                                result += "\n\n模型近期耗时：\n" + "\n".join("{}: {}".format(k, v) for k, v in router.stats().items())
+                            http_stats = http_client.stats()
+                            if http_stats:
+                                result += "\n\nHTTP连接复用：\n" + "\n".join("{}: {}".format(k, v) for k, v in http_stats.items())
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -296,4 +296,4 @@ def _find_file_id(context):
         return USER_FILE_MAP.get(user_id + "-file_id")
 
 
-USER_FILE_MAP = ExpiredDict(conf().get("expires_in_seconds") or 60 * 30)
+USER_FILE_MAP = ExpiredDict(conf().get("expires_in_seconds") or 60 * 30, max_size=10000)
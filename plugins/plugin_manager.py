@@ -1,17 +1,20 @@
 # encoding:utf-8
 
+import copy
 import importlib
 import importlib.util
 import json
 import os
 import sys
 
+from common import metrics
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
-from config import conf, write_plugin_config
+from config import conf, plugin_config, write_plugin_config
 
 from .event import *
+from .plugin import Plugin
 
 
 @singleton
@@ -84,6 +87,30 @@ class PluginManager:
         except Exception as e:
             logger.error(e)
 
+    def reload_plugin_configs(self):
+        """
+        重新读取 plugins/config.json，只刷新配置发生变化的插件：实现了reload的插件调用reload，
+        其余插件重新创建实例，返回刷新的插件名称
+        """
+        old_config = copy.deepcopy(plugin_config)
+        self._load_all_config()
+        reloaded = []
+        for name, instance in list(self.instances.items()):
+            key = instance.name.lower()
+            if plugin_config.get(key) == old_config.get(key):
+                continue
+            try:
+                if type(instance).reload is not Plugin.reload:
+                    instance.reload()
+                else:
+                    self.instances[name] = self.plugins[name]()
+                reloaded.append(name)
+            except Exception as e:
+                logger.warning("[PluginManager] reload config of plugin {} failed: {}".format(name, e))
+        if reloaded:
+            logger.info("[PluginManager] plugin config reloaded: {}".format(reloaded))
+        return reloaded
+
     def scan_plugins(self):
         logger.info("Scaning plugins ...")
         plugins_dir = "./plugins"
@@ -188,7 +215,8 @@ class PluginManager:
                 if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
                     logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
                     instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
+                    with metrics.timer("plugin_handler_seconds", plugin=name, event=e_context.event.name):
+                        instance.handlers[e_context.event](e_context, *args, **kwargs)
                     if e_context.is_break():
                         e_context["breaked_by"] = name
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
@@ -10,7 +10,6 @@ Description:
 
 import json
 import time
-import requests
 import datetime
 import hashlib
 import hmac
@@ -18,6 +17,7 @@ import base64
 import urllib.parse
 import uuid
 
+from common import http_client
 from common.log import logger
 from common.tmp_dir import TmpDir
 
@@ -46,7 +46,7 @@ def text_to_speech_aliyun(url, text, appkey, token):
         "format": "wav"
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = http_client.post(url, headers=headers, data=json.dumps(data))
 
     if response.status_code == 200 and response.headers['Content-Type'] == 'audio/mpeg':
         output_file = TmpDir().path() + "reply-" + str(int(time.time())) + "-" + str(hash(text) & 0x7FFFFFFF) + ".wav"
@@ -147,6 +147,6 @@ class AliyunTokenGenerator:
         url = 'http://nls-meta.cn-shanghai.aliyuncs.com/?' + urllib.parse.urlencode(params)
 
         # 发送请求
-        response = requests.get(url)
+        response = http_client.get(url)
 
         return response.text